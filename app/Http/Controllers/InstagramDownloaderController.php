@@ -480,6 +480,87 @@ public function cookieStatus()
         ]);
     }
 
+    /**
+     * Socket path of the resident Python worker, or null when it is not running
+     */
+    private function getWorkerSocketPath(): ?string
+    {
+        $path = config('services.python.worker_socket');
+        if (! $path || ! file_exists($path)) {
+            return null;
+        }
+        return $path;
+    }
+
+    /**
+     * Send one job to the resident worker (instagram_fetch.py --serve --socket)
+     */
+    private function runWorkerJob(string $socketPath, array $job): ?string
+    {
+        $socket = @stream_socket_client('unix://' . $socketPath, $errno, $errstr, 5);
+        if (! $socket) {
+            Log::warning('Python worker socket unavailable, falling back to process', [
+                'socket' => $socketPath,
+                'error' => $errstr,
+            ]);
+            return null;
+        }
+
+        stream_set_timeout($socket, 600);
+        fwrite($socket, json_encode($job) . "\n");
+        $line = fgets($socket);
+        fclose($socket);
+
+        if ($line === false) {
+            Log::warning('Python worker socket returned no response, falling back to process', ['socket' => $socketPath]);
+            return null;
+        }
+
+        return $line;
+    }
+
+    /**
+     * Run the Python worker as a one-shot process
+     */
+    private function runWorkerProcess(string $python, string $pythonScript, string $url, string $downloadPath, string $cookiesJson, string $ytDlpPath, ?string $quality = null): ?string
+    {
+        $escapedPython = escapeshellarg($python);
+        $escapedScript = escapeshellarg($pythonScript);
+        $escapedUrl = escapeshellarg($url);
+        $escapedDownloadPath = escapeshellarg($downloadPath);
+        $escapedCookiesJson = escapeshellarg($cookiesJson);
+        $escapedYtDlpPath = escapeshellarg($ytDlpPath);
+
+        $timingsFlag = config('services.python.worker_timings') ? '--timings ' : '';
+        $qualityFlag = $quality ? '--quality ' . escapeshellarg($quality) . ' ' : '';
+
+        $cmd = "{$escapedPython} {$escapedScript} {$timingsFlag}{$qualityFlag}{$escapedUrl} {$escapedDownloadPath} {$escapedCookiesJson} {$escapedYtDlpPath} 2>&1";
+
+        Log::debug('Executing command', ['cmd' => substr($cmd, 0, 500) . '...']);
+
+        $originalCwd = getcwd();
+        $scriptDir = dirname($pythonScript);
+        chdir($scriptDir);
+
+        $envBackup = [
+            'HOME' => getenv('HOME'),
+            'PATH' => getenv('PATH'),
+        ];
+
+        putenv('HOME=/tmp');
+        putenv('PATH=/usr/local/bin:/usr/bin:/bin:' . getenv('PATH'));
+
+        $output = shell_exec($cmd);
+
+        chdir($originalCwd);
+        putenv('HOME=' . ($envBackup['HOME'] ?: ''));
+        if ($envBackup['PATH']) {
+            putenv('PATH=' . $envBackup['PATH']);
+        }
+
+        return $output === false ? null : $output;
+    }
+
     /**
      * Fetch Instagram content via Python worker with multiple cookie support
      */
@@ -490,15 +571,18 @@ public function fetch(Request $request)
         $request->validate(
             [
                 'url' => ['required', 'url', 'regex:/^https?:\/\/(www\.)?instagram\.com\/(p|reel|reels|tv|stories)\/[\w\-\.]+/i'],
+                'quality' => ['nullable', 'string', 'regex:/^(original|\d{2,4}(p|px)?(,\d{2,4}(p|px)?)?)$/i'],
             ],
             [
                 'url.required' => 'Please enter an Instagram URL.',
                 'url.url' => 'Please enter a valid URL.',
                 'url.regex' => 'Please enter a valid Instagram URL (post, reel, video, or story).',
+                'quality.regex' => 'Please choose a valid quality (for example 720p or 640px).',
             ],
         );
 
         $url = $request->input('url');
+        $quality = $request->input('quality');
 
         try {
             $sessionId = Str::uuid()->toString();
@@ -549,35 +633,21 @@ public function fetch(Request $request)
                 'download_path' => $downloadPath,
             ]);
 
-            $escapedPython = escapeshellarg($python);
-            $escapedScript = escapeshellarg($pythonScript);
-            $escapedUrl = escapeshellarg($url);
-            $escapedDownloadPath = escapeshellarg($downloadPath);
-            $escapedCookiesJson = escapeshellarg($cookiesJson);
-            $escapedYtDlpPath = escapeshellarg($ytDlpPath);
-
-            $cmd = "{$escapedPython} {$escapedScript} {$escapedUrl} {$escapedDownloadPath} {$escapedCookiesJson} {$escapedYtDlpPath} 2>&1";
-
-            Log::debug('Executing command', ['cmd' => substr($cmd, 0, 500) . '...']);
-
-            $originalCwd = getcwd();
-            $scriptDir = dirname($pythonScript);
-            chdir($scriptDir);
-
-            $envBackup = [
-                'HOME' => getenv('HOME'),
-                'PATH' => getenv('PATH'),
-            ];
-
-            putenv('HOME=/tmp');
-            putenv('PATH=/usr/local/bin:/usr/bin:/bin:' . getenv('PATH'));
-
-            $output = shell_exec($cmd);
+            $output = null;
+            $workerSocket = $this->getWorkerSocketPath();
+            if ($workerSocket) {
+                $output = $this->runWorkerJob($workerSocket, [
+                    'url' => $url,
+                    'download_path' => $downloadPath,
+                    'cookies' => $cookieFiles,
+                    'yt_dlp_path' => $ytDlpPath,
+                    'timings' => (bool) config('services.python.worker_timings'),
+                    'quality' => $quality,
+                ]);
+            }
 
-            chdir($originalCwd);
-            putenv('HOME=' . ($envBackup['HOME'] ?: ''));
-            if ($envBackup['PATH']) {
-                putenv('PATH=' . $envBackup['PATH']);
+            if ($output === null) {
+                $output = $this->runWorkerProcess($python, $pythonScript, $url, $downloadPath, $cookiesJson, $ytDlpPath, $quality);
             }
 
             Log::info('Python script completed', [
@@ -631,6 +701,7 @@ public function fetch(Request $request)
                     'error' => $jsonOutput['error'],
                     'type' => $jsonOutput['error_type'] ?? 'unknown',
                     'debug' => $jsonOutput['debug'] ?? null,
+                    'timings' => $jsonOutput['timings'] ?? null,
                 ]);
 
                 return response()->json([
@@ -678,7 +749,9 @@ public function fetch(Request $request)
                 'session_id' => $sessionId,
                 'type' => $jsonOutput['type'] ?? 'unknown',
                 'items_count' => count($jsonOutput['items'] ?? []),
+                'timings' => $jsonOutput['timings'] ?? null,
             ]);
+            unset($jsonOutput['timings']);
 
             return response()->json($jsonOutput);
         } catch (\Illuminate\Validation\ValidationException $e) {
@@ -36,7 +36,9 @@
     ],
 
     'python'   => [
-        'path' => env('PYTHON_PATH', 'python3'),
+        'path'           => env('PYTHON_PATH', 'python3'),
+        'worker_socket'  => env('PYTHON_WORKER_SOCKET'),
+        'worker_timings' => env('PYTHON_WORKER_TIMINGS', false),
     ],
 
     'ytdlp'    => [
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the yt-dlp command line, used by the benchmarks.
+
+Supports the calls the worker makes: --version, --dump-json and a plain
+download with -o, -f and --write-thumbnail. A "video+audio" -f fetches both
+formats and concatenates them, standing in for the ffmpeg merge. Metadata comes from the fixture
+named by the scenario's "ytdlp" key; media is fetched from the fixture
+server through IG_WORKER_HOST_OVERRIDES, so it shows up in request counts.
+"""
+
+import json
+import os
+import sys
+import urllib.request
+from urllib.parse import urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fixture_server import FIXTURES_DIR, load_scenarios
+
+
+def find_info(url):
+    """The yt-dlp info dict for url, or None if the scenario has none."""
+    for scenario in load_scenarios().values():
+        if scenario['url'] == url and scenario.get('ytdlp'):
+            with open(os.path.join(FIXTURES_DIR, scenario['ytdlp']), 'r', encoding='utf-8') as f:
+                return json.load(f)
+    return None
+
+
+def fetch(url, save_path, mode='wb'):
+    """GET url through the host overrides and save (or with mode 'ab', append) it."""
+    parsed = urlparse(url)
+    overrides = dict(
+        pair.split('=', 1) for pair in os.environ.get('IG_WORKER_HOST_OVERRIDES', '').split(',') if '=' in pair
+    )
+    address = overrides.get(parsed.hostname)
+    request_url = parsed._replace(scheme='http', netloc=address).geturl() if address else url
+    request = urllib.request.Request(request_url, headers={'Host': parsed.netloc})
+    with urllib.request.urlopen(request, timeout=30) as response, open(save_path, mode) as f:
+        f.write(response.read())
+
+
+def main(argv):
+    if '--version' in argv:
+        print('2099.01.01')
+        return 0
+
+    url = argv[-1]
+    info = find_info(url)
+    if info is None:
+        print(f"ERROR: [Instagram] {url}: Unsupported URL", file=sys.stderr)
+        return 1
+
+    if '--dump-json' in argv:
+        print(json.dumps(info))
+        return 0
+
+    template = argv[argv.index('-o') + 1]
+    base = template.replace('%(id)s', info['id']).replace('%(autonumber)s', '00001')
+    formats = {f['format_id']: f for f in info.get('formats') or []}
+    selected = argv[argv.index('-f') + 1].split('+') if '-f' in argv else []
+    chosen = [formats[format_id] for format_id in selected if format_id in formats] or [info]
+    for i, fmt in enumerate(chosen):
+        fetch(fmt['url'], base.replace('%(ext)s', info['ext']), 'ab' if i else 'wb')
+    if '--write-thumbnail' in argv and info.get('thumbnail'):
+        fetch(info['thumbnail'], base.replace('%(ext)s', 'jpg'))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for instagram.com and its CDN, used by the benchmarks.
+
+Post pages come from fixtures/ (see fixtures/scenarios.json); any other
+host is treated as the CDN and answers with deterministic bytes whose size
+depends on the file extension, honouring open-ended Range requests like a
+real CDN. Every request is counted per host.
+"""
+
+import json
+import os
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+PAGE_HOST = 'www.instagram.com'
+CDN_HOST = 'scontent-lhr8-1.cdninstagram.com'
+
+# Bytes served per CDN file type
+MEDIA_SIZES = {
+    '.jpg': 180 * 1024,
+    '.mp4': 2 * 1024 * 1024,
+}
+
+
+def load_scenarios():
+    """fixtures/scenarios.json as a dict."""
+    with open(os.path.join(FIXTURES_DIR, 'scenarios.json'), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def media_bytes(path):
+    """Deterministic body for a CDN path."""
+    size = MEDIA_SIZES.get(os.path.splitext(path)[1], 64 * 1024)
+    seed = (path.encode() * (1 + 4096 // max(len(path), 1)))[:4096]
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+class FixtureServer(ThreadingHTTPServer):
+    """Serves fixture pages and CDN media; pads pages to pad_bytes if set."""
+
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), pad_bytes=0):
+        super().__init__(address, FixtureHandler)
+        self.pages = {}
+        for scenario in load_scenarios().values():
+            with open(os.path.join(FIXTURES_DIR, scenario['page']), 'r', encoding='utf-8') as f:
+                html = f.read()
+            self.pages[urlparse(scenario['url']).path.rstrip('/')] = pad_page(html, pad_bytes).encode('utf-8')
+        self.counts = {}
+        self.counts_lock = threading.Lock()
+
+    @property
+    def address(self):
+        return f"{self.server_address[0]}:{self.server_address[1]}"
+
+    def host_overrides(self):
+        """Value for IG_WORKER_HOST_OVERRIDES pointing both hosts here."""
+        return f"{PAGE_HOST}={self.address},{CDN_HOST}={self.address}"
+
+    def count(self, host):
+        with self.counts_lock:
+            self.counts[host] = self.counts.get(host, 0) + 1
+
+    def reset_counts(self):
+        with self.counts_lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+def pad_page(html, pad_bytes):
+    """
+    Grow a fixture to roughly pad_bytes with the kind of inline script noise
+    real post pages carry, so extractor costs scale like they do in production.
+    """
+    if pad_bytes <= len(html):
+        return html
+    block = ('<script type="application/json" data-sjs>{"require":[["CometSSRMergedContentInjector",'
+             '"onPayloadReceived",null,[{"__bbox":{"define":[["CurrentUserInitialData",[],'
+             '{"ACCOUNT_ID":"0","USER_ID":"0","NAME":"","SHORT_NAME":null},270]]}}]]]}</script>\n')
+    filler = block * ((pad_bytes - len(html)) // len(block) + 1)
+    head, _, tail = html.partition('<body')
+    return head + '<body' + tail.replace('>', '>\n' + filler, 1)
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        host = (self.headers.get('Host') or '').split(':')[0]
+        path = urlparse(self.path).path
+        self.server.count(host)
+
+        if host == PAGE_HOST:
+            body = self.server.pages.get(path.rstrip('/'))
+            content_type = 'text/html; charset=utf-8'
+        else:
+            body = media_bytes(path)
+            content_type = 'video/mp4' if path.endswith('.mp4') else 'image/jpeg'
+
+        if body is None:
+            self.send_error(404)
+            return
+        start = self.range_start(len(body)) if host != PAGE_HOST else None
+        if start is not None and start >= len(body):
+            self.send_response(416)
+            self.send_header('Content-Range', f"bytes */{len(body)}")
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(206 if start is not None else 200)
+        self.send_header('Content-Type', content_type)
+        if host != PAGE_HOST:
+            self.send_header('ETag', f'"{zlib.crc32(path.encode()):08x}"')
+            self.send_header('Accept-Ranges', 'bytes')
+        if start is not None:
+            self.send_header('Content-Range', f"bytes {start}-{len(body) - 1}/{len(body)}")
+            body = body[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def range_start(self, size):
+        """Start of an open-ended "bytes=N-" Range request, or None to send everything."""
+        value = self.headers.get('Range') or ''
+        if not value.startswith('bytes=') or not value.endswith('-'):
+            return None
+        start = value[len('bytes='):-1]
+        return int(start) if start.isdigit() else None
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    server = FixtureServer(('127.0.0.1', int(os.environ.get('PORT', 8799))))
+    print(f"Serving fixtures on {server.address}")
+    print(f"IG_WORKER_HOST_OVERRIDES={server.host_overrides()}")
+    server.serve_forever()
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for instagram_fetch.
+
+Runs try_download end to end for every scenario in fixtures/scenarios.json
+against a local fixture server and a fake yt-dlp, times each extractor on the
+same pages, and compares the numbers with baseline.json. No network needed.
+
+Usage:
+    cd python_worker
+    python benchmarks/run_benchmarks.py                  # compare with baseline
+    python benchmarks/run_benchmarks.py --save-baseline  # record a new baseline
+
+Options:
+    --repeat N              Timed runs per scenario; the median is reported (default 5)
+    --pad-kb N              Pad fixture pages to about N KiB like real pages (default 512)
+    --threshold PCT         Allowed growth in peak memory before it counts as a
+                            regression (default 25)
+    --timing-threshold PCT  Allowed slowdown of a timing, after calibration,
+                            before it is flagged as slower (default 50)
+    --strict-timing         Fail on slower timings too
+    --verbose               Keep the worker's debug log on stderr
+
+Timings are compared relative to a calibration run: a fixed workload that
+does not touch the worker is timed alongside the scenarios, and baseline
+timings are scaled by how much faster or slower this machine ran it than the
+one that recorded the baseline.
+
+Exit status is 1 when a scenario's outcome does not match the fixture's
+expectation, a scenario made more requests than the baseline, or its peak
+memory grew past the threshold. Slower timings are only reported, unless
+--strict-timing is given.
+"""
+
+import contextlib
+import json
+import os
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+WORKER_DIR = os.path.dirname(BENCH_DIR)
+BASELINE_PATH = os.path.join(BENCH_DIR, 'baseline.json')
+
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, WORKER_DIR)
+
+from fixture_server import FIXTURES_DIR, FixtureServer, load_scenarios, pad_page
+
+# Differences below these are noise whatever the percentage
+NOISE_FLOORS = {
+    'latency_ms': 5.0,
+    'peak_kb': 64.0,
+    'parse_ms': 1.0,
+    'requests': 0,
+}
+
+TIMING_KINDS = ('latency_ms', 'parse_ms')
+
+COOKIE_FILE = (
+    "# Netscape HTTP Cookie File\n"
+    ".instagram.com\tTRUE\t/\tTRUE\t0\tsessionid\t1234567890%3Abenchmark%3A0%3Asession\n"
+    ".instagram.com\tTRUE\t/\tTRUE\t0\tcsrftoken\tbenchmarkcsrftoken\n"
+)
+
+
+def parse_args(argv):
+    options = {
+        'repeat': 5, 'pad_kb': 512, 'threshold': 25.0, 'timing_threshold': 50.0,
+        'save_baseline': False, 'strict_timing': False, 'verbose': False,
+    }
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in ('--save-baseline', '--strict-timing', '--verbose'):
+            options[arg[2:].replace('-', '_')] = True
+        elif arg in ('--repeat', '--pad-kb', '--threshold', '--timing-threshold') and i + 1 < len(argv):
+            key = arg[2:].replace('-', '_')
+            options[key] = float(argv[i + 1]) if key.endswith('threshold') else int(argv[i + 1])
+            i += 1
+        else:
+            print(__doc__)
+            sys.exit(2)
+        i += 1
+    return options
+
+
+def setup_environment(server, cache_dir):
+    """Point the worker at the fixture server and switch its caches off."""
+    os.environ.update({
+        'IG_WORKER_HOST_OVERRIDES': server.host_overrides(),
+        'IG_WORKER_CACHE_DIR': cache_dir,
+        'IG_WORKER_MEDIA_CACHE': '0',
+        'IG_WORKER_META_CACHE_TTL': '0',
+        'IG_WORKER_YTDLP_ENGINE': 'subprocess',
+    })
+    os.environ.pop('IG_WORKER_HEDGE', None)
+
+
+def check_outcome(expect, result, error_type):
+    """None when the try_download outcome matches the scenario, else a message."""
+    if 'error_type' in expect:
+        if result or error_type != expect['error_type']:
+            return f"expected {expect['error_type']}, got {error_type or 'success'}"
+        return None
+    if not result:
+        return f"expected success, got {error_type}"
+    if result['content_type'] != expect['content_type'] or len(result['items']) != expect['items']:
+        return (f"expected {expect['content_type']} with {expect['items']} item(s), "
+                f"got {result['content_type']} with {len(result['items'])}")
+    return None
+
+
+def run_scenario(worker, server, scenario, cookie_path, ytdlp_cmd, repeat):
+    """Time try_download for one scenario. Returns (metrics, problem)."""
+    work_dir = tempfile.mkdtemp(prefix='ig-bench-')
+    latencies = []
+    problem = None
+    try:
+        for run in range(repeat + 1):
+            download_path = os.path.join(work_dir, str(run))
+            server.reset_counts()
+            if run == repeat:
+                # Allocation run, kept apart because tracemalloc slows everything down
+                tracemalloc.start()
+            started = time.perf_counter()
+            result, _, error_type, _ = worker.try_download(scenario['url'], download_path, cookie_path, ytdlp_cmd, 0)
+            elapsed = time.perf_counter() - started
+            if run == repeat:
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            else:
+                latencies.append(elapsed * 1000)
+            problem = problem or check_outcome(scenario['expect'], result, error_type)
+        counts = server.reset_counts()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'latency_ms': round(statistics.median(latencies), 2),
+        'peak_kb': round(peak / 1024, 1),
+        'requests': sum(counts.values()),
+    }, problem
+
+
+def time_call(func, repeat):
+    """Best-of-repeat wall time of func() in milliseconds."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = (time.perf_counter() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best, 3)
+
+
+def time_extractors(worker, scenario, pad_bytes, repeat):
+    """Parse time of each extractor on the scenario's (padded) page."""
+    with open(os.path.join(FIXTURES_DIR, scenario['page']), 'r', encoding='utf-8') as f:
+        html = pad_page(f.read(), pad_bytes)
+    url = scenario['url']
+    shortcode = worker.extract_shortcode(url)
+    extractors = {
+        'scan_media_payloads': lambda: worker.scan_media_payloads(html),
+        'extract_post_info_from_html': lambda: worker.extract_post_info_from_html(html, shortcode),
+        'find_carousel_media': lambda: worker.find_carousel_media(html, shortcode),
+        'extract_post_images_from_page': lambda: worker.extract_post_images_from_page(worker.PostPage(url, html), shortcode),
+        'extract_video_url_from_page': lambda: worker.extract_video_url_from_page(worker.PostPage(url, html), shortcode),
+        'extract_post_metadata': lambda: worker.extract_post_metadata(worker.PostPage(url, html), url, shortcode),
+    }
+    return {name: time_call(func, max(repeat * 2, 10)) for name, func in extractors.items()}
+
+
+def calibrate(repeat):
+    """
+    Best-of time of a fixed regex and JSON workload on a padded fixture page,
+    in milliseconds. It uses no worker code, so it only measures the machine.
+    """
+    with open(os.path.join(FIXTURES_DIR, 'carousel.html'), 'r', encoding='utf-8') as f:
+        html = pad_page(f.read(), 256 * 1024)
+
+    def workload():
+        re.findall(r'"(\w+)"\s*:\s*"([^"]*)"', html)
+        json.loads(json.dumps({'page': html}))
+
+    return time_call(workload, max(repeat * 4, 20))
+
+
+def metric_kind(name):
+    """Which NOISE_FLOORS entry applies to a metric name."""
+    if name.startswith('parse.'):
+        return 'parse_ms'
+    return name.rsplit('.', 1)[1]
+
+
+def compare(results, baseline, calibration_ms, threshold, timing_threshold):
+    """
+    Print results next to the baseline, with baseline timings scaled by the
+    calibration ratio. Returns (regressed metric names, slower timing names).
+    """
+    scale = calibration_ms / baseline['calibration_ms'] if baseline.get('calibration_ms') else 1.0
+    regressions = []
+    slower = []
+    print(f"calibration: {calibration_ms} ms (baseline {baseline.get('calibration_ms', '-')}), timings scaled x{scale:.2f}")
+    print(f"{'metric':<62} {'expected':>10} {'current':>10} {'change':>8}")
+    for name, value in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<62} {'-':>10} {value:>10} {'new':>8}")
+            continue
+        kind = metric_kind(name)
+        floor = NOISE_FLOORS[kind]
+        if kind in TIMING_KINDS:
+            base = round(base * scale, 3)
+            floor *= scale
+        change = ((value - base) / base * 100) if base else (0.0 if value == base else 100.0)
+        marker = ''
+        if kind == 'requests':
+            if value > base:
+                regressions.append(name)
+                marker = '  <-- regression'
+        elif kind in TIMING_KINDS:
+            if value - base > floor and change > timing_threshold:
+                slower.append(name)
+                marker = '  <-- slower'
+        elif value - base > floor and change > threshold:
+            regressions.append(name)
+            marker = '  <-- regression'
+        print(f"{name:<62} {base:>10} {value:>10} {change:>+7.1f}%{marker}")
+    return regressions, slower
+
+
+def main(argv):
+    options = parse_args(argv)
+    server = FixtureServer(pad_bytes=options['pad_kb'] * 1024).start()
+    cache_dir = tempfile.mkdtemp(prefix='ig-bench-cache-')
+    setup_environment(server, cache_dir)
+
+    import instagram_fetch as worker
+
+    cookie_fd, cookie_path = tempfile.mkstemp(prefix='ig-bench-', suffix='.txt')
+    with os.fdopen(cookie_fd, 'w') as f:
+        f.write(COOKIE_FILE)
+    ytdlp_cmd = [sys.executable, os.path.join(BENCH_DIR, 'fake_ytdlp.py')]
+
+    results = {}
+    problems = []
+    stderr = sys.stderr if options['verbose'] else open(os.devnull, 'w')
+    try:
+        with contextlib.redirect_stderr(stderr):
+            calibration_ms = calibrate(options['repeat'])
+            for name, scenario in load_scenarios().items():
+                metrics, problem = run_scenario(worker, server, scenario, cookie_path, ytdlp_cmd, options['repeat'])
+                for metric, value in metrics.items():
+                    results[f"{name}.{metric}"] = value
+                if problem:
+                    problems.append(f"{name}: {problem}")
+                for extractor, value in time_extractors(worker, scenario, options['pad_kb'] * 1024, options['repeat']).items():
+                    results[f"parse.{name}.{extractor}"] = value
+            # Once more at the end, so a machine that slowed down mid-run is not blamed on the worker
+            calibration_ms = max(calibration_ms, calibrate(options['repeat']))
+    finally:
+        server.shutdown()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.remove(cookie_path)
+
+    if options['save_baseline']:
+        with open(BASELINE_PATH, 'w', encoding='utf-8') as f:
+            json.dump(dict(results, calibration_ms=calibration_ms), f, indent=2)
+            f.write('\n')
+        print(f"Baseline saved to {BASELINE_PATH}")
+        regressions, slower = [], []
+    else:
+        baseline = {}
+        if os.path.isfile(BASELINE_PATH):
+            with open(BASELINE_PATH, 'r', encoding='utf-8') as f:
+                baseline = json.load(f)
+        regressions, slower = compare(results, baseline, calibration_ms, options['threshold'], options['timing_threshold'])
+
+    for problem in problems:
+        print(f"OUTCOME MISMATCH {problem}")
+    if regressions:
+        print(f"{len(regressions)} metric(s) regressed: {', '.join(regressions)}")
+    if slower:
+        print(f"{len(slower)} timing(s) more than {options['timing_threshold']:g}% slower than the calibrated baseline")
+    failed = problems or regressions or (slower and options['strict_timing'])
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
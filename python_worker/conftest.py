@@ -0,0 +1,3 @@
+# test_fetch.py is the interactive debug tool (live Instagram, real cookies);
+# its test_* functions take arguments and are not pytest tests.
+collect_ignore = ['test_fetch.py']
@@ -4,11 +4,160 @@ Instagram Downloader - Python Worker
 IGReelDownloader.net
 
 Supports: Reels, Videos, Photos, Stories, Carousel posts.
-- Uses yt-dlp for video content (as module or binary)
+- Uses yt-dlp for video content (in-process API, or module/binary subprocess)
 - Uses direct HTTP requests for photo content
 
+Environment:
+    IG_WORKER_YTDLP_ENGINE   auto (default), api or subprocess. "auto" drives
+                             yt_dlp.YoutubeDL in-process when the module is
+                             importable and falls back to the subprocess path.
+    IG_WORKER_CACHE_DIR      Directory for worker caches (default:
+                             storage/framework/cache/ig-worker in the Laravel
+                             app, else ig-worker-cache in the temp directory).
+                             When it cannot be created the worker runs without
+                             its on-disk caches.
+    IG_WORKER_YTDLP_CACHE_TTL
+                             Seconds a cached yt-dlp command/version stays
+                             valid (default 86400). The entry is also dropped
+                             when the resolved file's mtime changes, or when
+                             --refresh-ytdlp is passed.
+    IG_WORKER_HTTP_POOL_SIZE Keep-alive connections kept per host in each
+                             shared HTTP session (default 10).
+    IG_WORKER_HTTP_RETRIES   Retries for connection errors and 5xx responses
+                             on page requests (default 2); media downloads use
+                             IG_WORKER_DOWNLOAD_RETRIES instead.
+    IG_WORKER_HTTP_BACKOFF   Retry backoff factor in seconds (default 0.5).
+    IG_WORKER_HTTP_SESSIONS  Pooled HTTP sessions kept at once, one per cookie
+                             identity; the least recently used is closed
+                             beyond it (default 32).
+    IG_WORKER_CAROUSEL_CONCURRENCY
+                             Carousel images downloaded at once (default 4).
+    IG_WORKER_PER_HOST_LIMIT Concurrent downloads allowed per CDN host across
+                             the whole process (default 4).
+    IG_WORKER_MAX_DOWNLOAD_BYTES
+                             Largest single media file the worker will write
+                             (default 500 MiB, 0 disables the check).
+    IG_WORKER_DOWNLOAD_RETRIES
+                             Retries for a media download that drops, comes up
+                             short or gets a 5xx/429 answer (default 3). Each
+                             retry resumes the .part file with a Range request;
+                             after the last one the .part file stays for the
+                             next cookie attempt of the same job to resume.
+    IG_WORKER_DOWNLOAD_BACKOFF
+                             Seconds before the first download retry, doubled
+                             for each one after it (default 1).
+    IG_WORKER_MEDIA_CACHE    1 (default) keeps downloaded media per shortcode
+                             and serves repeat requests by hardlinking it into
+                             the new download folder; 0 disables it.
+    IG_WORKER_MEDIA_CACHE_MAX_BYTES
+                             Total size of the media cache before least
+                             recently used posts are evicted (default 2 GiB).
+    IG_WORKER_MEDIA_CACHE_TTL
+                             Seconds a cached post is served (default 21600).
+    IG_WORKER_MEDIA_CACHE_EVICT_INTERVAL
+                             Seconds between sweeps of the media cache for
+                             expired and over-cap entries (default 60); a
+                             store that pushes the known size over the cap
+                             sweeps at once.
+    IG_WORKER_META_CACHE_TTL Seconds parsed post metadata (username, caption,
+                             media URLs) is reused (default 300). Entries never
+                             outlive the oe= expiry signed into their CDN URLs.
+    IG_WORKER_SINGLE_FLIGHT_TIMEOUT
+                             Seconds a job waits for a concurrent job on the
+                             same shortcode before fetching anyway (default 300).
+    IG_WORKER_COOKIE_COOLDOWN
+                             Seconds a cookie is benched after a login/cookie
+                             failure (default 1800).
+    IG_WORKER_RATE_LIMIT_COOLDOWN
+                             Seconds a cookie is benched after being
+                             rate-limited (default 600).
+    IG_WORKER_HEDGE          1 enables hedged cookie attempts: when the first
+                             attempt has no metadata after
+                             IG_WORKER_HEDGE_AFTER seconds (default 10, set
+                             it near your p95), the next cookie starts in
+                             parallel and the first success wins.
+    IG_WORKER_HOST_OVERRIDES Comma-separated host=address pairs; HTTP requests
+                             to a listed host are sent over plain http to the
+                             address instead, with the original Host header
+                             (used by the offline benchmarks).
+    IG_WORKER_METRICS_FILE   Default for --metrics-file.
+    IG_WORKER_THUMBNAILS     auto (default), always or never. "auto" has yt-dlp
+                             write and convert a local video thumbnail only
+                             when the metadata carries no remote thumbnail
+                             URL; items then have an empty "thumbnail_file"
+                             and one can be made on demand (see below).
+    IG_WORKER_PROGRESSIVE_TOLERANCE
+                             Percent of resolution a pre-muxed video format may
+                             lose against the best separate video stream and
+                             still be picked, avoiding the audio download and
+                             ffmpeg merge (default 35; 0 takes whichever is
+                             best).
+    IG_WORKER_MAX_RESOLUTION Cap on the shorter side of downloaded video
+                             (e.g. 720; default 0, no cap).
+    IG_WORKER_TIER_MAX_RESOLUTION
+                             Per-tier caps as name=resolution pairs, e.g.
+                             "free=720,pro=1080"; a job's "tier" (or --tier)
+                             selects one.
+    IG_WORKER_ENGINE         Default for --engine: threads (default) or async.
+    IG_WORKER_ASYNC_CONCURRENCY
+                             Jobs the async engine runs at once (default 64;
+                             --parallel overrides it in batch mode).
+    IG_WORKER_PER_COOKIE_LIMIT
+                             Attempts the async engine runs on one cookie
+                             file at a time (default 2).
+
 Usage:
-    python instagram_fetch.py <instagram_url> <download_path> <cookies_json> [yt_dlp_path]
+    python instagram_fetch.py [--refresh-ytdlp] [--preview] [--timings] [--tier <name>] [--quality <target>] <instagram_url> <download_path> <cookies_json> [yt_dlp_path]
+    python instagram_fetch.py --serve [--socket <socket_path>] [--metrics-port <port>] [--engine threads|async] [--refresh-ytdlp] [yt_dlp_path]
+    python instagram_fetch.py --thumbnail <video_path> [thumbnail_url]
+    python instagram_fetch.py --batch <jobs_file|-> [--parallel N] [--cookies <cookies_json>] [--engine threads|async] [yt_dlp_path]
+
+Serve mode keeps one worker resident and reads one JSON job per line, either
+from stdin or from clients of a Unix socket:
+    {"url": "...", "download_path": "...", "cookies": ["/path/a.txt"], "yt_dlp_path": ""}
+Each job is answered with one line holding the same JSON envelope the one-shot
+mode prints. A job's "id", if given, is echoed back in its envelope.
+
+Batch mode runs the same job lines from a file (or stdin with "-") and exits,
+N jobs at a time (default 4), printing results in input order. Jobs without
+"cookies" use the --cookies list.
+
+--engine async runs serve and batch jobs as asyncio tasks on one event loop
+instead of one thread per job: yt-dlp via asyncio subprocesses, HTTP via
+httpx when installed (worker threads otherwise), under a global job limit
+plus per-host and per-cookie limits. Jobs on one socket connection may be
+pipelined; answers still come back in request order.
+
+--thumbnail (or {"op": "thumbnail", "path": "<video file>", "thumbnail": "<url>"}
+as a job) writes <video stem>.jpg next to a downloaded video on demand, from
+the remote thumbnail URL if given, else from the first frame via ffmpeg, and
+answers with {"success": true, "thumbnail_file": "..."}.
+
+Video items carry "merged": true when yt-dlp had to mux separate video and
+audio streams (null when it could not be known up front).
+
+Items list every size the post offers in "variants" (url, width, height and,
+for videos, bitrate), with the downloaded one marked "selected"; "quality"
+names that size (e.g. "720p", "1080px"). --quality (or "quality" in a job)
+asks for less than the original: the smallest variant reaching the target is
+downloaded. "720p" targets videos by their shorter side, "640px" images by
+width; one target applies to both unless both are given ("720p,640px").
+Cached media and metadata are kept per target.
+
+--preview (or "preview": true in a job) returns post metadata and remote media
+URLs without downloading anything.
+
+--timings (or "timings": true in a job) adds a "timings" object to the
+envelope: milliseconds per stage, per cookie attempt, and bytes/throughput
+for every media download.
+
+Metrics (fetches by type and outcome, error types, cookie attempts, bytes
+downloaded, cache hits and stage latencies) are exported in the Prometheus
+text format when enabled:
+    --metrics-port <port>   serve mode: GET http://127.0.0.1:<port>/metrics
+    --metrics-file <path>   any mode: rewrite <path> after every job for the
+                            node_exporter textfile collector; one-shot runs
+                            merge into shared state kept in <path>.state.json
 """
 
 import sys
@@ -17,14 +166,35 @@ import json
 import subprocess
 import re
 import shutil
+import tempfile
 import hashlib
 import time
+import threading
+import socketserver
+import traceback
+import importlib.util
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import contextvars
+import queue
+import asyncio
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 from urllib.parse import urlparse
 
+# fcntl (POSIX only) backs the cross-process file locks
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 # Try to import requests, fall back to urllib if not available
 try:
     import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
     HAS_REQUESTS = True
 except ImportError:
     import urllib.request
@@ -32,9 +202,16 @@ except ImportError:
     import http.cookiejar
     HAS_REQUESTS = False
 
+# Optional async HTTP client for --engine async; threads are used without it
+try:
+    import httpx
+    HAS_HTTPX = True
+except ImportError:
+    HAS_HTTPX = False
 
-def log_error(message, error_type="unknown", cookies_tried=0, debug_info=None):
-    """Output error as JSON and exit."""
+
+def error_envelope(message, error_type="unknown", cookies_tried=0, debug_info=None):
+    """Build the JSON error envelope returned to the PHP side."""
     output = {
         "success": False,
         "error": str(message)[:500],
@@ -43,7 +220,12 @@ def log_error(message, error_type="unknown", cookies_tried=0, debug_info=None):
     }
     if debug_info:
         output["debug"] = debug_info
-    print(json.dumps(output))
+    return output
+
+
+def log_error(message, error_type="unknown", cookies_tried=0, debug_info=None):
+    """Output error as JSON and exit."""
+    print(json.dumps(error_envelope(message, error_type, cookies_tried, debug_info)))
     sys.exit(1)
 
 
@@ -53,19 +235,424 @@ def log_debug(message):
     sys.stderr.flush()
 
 
+# Set per hedged attempt (see fetch_with_cookies_hedged); None otherwise
+ATTEMPT_CANCEL = contextvars.ContextVar('attempt_cancel', default=None)
+ATTEMPT_METADATA = contextvars.ContextVar('attempt_metadata', default=None)
+
+
+class AttemptCancelled(Exception):
+    """Raised inside an attempt that lost a hedged race."""
+
+
+def check_cancelled():
+    """Abort the current attempt if it has been cancelled."""
+    cancel = ATTEMPT_CANCEL.get()
+    if cancel is not None and cancel.is_set():
+        raise AttemptCancelled("Attempt cancelled")
+
+
+class TimingRecorder:
+    """
+    Collects the optional "timings" object for one job.
+    Stages outside a cookie attempt are job-level; the rest belong to the
+    attempt that is current in the context (see timing_attempt).
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.attempts = []
+        self.downloads = []
+        self.lock = threading.Lock()
+
+    def add_stage(self, attempt, stage, seconds):
+        stages = attempt['stages'] if attempt is not None else self.stages
+        with self.lock:
+            stages[stage] = round(stages.get(stage, 0) + seconds * 1000, 1)
+
+    def as_dict(self):
+        with self.lock:
+            timings = {
+                'total_ms': round((time.perf_counter() - self.started) * 1000, 1),
+                'stages': dict(self.stages),
+                'attempts': [dict(attempt) for attempt in self.attempts],
+            }
+            if self.downloads:
+                timings['downloads'] = list(self.downloads)
+            return timings
+
+
+# Set while a job runs with timings enabled; None otherwise
+TIMINGS = contextvars.ContextVar('timings', default=None)
+TIMING_ATTEMPT = contextvars.ContextVar('timing_attempt', default=None)
+
+
+@contextmanager
+def collect_timings(enabled):
+    """Record timings for the job run inside the block. Yields the recorder or None."""
+    if not enabled:
+        yield None
+        return
+    recorder = TimingRecorder()
+    token = TIMINGS.set(recorder)
+    try:
+        yield recorder
+    finally:
+        TIMINGS.reset(token)
+
+
+@contextmanager
+def timed(stage):
+    """Add the time spent in the block to stage in the job timings and metrics."""
+    recorder = TIMINGS.get()
+    if recorder is None and not METRICS.enabled:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        if recorder is not None:
+            recorder.add_stage(TIMING_ATTEMPT.get(), stage, elapsed)
+        METRICS.observe('ig_worker_stage_seconds', elapsed, stage=stage)
+
+
+@contextmanager
+def timing_attempt(cookie_path):
+    """Group the stages timed inside the block under one cookie attempt."""
+    recorder = TIMINGS.get()
+    if recorder is None:
+        yield None
+        return
+    attempt = {'cookie': os.path.basename(cookie_path), 'ms': 0, 'stages': {}, 'downloads': []}
+    with recorder.lock:
+        recorder.attempts.append(attempt)
+    token = TIMING_ATTEMPT.set(attempt)
+    started = time.perf_counter()
+    try:
+        yield attempt
+    finally:
+        attempt['ms'] = round((time.perf_counter() - started) * 1000, 1)
+        TIMING_ATTEMPT.reset(token)
+
+
+def record_download_timing(url, size, seconds):
+    """Note one finished media download on the current attempt."""
+    recorder = TIMINGS.get()
+    if recorder is None:
+        return
+    entry = {
+        'host': urlparse(url).netloc,
+        'bytes': size,
+        'ms': round(seconds * 1000, 1),
+        'kbps': round(size / 1024 / seconds) if seconds > 0 else None,
+    }
+    attempt = TIMING_ATTEMPT.get()
+    with recorder.lock:
+        (attempt['downloads'] if attempt is not None else recorder.downloads).append(entry)
+
+
+# name: (type, help, histogram buckets)
+METRIC_DEFINITIONS = {
+    'ig_worker_fetches_total': ('counter', 'Jobs answered, by content type and outcome.', None),
+    'ig_worker_errors_total': ('counter', 'Failed jobs, by error type.', None),
+    'ig_worker_request_seconds': ('histogram', 'Job duration in seconds.',
+                                  (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)),
+    'ig_worker_cookie_attempts': ('histogram', 'Cookie attempts per job that reached Instagram.',
+                                  (0, 1, 2, 3, 5, 8)),
+    'ig_worker_downloaded_bytes_total': ('counter', 'Media bytes downloaded, by downloader.', None),
+    'ig_worker_cache_requests_total': ('counter', 'Cache lookups, by cache and result.', None),
+    'ig_worker_stage_seconds': ('histogram', 'Time spent per stage in seconds.',
+                                (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)),
+}
+
+
+def escape_label_value(value):
+    """Escape a label value for the Prometheus text format."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    """
+    In-process counters and histograms, rendered in the Prometheus text format.
+    Samples are keyed by "name\tlabels" so the whole state is JSON-serialisable,
+    which is what lets one-shot processes merge into a shared textfile.
+    Nothing is recorded until enabled is set (--metrics-port / --metrics-file).
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.flushed = {'counters': {}, 'histograms': {}}
+
+    @staticmethod
+    def key(name, labels):
+        label_text = ','.join(f'{k}="{escape_label_value(v)}"' for k, v in sorted(labels.items()))
+        return f"{name}\t{label_text}"
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        buckets = METRIC_DEFINITIONS[name][2]
+        key = self.key(name, labels)
+        with self.lock:
+            # [per-bucket counts..., sum, count]
+            series = self.histograms.setdefault(key, [0] * (len(buckets) + 2))
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': {key: list(series) for key, series in self.histograms.items()},
+            }
+
+    def take_delta(self):
+        """What changed since the last take_delta(), for merging into shared state."""
+        current = self.snapshot()
+        delta = merge_metric_states(current, self.flushed, sign=-1)
+        self.flushed = current
+        return delta
+
+
+def merge_metric_states(base, other, sign=1):
+    """base + sign * other, for states produced by Metrics.snapshot()."""
+    merged = {
+        'counters': dict(base.get('counters') or {}),
+        'histograms': {key: list(series) for key, series in (base.get('histograms') or {}).items()},
+    }
+    for key, value in (other.get('counters') or {}).items():
+        merged['counters'][key] = merged['counters'].get(key, 0) + sign * value
+    for key, series in (other.get('histograms') or {}).items():
+        target = merged['histograms'].setdefault(key, [0] * len(series))
+        for i, value in enumerate(series):
+            target[i] += sign * value
+    return merged
+
+
+def render_metrics(state):
+    """Prometheus text exposition of a Metrics.snapshot() state."""
+    samples = {}
+    for key, value in sorted((state.get('counters') or {}).items()):
+        name, labels = key.split('\t', 1)
+        samples.setdefault(name, []).append(f"{name}{{{labels}}} {value:g}" if labels else f"{name} {value:g}")
+    for key, series in sorted((state.get('histograms') or {}).items()):
+        name, labels = key.split('\t', 1)
+        buckets = METRIC_DEFINITIONS[name][2]
+        prefix = labels + ',' if labels else ''
+        lines = samples.setdefault(name, [])
+        cumulative = 0
+        for bound, count in zip(buckets, series):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{prefix}le="{bound:g}"}} {cumulative:g}')
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {series[-1]:g}')
+        lines.append(f"{name}_sum{{{labels}}} {series[-2]:g}" if labels else f"{name}_sum {series[-2]:g}")
+        lines.append(f"{name}_count{{{labels}}} {series[-1]:g}" if labels else f"{name}_count {series[-1]:g}")
+
+    output = []
+    for name, (metric_type, help_text, _) in METRIC_DEFINITIONS.items():
+        if name in samples:
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {metric_type}")
+            output.extend(samples[name])
+    return '\n'.join(output) + '\n'
+
+
+METRICS = Metrics()
+
+
+def observe_job(response, seconds):
+    """Record one answered job in METRICS."""
+    if not METRICS.enabled:
+        return
+    outcome = 'success' if response.get('success') else 'error'
+    METRICS.inc('ig_worker_fetches_total', content_type=response.get('type') or 'none', outcome=outcome)
+    METRICS.observe('ig_worker_request_seconds', seconds, outcome=outcome)
+    if not response.get('success'):
+        METRICS.inc('ig_worker_errors_total', error_type=response.get('error_type') or 'unknown')
+    if 'cookies_tried' in response:
+        METRICS.observe('ig_worker_cookie_attempts', response['cookies_tried'])
+    if response.get('success') and not response.get('preview') and media_cache_enabled():
+        METRICS.inc('ig_worker_cache_requests_total', cache='media',
+                    result='hit' if response.get('cache') == 'hit' else 'miss')
+
+
+def flush_metrics_file(metrics_path):
+    """
+    Merge what this process recorded since the last flush into the shared
+    state next to metrics_path and rewrite metrics_path (textfile collector
+    format). Serialised by an flock, so one-shot processes can share a file.
+    """
+    delta = METRICS.take_delta()
+    state_path = metrics_path + '.state.json'
+    with open(metrics_path + '.lock', 'w') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            state = merge_metric_states(read_json_file(state_path) or {}, delta)
+            write_json_file(state_path, state)
+            tmp_path = f"{metrics_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(render_metrics(state))
+            os.replace(tmp_path, metrics_path)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """GET /metrics returns METRICS in the Prometheus text format."""
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render_metrics(METRICS.snapshot()).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port):
+    """Serve /metrics on 127.0.0.1:port from a background thread."""
+    server = ThreadingHTTPServer(('127.0.0.1', int(port)), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log_debug(f"Serving metrics on http://127.0.0.1:{server.server_address[1]}/metrics")
+    return server
+
+
+def mark_metadata_ready():
+    """Tell the hedging scheduler that this attempt has the post metadata."""
+    ready = ATTEMPT_METADATA.get()
+    if ready is not None:
+        ready.set()
+
+
+def keyword_pattern(keywords):
+    """
+    Compile a lower-case keyword list into one alternation.
+    Search lower-cased text with it: that is several times faster than
+    re.IGNORECASE on an alternation.
+    """
+    return re.compile('|'.join(re.escape(keyword) for keyword in keywords))
+
+
+# Patterns used on every request, compiled once at import
+URL_PATTERN = re.compile(
+    r'^https?://(?:www\.)?instagram\.com/(?:(?:p|reels?|tv)/[\w-]+|stories/[\w.]+/\d+)/?',
+    re.IGNORECASE
+)
+SHORTCODE_PATTERN = re.compile(r'/(?:p|reels?|tv)/([^/?]+)|/stories/[^/]+/(\d+)')
+STORY_USER_PATTERN = re.compile(r'/stories/([^/]+)/')
+URL_KIND_PATTERN = re.compile(r'/(reels?|stories|tv)/', re.IGNORECASE)
+
+
 def validate_url(url):
     """Validate Instagram URL format."""
-    patterns = [
-        r'^https?://(www\.)?instagram\.com/p/[\w-]+/?',
-        r'^https?://(www\.)?instagram\.com/reel/[\w-]+/?',
-        r'^https?://(www\.)?instagram\.com/reels/[\w-]+/?',
-        r'^https?://(www\.)?instagram\.com/tv/[\w-]+/?',
-        r'^https?://(www\.)?instagram\.com/stories/[\w.]+/\d+/?',
-    ]
-    for pattern in patterns:
-        if re.match(pattern, url, re.IGNORECASE):
-            return True
-    return False
+    if not url or 'nstagram.' not in url.lower():
+        return False
+    return URL_PATTERN.match(url) is not None
+
+
+def url_kind(url):
+    """'reel', 'story', 'tv' or 'post', from the URL path alone."""
+    match = URL_KIND_PATTERN.search(url)
+    if not match:
+        return 'post'
+    kind = match.group(1).lower()
+    if kind.startswith('reel'):
+        return 'reel'
+    return 'story' if kind == 'stories' else kind
+
+
+def is_video_url(url):
+    """Reels and IGTV URLs are expected to carry a video."""
+    return url_kind(url) in ('reel', 'tv')
+
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def env_int(name, default):
+    """Read an integer setting from the environment."""
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def env_float(name, default):
+    """Read a float setting from the environment."""
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def default_cache_dir():
+    """Laravel's storage/framework/cache when the worker sits in the app, else the temp directory."""
+    storage_dir = os.path.join(os.path.dirname(SCRIPT_DIR), 'storage')
+    if os.path.isdir(storage_dir):
+        return os.path.join(storage_dir, 'framework', 'cache', 'ig-worker')
+    return os.path.join(tempfile.gettempdir(), 'ig-worker-cache')
+
+
+def get_cache_dir(*parts):
+    """
+    Return (and create) a directory under the worker cache dir, or None when
+    it cannot be created; callers then carry on without that cache.
+    """
+    base = os.environ.get('IG_WORKER_CACHE_DIR') or default_cache_dir()
+    path = os.path.join(base, *parts)
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError as e:
+        log_debug(f"Cache directory {path} unavailable, running without it: {e}")
+        return None
+    return path
+
+
+def read_json_file(path):
+    """Read a JSON cache file. Returns None if missing or corrupt."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json_file(path, data):
+    """Write a JSON cache file atomically (temp file + rename)."""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        log_debug(f"Could not write cache file {path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
 def get_env():
@@ -181,6 +768,8 @@ def run_ytdlp(ytdlp_cmd, args, timeout=120):
     log_debug(f"Running: {' '.join(full_cmd[:5])}...")
     
     try:
+        if ATTEMPT_CANCEL.get() is not None:
+            return run_cancellable(full_cmd, timeout)
         result = subprocess.run(
             full_cmd,
             capture_output=True,
@@ -191,131 +780,1046 @@ def run_ytdlp(ytdlp_cmd, args, timeout=120):
         return result.returncode, result.stdout, result.stderr
     except subprocess.TimeoutExpired:
         return -2, '', 'Request timed out'
+    except AttemptCancelled:
+        return -6, '', 'Attempt cancelled'
     except FileNotFoundError as e:
         return -3, '', f'Command not found: {str(e)}'
     except Exception as e:
         return -5, '', f'Unexpected error: {str(e)}'
 
 
-def parse_netscape_cookies(cookie_file):
-    """Parse Netscape format cookie file and return cookies dict for requests."""
-    cookies = {}
+def run_cancellable(full_cmd, timeout):
+    """subprocess.run() equivalent that kills the process if the attempt is cancelled."""
+    deadline = time.time() + timeout
+    process = subprocess.Popen(
+        full_cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        env=get_env()
+    )
+    while True:
+        try:
+            stdout, stderr = process.communicate(timeout=0.2)
+            return process.returncode, stdout, stderr
+        except subprocess.TimeoutExpired:
+            cancel = ATTEMPT_CANCEL.get()
+            if time.time() >= deadline or cancel.is_set():
+                process.kill()
+                process.communicate()
+                if cancel.is_set():
+                    raise AttemptCancelled("Attempt cancelled")
+                raise
+
+
+YTDLP_MODULE = None
+
+
+def load_ytdlp_module():
+    """Import yt_dlp for in-process use. Returns None if it is not installed."""
+    global YTDLP_MODULE
+    if YTDLP_MODULE is None:
+        try:
+            import yt_dlp
+            YTDLP_MODULE = yt_dlp
+            log_debug(f"yt-dlp module available in-process (version: {yt_dlp.version.__version__})")
+        except Exception as e:
+            log_debug(f"yt-dlp module not importable in-process: {e}")
+            YTDLP_MODULE = False
+    return YTDLP_MODULE or None
+
+
+def use_ytdlp_api():
+    """Decide whether to drive yt-dlp in-process (IG_WORKER_YTDLP_ENGINE)."""
+    engine = os.environ.get('IG_WORKER_YTDLP_ENGINE', 'auto').strip().lower()
+    if engine == 'subprocess':
+        return False
+    if load_ytdlp_module():
+        return True
+    if engine == 'api':
+        log_debug("yt-dlp API engine requested but module is missing, using subprocess")
+    return False
+
+
+class YtdlpLogger:
+    """Route in-process yt-dlp output to the debug log."""
+
+    def debug(self, msg):
+        if not msg.startswith('[debug] '):
+            log_debug(f"yt-dlp: {msg}")
+
+    def info(self, msg):
+        log_debug(f"yt-dlp: {msg}")
+
+    def warning(self, msg):
+        pass
+
+    def error(self, msg):
+        log_debug(f"yt-dlp: {msg}")
+
+
+class YtdlpApiSession:
+    """
+    In-process yt-dlp for one cookie attempt.
+    Extracts the post once and downloads from the same info dict, so the
+    Instagram page and the cookie file are only processed once.
+    """
+
+    def __init__(self, url, download_path, cookies_path):
+        self.url = url
+        self.download_path = download_path
+        self.cookies_path = cookies_path
+        self.info = None
+        self._ydl = None
+
+    @property
+    def ydl(self):
+        """The YoutubeDL instance, built on first use so cached metadata never pays for it."""
+        if self._ydl is None:
+            self._ydl = self.build_ydl()
+        return self._ydl
+
+    def build_ydl(self):
+        yt_dlp = load_ytdlp_module()
+        return yt_dlp.YoutubeDL({
+            'cookiefile': self.cookies_path,
+            'quiet': True,
+            'no_warnings': True,
+            'noprogress': True,
+            'nocheckcertificate': True,
+            'socket_timeout': 30,
+            'extractor_args': {'instagram': {'api_only': ['false']}},
+            'outtmpl': os.path.join(self.download_path, '%(id)s_%(autonumber)s.%(ext)s'),
+            'merge_output_format': 'mp4',
+            'writethumbnail': True,
+            'postprocessors': [{'key': 'FFmpegThumbnailsConvertor', 'format': 'jpg', 'when': 'before_dl'}],
+            'progress_hooks': [lambda status: check_cancelled()],
+            'logger': YtdlpLogger(),
+        })
+
+    def fetch_metadata(self):
+        """Same contract as fetch_metadata(): returns (info_dict, error)."""
+        log_debug(f"Fetching metadata in-process with cookie: {os.path.basename(self.cookies_path)}")
+        try:
+            self.info = self.ydl.extract_info(self.url, download=False)
+        except Exception as e:
+            return None, self.error_text(e)
+
+        if not self.info:
+            return None, "No content found at this URL."
+
+        info = self.ydl.sanitize_info(self.info)
+        if info.get('_type') == 'playlist':
+            entries = [entry for entry in (info.get('entries') or []) if entry]
+        else:
+            entries = [info]
+
+        if not entries:
+            return None, "No content found at this URL."
+
+        main_info = entries[0].copy()
+        if len(entries) > 1:
+            main_info['entries'] = entries
+            main_info['_type'] = 'playlist'
+
+        return main_info, None
+
+    def download(self, write_thumbnail=True, choice=None):
+        """Same contract as download_video_content(): returns (files, error)."""
+        if not self.info:
+            return None, "No metadata extracted before download."
+
+        # Without written thumbnails the jpg convertor has nothing to run on
+        self.ydl.params['writethumbnail'] = write_thumbnail
+        if choice:
+            # Formats are selected again when the extracted info is processed for download
+            self.ydl.params.update(choice.ydl_params())
+
+        Path(self.download_path).mkdir(parents=True, exist_ok=True)
+        log_debug(f"Downloading video in-process to: {self.download_path}")
+        try:
+            self.ydl.process_ie_result(self.info, download=True)
+        except Exception as e:
+            # Check if any files were downloaded despite error
+            media_files = find_downloaded_media(self.download_path, partial=True)
+            if media_files:
+                return media_files, None
+            return None, self.error_text(e)
+
+        media_files = find_downloaded_media(self.download_path)
+        if media_files:
+            return media_files, None
+        return None, "No media files were downloaded."
+
+    @staticmethod
+    def error_text(error):
+        """Error text in the shape the is_*_error classifiers expect."""
+        yt_dlp = load_ytdlp_module()
+        if isinstance(error, yt_dlp.utils.DownloadError):
+            return str(error)
+        # Unexpected crash inside yt-dlp: keep the traceback so it is
+        # classified as an execution error rather than a content error
+        return traceback.format_exc()
+
+
+COOKIE_JARS = {}
+COOKIE_JARS_LOCK = threading.Lock()
+
+# Cookies without which an Instagram cookie file cannot authenticate
+SESSION_COOKIES = ('sessionid', 'csrftoken')
+
+
+class CookieJar:
+    """
+    One parsed Netscape cookie file: the Instagram cookies for requests, the
+    expiry of the session cookies and, when the file is unusable, why.
+    """
+
+    def __init__(self, path, mtime):
+        self.path = path
+        self.mtime = mtime
+        self.cookies = {}
+        self.expires = {}
+        self.error = None
+        self.error_type = None
+
+    def session_expired(self, now=None):
+        """True when sessionid or csrftoken carries an expiry that has passed."""
+        now = now or time.time()
+        return any(0 < self.expires.get(name, 0) <= now for name in SESSION_COOKIES)
+
+
+def read_cookie_jar(cookie_file, mtime):
+    """Parse a Netscape cookie file into a CookieJar."""
+    jar = CookieJar(cookie_file, mtime)
+    cookie_name = os.path.basename(cookie_file)
     try:
+        if os.path.getsize(cookie_file) < 50:
+            jar.error, jar.error_type = f"Cookie file too small: {cookie_name}", "cookie_invalid"
+            return jar
         with open(cookie_file, 'r', encoding='utf-8', errors='ignore') as f:
             for line in f:
                 line = line.strip()
+                # yt-dlp and browsers mark HttpOnly cookies with this prefix
+                if line.startswith('#HttpOnly_'):
+                    line = line[len('#HttpOnly_'):]
                 if not line or line.startswith('#'):
                     continue
                 parts = line.split('\t')
                 if len(parts) >= 7:
                     domain, _, path, secure, expires, name, value = parts[:7]
                     if 'instagram.com' in domain:
-                        cookies[name] = value
-    except Exception as e:
-        log_debug(f"Error parsing cookies: {e}")
-    return cookies
+                        jar.cookies[name] = value
+                        try:
+                            jar.expires[name] = int(float(expires))
+                        except ValueError:
+                            jar.expires[name] = 0
+    except OSError as e:
+        jar.error, jar.error_type = f"Cannot read cookie file: {str(e)}", "cookie_unreadable"
+    return jar
 
 
-def download_image_with_requests(url, save_path, cookies_dict):
-    """Download image using requests library."""
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'Accept': 'image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8',
-        'Accept-Language': 'en-US,en;q=0.9',
-        'Referer': 'https://www.instagram.com/',
-        'Sec-Fetch-Dest': 'image',
-        'Sec-Fetch-Mode': 'no-cors',
-        'Sec-Fetch-Site': 'cross-site',
-    }
-    
-    try:
-        if HAS_REQUESTS:
-            session = requests.Session()
-            session.cookies.update(cookies_dict)
-            response = session.get(url, headers=headers, timeout=30, allow_redirects=True)
-            response.raise_for_status()
-            
-            with open(save_path, 'wb') as f:
-                f.write(response.content)
-            return True
-        else:
-            # Fallback to urllib
-            req = urllib.request.Request(url, headers=headers)
-            
-            # Add cookies to request
-            cookie_header = '; '.join([f'{k}={v}' for k, v in cookies_dict.items()])
-            req.add_header('Cookie', cookie_header)
-            
-            with urllib.request.urlopen(req, timeout=30) as response:
-                with open(save_path, 'wb') as f:
-                    f.write(response.read())
-            return True
-    except Exception as e:
-        log_debug(f"Error downloading image: {e}")
-        return False
+def load_cookie_jar(cookie_file):
+    """
+    Return the parsed CookieJar for a cookie file, parsing it only when its
+    mtime changed since the last call. Missing files and expired sessions come
+    back with error/error_type set so callers can skip them without a request.
+    """
+    mtime = get_file_mtime(cookie_file)
+    if mtime is None:
+        jar = CookieJar(cookie_file, None)
+        jar.error = f"Cookie file not found: {os.path.basename(cookie_file)}"
+        jar.error_type = "cookie_not_found"
+        return jar
 
+    with COOKIE_JARS_LOCK:
+        jar = COOKIE_JARS.get(cookie_file)
+    if jar is None or jar.mtime != mtime:
+        jar = read_cookie_jar(cookie_file, mtime)
+        log_debug(f"Parsed {len(jar.cookies)} cookies from {os.path.basename(cookie_file)}")
+        with COOKIE_JARS_LOCK:
+            COOKIE_JARS[cookie_file] = jar
 
-def get_image_extension(url, content_type=None):
-    """Determine image extension from URL or content type."""
-    url_lower = url.lower()
-    if '.jpg' in url_lower or '.jpeg' in url_lower:
-        return 'jpg'
-    if '.png' in url_lower:
-        return 'png'
-    if '.webp' in url_lower:
-        return 'webp'
-    if '.gif' in url_lower:
-        return 'gif'
-    if content_type:
-        if 'jpeg' in content_type or 'jpg' in content_type:
-            return 'jpg'
-        if 'png' in content_type:
-            return 'png'
-        if 'webp' in content_type:
-            return 'webp'
-        if 'gif' in content_type:
-            return 'gif'
-    return 'jpg'  # Default
+    if jar.error is None and jar.session_expired():
+        return expired_cookie_jar(jar)
+    return jar
 
 
-def extract_shortcode(url):
-    """Extract shortcode from Instagram URL."""
-    patterns = [
-        r'/p/([^/?]+)',
-        r'/reel/([^/?]+)',
-        r'/reels/([^/?]+)',
-        r'/tv/([^/?]+)',
-        r'/stories/[^/]+/(\d+)',
-    ]
-    for pattern in patterns:
-        match = re.search(pattern, url)
-        if match:
-            return match.group(1)
-    return hashlib.md5(url.encode()).hexdigest()[:12]
+def expired_cookie_jar(jar):
+    """Copy of a jar flagged as expired (the cached jar stays as parsed)."""
+    expired = CookieJar(jar.path, jar.mtime)
+    expired.cookies = jar.cookies
+    expired.expires = jar.expires
+    expired.error = f"Cookie session expired: {os.path.basename(jar.path)}"
+    expired.error_type = "cookie_expired"
+    return expired
 
 
-def extract_username_from_url(url):
-    """Extract username from story URL if present."""
-    match = re.search(r'/stories/([^/]+)/', url)
-    if match:
-        return match.group(1)
-    return None
+def parse_netscape_cookies(cookie_file):
+    """Parse Netscape format cookie file and return cookies dict for requests."""
+    return load_cookie_jar(cookie_file).cookies
 
 
-def find_carousel_media(html, shortcode):
+# Least recently used first; capped at IG_WORKER_HTTP_SESSIONS
+HTTP_SESSIONS = OrderedDict()
+HTTP_SESSIONS_LOCK = threading.Lock()
+
+
+def get_http_session(cookies_dict, media=False):
     """
-    Find carousel media items from Instagram HTML.
-    Returns list of image URLs.
+    Return the shared requests session for one cookie identity.
+    Each session keeps a keep-alive pool per host, so the post page and every
+    CDN download for that cookie reuse connections instead of new handshakes.
+    Media downloads get a session of their own without adapter retries:
+    stream_download retries (and resumes) them itself.
+    Rotated cookies would leave sessions behind, so the least recently used
+    one is closed once there are more than IG_WORKER_HTTP_SESSIONS.
     """
-    image_urls = []
-    
-    log_debug(f"Searching for carousel media with shortcode: {shortcode}")
-    
-    # Method 1: Look for edge_sidecar_to_children (carousel indicator)
-    sidecar_pattern = r'"edge_sidecar_to_children"\s*:\s*\{\s*"edges"\s*:\s*\[(.*?)\]\s*\}'
-    sidecar_match = re.search(sidecar_pattern, html, re.DOTALL)
-    
-    if sidecar_match:
+    identity = (hashlib.sha1(json.dumps(sorted(cookies_dict.items())).encode()).hexdigest(), media)
+    with HTTP_SESSIONS_LOCK:
+        session = HTTP_SESSIONS.get(identity)
+        if session is not None:
+            HTTP_SESSIONS.move_to_end(identity)
+            return session
+
+        pool_size = env_int('IG_WORKER_HTTP_POOL_SIZE', 10)
+        if media:
+            retry = 0
+        else:
+            retry = Retry(
+                total=env_int('IG_WORKER_HTTP_RETRIES', 2),
+                backoff_factor=env_float('IG_WORKER_HTTP_BACKOFF', 0.5),
+                status_forcelist=(500, 502, 503, 504),
+                allowed_methods=frozenset(['GET', 'HEAD']),
+                raise_on_status=False,
+            )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.cookies.update(cookies_dict)
+        HTTP_SESSIONS[identity] = session
+
+        while len(HTTP_SESSIONS) > max(1, env_int('IG_WORKER_HTTP_SESSIONS', 32)):
+            _, evicted = HTTP_SESSIONS.popitem(last=False)
+            evicted.close()
+        return session
+
+
+class HttpResponse:
+    """Response wrapper so callers read requests and urllib responses the same way."""
+
+    def __init__(self, raw, status, url, headers):
+        self.raw = raw
+        self.status = status
+        self.url = url
+        self.headers = headers
+
+    @property
+    def text(self):
+        if HAS_REQUESTS:
+            return self.raw.text
+        return self.raw.read().decode('utf-8', errors='ignore')
+
+    def iter_content(self, chunk_size):
+        if HAS_REQUESTS:
+            for chunk in self.raw.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    yield chunk
+            return
+        while True:
+            chunk = self.raw.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+HOST_OVERRIDES = {}
+
+
+def get_host_overrides():
+    """IG_WORKER_HOST_OVERRIDES as {host: address}, parsed once per value."""
+    raw = os.environ.get('IG_WORKER_HOST_OVERRIDES', '')
+    if raw not in HOST_OVERRIDES:
+        overrides = {}
+        for pair in raw.split(','):
+            host, _, address = pair.strip().partition('=')
+            if host and address:
+                overrides[host.lower()] = address
+        HOST_OVERRIDES[raw] = overrides
+    return HOST_OVERRIDES[raw]
+
+
+def apply_host_override(url, headers):
+    """Redirect url to its IG_WORKER_HOST_OVERRIDES address. Returns (url, headers)."""
+    overrides = get_host_overrides()
+    if not overrides:
+        return url, headers
+    parsed = urlparse(url)
+    address = overrides.get((parsed.hostname or '').lower())
+    if not address:
+        return url, headers
+    return parsed._replace(scheme='http', netloc=address).geturl(), dict(headers, Host=parsed.netloc)
+
+
+def http_get(url, cookies_dict, headers, timeout=30, stream=False, raise_for_status=True, media=False):
+    """
+    GET through the shared session for this cookie identity (its media
+    session, without adapter retries, when media is set).
+    Falls back to urllib (no pooling) when requests is not installed.
+    Returns an HttpResponse; raises on network errors, and on HTTP errors
+    when raise_for_status is set.
+    """
+    check_cancelled()
+    url, headers = apply_host_override(url, headers)
+    if HAS_REQUESTS:
+        session = get_http_session(cookies_dict, media)
+        response = session.get(url, headers=headers, timeout=timeout, allow_redirects=True, stream=stream)
+        if raise_for_status:
+            response.raise_for_status()
+        return HttpResponse(response, response.status_code, response.url, response.headers)
+
+    req = urllib.request.Request(url, headers=headers)
+    cookie_header = '; '.join([f'{k}={v}' for k, v in cookies_dict.items()])
+    req.add_header('Cookie', cookie_header)
+    try:
+        response = urllib.request.urlopen(req, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if raise_for_status:
+            raise
+        response = e
+    return HttpResponse(response, response.status, response.geturl(), response.headers)
+
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+CONTENT_RANGE_PATTERN = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+
+class DownloadTooLarge(Exception):
+    """Raised when a download exceeds IG_WORKER_MAX_DOWNLOAD_BYTES."""
+
+
+class DownloadInterrupted(Exception):
+    """Raised when a response ends short of, or does not line up with, the bytes on disk."""
+
+
+class DownloadHttpError(Exception):
+    """Raised for an HTTP error status on a media download."""
+
+    def __init__(self, status, url):
+        super().__init__(f"HTTP {status} for {url[:80]}")
+        self.status = status
+
+
+def retryable_download_error(error):
+    """Whether a failed media download is worth another (resumed) try."""
+    if isinstance(error, DownloadHttpError):
+        return error.status == 429 or error.status >= 500
+    if isinstance(error, (DownloadInterrupted, OSError, http.client.HTTPException)):
+        return True
+    if HAS_REQUESTS and isinstance(error, requests.RequestException):
+        return True
+    return HAS_HTTPX and isinstance(error, httpx.TransportError)
+
+
+def download_retry_delay(retry):
+    """Seconds to wait before the given retry (1-based) of a media download."""
+    return env_float('IG_WORKER_DOWNLOAD_BACKOFF', 1.0) * 2 ** (retry - 1)
+
+
+class PartialDownload:
+    """
+    The .part file of an unfinished download.
+    A small .part.json next to it records the URL path, the server's
+    validator (ETag or Last-Modified) and the full size, so a later try, even
+    with another cookie or a re-signed URL, asks for the rest with a Range
+    request instead of fetching the whole file again.
+    """
+
+    def __init__(self, url, save_path):
+        self.path = save_path + '.part'
+        self.state_path = save_path + '.part.json'
+        self.url_path = urlparse(url).path
+        self.validator = ''
+        self.total = 0
+        self.offset = 0
+        self.transferred = 0
+
+        state = read_json_file(self.state_path)
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if not state or state.get('path') != self.url_path or size > (state.get('total') or size):
+            return
+        self.validator = state.get('validator') or ''
+        self.total = state.get('total') or 0
+        self.offset = size
+
+    def request_headers(self, headers):
+        """Headers for the next request: a Range continuing the .part file, if any."""
+        # Ranges count raw bytes, so keep the body unencoded
+        headers = dict(headers, **{'Accept-Encoding': 'identity'})
+        if self.offset:
+            headers['Range'] = f'bytes={self.offset}-'
+            if self.validator:
+                headers['If-Range'] = self.validator
+        return headers
+
+    def begin(self, url, status, response_headers, max_bytes):
+        """
+        Check a response against the bytes on disk and open the .part file
+        for it: appending for a 206 that continues at our offset, from the
+        start for anything else (the server ignored the Range, or the file
+        changed). Raises DownloadInterrupted when a 206 does not line up.
+        """
+        if status == 416 and self.offset:
+            self.discard()
+            raise DownloadInterrupted(f"Range from byte {self.offset} not satisfiable, starting over")
+        if status >= 400:
+            raise DownloadHttpError(status, url)
+
+        content_length = int(response_headers.get('Content-Length') or 0)
+        if self.offset and status == 206:
+            content_range = response_headers.get('Content-Range') or ''
+            match = CONTENT_RANGE_PATTERN.fullmatch(content_range.strip())
+            start, end = (int(match.group(1)), int(match.group(2))) if match else (-1, -1)
+            total = int(match.group(3)) if match and match.group(3) != '*' else 0
+            if (start != self.offset or (content_length and content_length != end - start + 1)
+                    or (self.total and total and total != self.total)):
+                self.discard()
+                raise DownloadInterrupted(f"Content-Range {content_range!r} does not continue at byte {self.offset}")
+            self.total = total or self.total
+            mode = 'ab'
+            log_debug(f"Resuming download at byte {self.offset}")
+        else:
+            etag = response_headers.get('ETag') or ''
+            self.offset = 0
+            self.total = content_length
+            # Weak ETags are not allowed in If-Range
+            self.validator = etag if etag and not etag.startswith('W/') else response_headers.get('Last-Modified') or ''
+            mode = 'wb'
+
+        if max_bytes and self.total > max_bytes:
+            raise DownloadTooLarge(f"Content-Length {self.total} exceeds limit of {max_bytes} bytes")
+        write_json_file(self.state_path, {'path': self.url_path, 'validator': self.validator, 'total': self.total})
+        return open(self.path, mode)
+
+    def write(self, f, chunk, max_bytes):
+        if max_bytes and self.offset + len(chunk) > max_bytes:
+            raise DownloadTooLarge(f"Download exceeds limit of {max_bytes} bytes")
+        f.write(chunk)
+        self.offset += len(chunk)
+        self.transferred += len(chunk)
+
+    def finish(self):
+        """Raise DownloadInterrupted unless the .part file holds the full size."""
+        if self.total and self.offset != self.total:
+            if self.offset > self.total:
+                self.discard()
+            raise DownloadInterrupted(f"Got {self.offset} of {self.total} bytes")
+
+    def complete(self, save_path):
+        """Rename the finished .part file into place."""
+        os.replace(self.path, save_path)
+        self.remove_state()
+
+    def keep(self):
+        """Leave the .part file for a later try, unless there is nothing in it."""
+        if not self.offset:
+            self.discard()
+
+    def discard(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.remove_state()
+        self.offset = 0
+        self.total = 0
+        self.validator = ''
+
+    def remove_state(self):
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+
+def remove_partial_downloads(download_path):
+    """
+    Delete the .part files (and .part.json) that unfinished downloads left in
+    download_path. Called once the job has its answer, so nothing will resume
+    them and they never end up next to the real media.
+    """
+    try:
+        entries = list(os.scandir(download_path))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.name.endswith(('.part', '.part.json')) and entry.is_file():
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+def download_part(url, partial, cookies_dict, headers, timeout, max_bytes):
+    """One request of stream_download(): fetch what the .part file is missing."""
+    with http_get(url, cookies_dict, partial.request_headers(headers), timeout=timeout, stream=True,
+                  raise_for_status=False, media=True) as response:
+        with partial.begin(url, response.status, response.headers, max_bytes) as f:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                check_cancelled()
+                partial.write(f, chunk, max_bytes)
+    partial.finish()
+
+
+def stream_download(url, save_path, cookies_dict, headers, timeout=60):
+    """
+    Stream url to save_path in large chunks without holding it in memory.
+    Data goes to save_path + '.part' and is renamed into place only when
+    complete, so a failed download never leaves a truncated file behind.
+    Dropped connections, short bodies and 5xx/429 answers are retried
+    (IG_WORKER_DOWNLOAD_RETRIES) with a Range request for the missing bytes;
+    when retries run out the .part file is kept for the next cookie attempt
+    (run_job removes whatever is left once the job is answered).
+    Raises on HTTP/network errors and DownloadTooLarge past the size cap.
+    Returns the number of bytes written.
+    """
+    max_bytes = env_int('IG_WORKER_MAX_DOWNLOAD_BYTES', 500 * 1024 * 1024)
+    retries = max(0, env_int('IG_WORKER_DOWNLOAD_RETRIES', 3))
+    partial = PartialDownload(url, save_path)
+    started = time.perf_counter()
+
+    try:
+        for retry in range(1, retries + 2):
+            try:
+                download_part(url, partial, cookies_dict, headers, timeout, max_bytes)
+                break
+            except Exception as e:
+                if retry > retries or not retryable_download_error(e):
+                    raise
+                delay = download_retry_delay(retry)
+                log_debug(f"Download interrupted at byte {partial.offset} ({e}), retry {retry}/{retries} in {delay:g}s")
+                cancel = ATTEMPT_CANCEL.get()
+                if cancel is not None:
+                    cancel.wait(delay)
+                    check_cancelled()
+                else:
+                    time.sleep(delay)
+
+        partial.complete(save_path)
+        record_download_timing(url, partial.transferred, time.perf_counter() - started)
+        METRICS.inc('ig_worker_downloaded_bytes_total', partial.transferred, downloader='http')
+        return partial.offset
+    except DownloadTooLarge:
+        partial.discard()
+        raise
+    except BaseException:
+        partial.keep()
+        raise
+
+
+IMAGE_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Referer': 'https://www.instagram.com/',
+    'Sec-Fetch-Dest': 'image',
+    'Sec-Fetch-Mode': 'no-cors',
+    'Sec-Fetch-Site': 'cross-site',
+}
+
+
+def download_image_with_requests(url, save_path, cookies_dict):
+    """Download image using requests library."""
+    try:
+        stream_download(url, save_path, cookies_dict, IMAGE_HEADERS, timeout=30)
+        return True
+    except AttemptCancelled:
+        raise
+    except Exception as e:
+        log_debug(f"Error downloading image: {e}")
+        return False
+
+
+HOST_SEMAPHORES = {}
+HOST_SEMAPHORES_LOCK = threading.Lock()
+
+
+def get_host_semaphore(url):
+    """Semaphore capping concurrent downloads to one host (IG_WORKER_PER_HOST_LIMIT)."""
+    host = urlparse(url).netloc.lower()
+    with HOST_SEMAPHORES_LOCK:
+        semaphore = HOST_SEMAPHORES.get(host)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(max(1, env_int('IG_WORKER_PER_HOST_LIMIT', 4)))
+            HOST_SEMAPHORES[host] = semaphore
+        return semaphore
+
+
+def download_images_parallel(downloads, cookies_dict):
+    """
+    Download (url, save_path) pairs concurrently with download_image_with_requests.
+    Concurrency is capped by IG_WORKER_CAROUSEL_CONCURRENCY and per host.
+    Returns one success flag per pair, in input order.
+    """
+    def download_one(idx, url, save_path):
+        with get_host_semaphore(url):
+            log_debug(f"Downloading image {idx + 1}: {url[:80]}...")
+            return download_image_with_requests(url, save_path, cookies_dict)
+
+    workers = max(1, min(env_int('IG_WORKER_CAROUSEL_CONCURRENCY', 4), len(downloads)))
+    if workers == 1:
+        return [download_one(idx, url, save_path) for idx, (url, save_path) in enumerate(downloads)]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Run each download in a copy of this context so cancellation reaches it
+        futures = [
+            executor.submit(contextvars.copy_context().run, download_one, idx, url, save_path)
+            for idx, (url, save_path) in enumerate(downloads)
+        ]
+        return [future.result() for future in futures]
+
+
+def get_image_extension(url, content_type=None):
+    """Determine image extension from URL or content type."""
+    url_lower = url.lower()
+    if '.jpg' in url_lower or '.jpeg' in url_lower:
+        return 'jpg'
+    if '.png' in url_lower:
+        return 'png'
+    if '.webp' in url_lower:
+        return 'webp'
+    if '.gif' in url_lower:
+        return 'gif'
+    if content_type:
+        if 'jpeg' in content_type or 'jpg' in content_type:
+            return 'jpg'
+        if 'png' in content_type:
+            return 'png'
+        if 'webp' in content_type:
+            return 'webp'
+        if 'gif' in content_type:
+            return 'gif'
+    return 'jpg'  # Default
+
+
+def extract_shortcode(url):
+    """Extract shortcode from Instagram URL."""
+    if '/' in url:
+        match = SHORTCODE_PATTERN.search(url)
+        if match:
+            return match.group(1) or match.group(2)
+    return hashlib.md5(url.encode()).hexdigest()[:12]
+
+
+def extract_username_from_url(url):
+    """Extract username from story URL if present."""
+    if '/stories/' not in url:
+        return None
+    match = STORY_USER_PATTERN.search(url)
+    if match:
+        return match.group(1)
+    return None
+
+
+# Keys of the JSON payloads Instagram embeds in post pages. They are located
+# with one scan and decoded with a real JSON parser (see scan_media_payloads).
+MEDIA_PAYLOAD_KEYS = (
+    'xdt_api__v1__media__shortcode__web_info',
+    'shortcode_media',
+    'edge_sidecar_to_children',
+    'carousel_media',
+    'video_versions',
+    'image_versions2',
+)
+MEDIA_PAYLOAD_PATTERN = re.compile(r'"(' + '|'.join(MEDIA_PAYLOAD_KEYS) + r')"\s*:\s*')
+JSON_DECODER = json.JSONDecoder()
+
+
+def scan_media_payloads(html):
+    """
+    Walk the page once and decode every embedded media payload.
+    A decoded value is skipped over as a whole, so keys nested inside it are
+    not decoded a second time. Returns {key: [decoded values, in page order]}.
+    """
+    payloads = {}
+    pos = 0
+    while True:
+        match = MEDIA_PAYLOAD_PATTERN.search(html, pos)
+        if not match:
+            break
+        try:
+            value, pos = JSON_DECODER.raw_decode(html, match.end())
+        except ValueError:
+            pos = match.end()
+            continue
+        if isinstance(value, (dict, list)):
+            payloads.setdefault(match.group(1), []).append(value)
+    return payloads
+
+
+def image_candidates(node):
+    """[{'url', 'width', 'height'}] for an API item or GraphQL node, largest first."""
+    candidates = []
+    for candidate in ((node.get('image_versions2') or {}).get('candidates') or []):
+        if candidate.get('url'):
+            candidates.append({'url': candidate['url'], 'width': candidate.get('width'), 'height': candidate.get('height')})
+    for resource in (node.get('display_resources') or []):
+        if resource.get('src'):
+            candidates.append({'url': resource['src'], 'width': resource.get('config_width'), 'height': resource.get('config_height')})
+    if node.get('display_url'):
+        dimensions = node.get('dimensions') or {}
+        candidates.append({'url': node['display_url'], 'width': dimensions.get('width'), 'height': dimensions.get('height')})
+    return sorted(candidates, key=lambda c: -((c['width'] or 0) * (c['height'] or 0)))
+
+
+def video_candidates(node):
+    """[{'url', 'width', 'height', 'bitrate'}] for an API item or GraphQL node, largest first."""
+    candidates = []
+    for version in (node.get('video_versions') or []):
+        if version.get('url'):
+            candidates.append({
+                'url': version['url'],
+                'width': version.get('width'),
+                'height': version.get('height'),
+                'bitrate': version.get('bandwidth'),
+            })
+    if node.get('video_url'):
+        dimensions = node.get('dimensions') or {}
+        candidates.append({
+            'url': node['video_url'],
+            'width': dimensions.get('width'),
+            'height': dimensions.get('height'),
+            'bitrate': None,
+        })
+    return sorted(candidates, key=lambda c: (-((c['width'] or 0) * (c['height'] or 0)), -(c['bitrate'] or 0)))
+
+
+def pick_variant(candidates, minimum, measure):
+    """
+    Smallest of candidates (largest first) whose measure reaches minimum;
+    the largest when minimum is 0 or nothing is big enough.
+    """
+    if not candidates:
+        return None
+    if minimum:
+        for candidate in reversed(candidates):
+            if measure(candidate) >= minimum:
+                return candidate
+    return candidates[0]
+
+
+def image_width(candidate):
+    return candidate.get('width') or 0
+
+
+class MediaItem:
+    """One photo or video of a post, with every size the page offers."""
+
+    def __init__(self, images, videos):
+        self.images = images
+        self.videos = videos
+
+    @property
+    def is_video(self):
+        return bool(self.videos)
+
+    @classmethod
+    def from_node(cls, node):
+        return cls(image_candidates(node), video_candidates(node))
+
+
+class PostMedia:
+    """Typed view of the media embedded in a post page."""
+
+    def __init__(self, items, username=None, caption=None, is_carousel=False):
+        self.items = items
+        self.username = username
+        self.caption = caption
+        self.is_carousel = is_carousel or len(items) > 1
+
+    @property
+    def image_urls(self):
+        return self.image_urls_for(0)
+
+    @property
+    def video_urls(self):
+        return self.video_urls_for(0)
+
+    def image_urls_for(self, min_width):
+        """One image URL per item: the smallest at least min_width wide (0 for the original)."""
+        return [pick_variant(item.images, min_width, image_width)['url'] for item in self.items if item.images]
+
+    def video_urls_for(self, min_resolution):
+        """One video URL per item: the smallest whose shorter side reaches min_resolution."""
+        return [pick_variant(item.videos, min_resolution, format_resolution)['url'] for item in self.items if item.videos]
+
+    @property
+    def image_variants(self):
+        """Every image size per item, aligned with image_urls."""
+        return [item.images for item in self.items if item.images]
+
+    @property
+    def video_variants(self):
+        """Every video version per item, aligned with video_urls."""
+        return [item.videos for item in self.items if item.videos]
+
+    @property
+    def thumbnail(self):
+        return self.image_urls[0] if self.image_urls else None
+
+    @classmethod
+    def from_api_item(cls, item):
+        """xdt_api__v1__media__shortcode__web_info / carousel_media item."""
+        children = item.get('carousel_media') or []
+        items = [MediaItem.from_node(child) for child in children] or [MediaItem.from_node(item)]
+        owner = item.get('user') or item.get('owner') or {}
+        caption = (item.get('caption') or {}).get('text')
+        return cls(items, owner.get('username'), caption, bool(children))
+
+    @classmethod
+    def from_graphql(cls, node):
+        """shortcode_media node."""
+        edges = (node.get('edge_sidecar_to_children') or {}).get('edges') or []
+        items = [MediaItem.from_node(edge.get('node') or {}) for edge in edges] or [MediaItem.from_node(node)]
+        caption_edges = (node.get('edge_media_to_caption') or {}).get('edges') or []
+        caption = (caption_edges[0].get('node') or {}).get('text') if caption_edges else None
+        return cls(items, (node.get('owner') or {}).get('username'), caption, bool(edges))
+
+
+def build_post_media(payloads, shortcode):
+    """
+    Pick the payload describing this shortcode and return a PostMedia (or None).
+    The full post objects are preferred; loose carousel/video/image fragments
+    are used the way the old regex extractors did, first occurrence wins.
+    """
+    for web_info in payloads.get('xdt_api__v1__media__shortcode__web_info', []):
+        items = web_info.get('items') if isinstance(web_info, dict) else None
+        for item in (items or []):
+            if isinstance(item, dict) and item.get('code') in (shortcode, None):
+                return PostMedia.from_api_item(item)
+
+    for node in payloads.get('shortcode_media', []):
+        if isinstance(node, dict) and node.get('shortcode') in (shortcode, None):
+            return PostMedia.from_graphql(node)
+
+    for sidecar in payloads.get('edge_sidecar_to_children', []):
+        if isinstance(sidecar, dict) and sidecar.get('edges'):
+            return PostMedia.from_graphql({'edge_sidecar_to_children': sidecar})
+
+    for children in payloads.get('carousel_media', []):
+        if isinstance(children, list) and children:
+            return PostMedia.from_api_item({'carousel_media': [c for c in children if isinstance(c, dict)]})
+
+    versions = next((v for v in payloads.get('video_versions', []) if isinstance(v, list) and v), None)
+    images = next((v for v in payloads.get('image_versions2', []) if isinstance(v, dict)), None)
+    if versions or images:
+        item = MediaItem.from_node({'video_versions': versions, 'image_versions2': images})
+        if item.images or item.videos:
+            return PostMedia([item])
+    return None
+
+
+class PostPage:
+    """
+    Post page fetched once per cookie attempt.
+    Every extractor reads from the same HTML instead of re-fetching the URL.
+    """
+
+    def __init__(self, url, html, status=None, final_url=None):
+        self.url = url
+        self.html = html
+        self.status = status
+        self.final_url = final_url or url
+        self.post_info = {}
+        self.media = {}
+        self._payloads = None
+
+    @property
+    def payloads(self):
+        """scan_media_payloads(), run on first use."""
+        if self._payloads is None:
+            self._payloads = scan_media_payloads(self.html)
+            log_debug(f"Embedded payloads: {', '.join(f'{k}={len(v)}' for k, v in self._payloads.items()) or 'none'}")
+        return self._payloads
+
+    def get_media(self, shortcode):
+        """build_post_media(), computed once per shortcode."""
+        if shortcode not in self.media:
+            try:
+                self.media[shortcode] = build_post_media(self.payloads, shortcode)
+            except Exception as e:
+                log_debug(f"Error reading embedded media JSON: {e}")
+                self.media[shortcode] = None
+        return self.media[shortcode]
+
+    def get_post_info(self, shortcode):
+        """
+        Post username, caption and thumbnail, computed once per shortcode.
+        The thumbnail is the page's og:image preview, as it always was; the
+        embedded media's first image is only a fallback for pages without one.
+        """
+        if shortcode not in self.post_info:
+            media = self.get_media(shortcode)
+            if media and media.username:
+                self.post_info[shortcode] = {
+                    'username': media.username,
+                    'caption': media.caption,
+                    'thumbnail': og_image_url(self.html) or media.thumbnail,
+                }
+            else:
+                self.post_info[shortcode] = extract_post_info_from_html(self.html, shortcode)
+        return self.post_info[shortcode]
+
+
+PAGE_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Sec-Fetch-Dest': 'document',
+    'Sec-Fetch-Mode': 'navigate',
+    'Sec-Fetch-Site': 'none',
+}
+
+
+def fetch_post_page(url, cookies_dict):
+    """Fetch the post HTML. Returns (PostPage, error)."""
+    try:
+        with timed('page_fetch'), http_get(url, cookies_dict, PAGE_HEADERS, timeout=30, raise_for_status=False) as response:
+            page = PostPage(url, response.text, response.status, response.url)
+    except AttemptCancelled:
+        raise
+    except Exception as e:
+        log_debug(f"Error fetching page: {e}")
+        return None, str(e)
+
+    log_debug(f"Fetched page HTML, length: {len(page.html)}, status: {page.status}, final URL: {page.final_url}")
+    return page, None
+
+
+def find_carousel_media(html, shortcode):
+    """
+    Find carousel media items from Instagram HTML.
+    Returns list of image URLs.
+    """
+    image_urls = []
+    
+    log_debug(f"Searching for carousel media with shortcode: {shortcode}")
+    
+    # Method 1: Look for edge_sidecar_to_children (carousel indicator)
+    sidecar_pattern = r'"edge_sidecar_to_children"\s*:\s*\{\s*"edges"\s*:\s*\[(.*?)\]\s*\}'
+    sidecar_match = re.search(sidecar_pattern, html, re.DOTALL)
+    
+    if sidecar_match:
         log_debug("Found edge_sidecar_to_children (carousel)")
         edges_content = sidecar_match.group(1)
         
@@ -377,6 +1881,15 @@ def find_carousel_media(html, shortcode):
     return image_urls
 
 
+OG_IMAGE_PATTERN = re.compile(r'<meta\s+property=["\']og:image["\']\s+content=["\']([^"\']+)["\']', re.I)
+
+
+def og_image_url(html):
+    """The page's og:image URL, or None."""
+    match = OG_IMAGE_PATTERN.search(html)
+    return match.group(1).replace('&amp;', '&') if match else None
+
+
 def extract_post_info_from_html(html, shortcode):
     """
     Extract post information (username, caption, thumbnail) from HTML.
@@ -467,52 +1980,36 @@ def extract_post_info_from_html(html, shortcode):
             break
     
     # Extract thumbnail from og:image
-    og_image_pattern = r'<meta\s+property=["\']og:image["\']\s+content=["\']([^"\']+)["\']'
-    og_match = re.search(og_image_pattern, html, re.I)
-    if og_match:
-        info['thumbnail'] = og_match.group(1).replace('&amp;', '&')
+    info['thumbnail'] = og_image_url(html)
     
     return info
 
 
-def extract_post_images_from_page(url, cookies_dict, shortcode):
+def extract_post_images_from_page(page, shortcode):
     """
     Extract image URLs specifically for the target post.
     Handles both single images and carousels.
     """
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
-        'Accept-Language': 'en-US,en;q=0.9',
-        'Sec-Fetch-Dest': 'document',
-        'Sec-Fetch-Mode': 'navigate',
-        'Sec-Fetch-Site': 'none',
-    }
-    
     try:
-        if HAS_REQUESTS:
-            session = requests.Session()
-            session.cookies.update(cookies_dict)
-            response = session.get(url, headers=headers, timeout=30)
-            html = response.text
-        else:
-            req = urllib.request.Request(url, headers=headers)
-            cookie_header = '; '.join([f'{k}={v}' for k, v in cookies_dict.items()])
-            req.add_header('Cookie', cookie_header)
-            with urllib.request.urlopen(req, timeout=30) as response:
-                html = response.read().decode('utf-8', errors='ignore')
-        
-        log_debug(f"Fetched page HTML, length: {len(html)}")
+        html = page.html
+
         log_debug(f"Looking for shortcode: {shortcode}")
         
         image_urls = []
         is_carousel = False
         
         # Extract post info (username, caption, thumbnail)
-        post_info = extract_post_info_from_html(html, shortcode)
+        post_info = page.get_post_info(shortcode)
         
+        # Embedded JSON first; the regex methods below are the fallback
+        media = page.get_media(shortcode)
+        if media and media.image_urls:
+            image_urls = media.image_urls_for(current_format_policy().image_width)
+            is_carousel = media.is_carousel
+            log_debug(f"Found {len(image_urls)} image(s) in embedded JSON")
+
         # Check if this is a carousel post
-        if '"edge_sidecar_to_children"' in html or '"carousel_media"' in html or '"GraphSidecar"' in html:
+        elif '"edge_sidecar_to_children"' in html or '"carousel_media"' in html or '"GraphSidecar"' in html:
             is_carousel = True
             log_debug("Detected CAROUSEL post")
             image_urls = find_carousel_media(html, shortcode)
@@ -607,7 +2104,6 @@ def extract_post_images_from_page(url, cookies_dict, shortcode):
         
     except Exception as e:
         log_debug(f"Error extracting images from page: {e}")
-        import traceback
         log_debug(traceback.format_exc())
         return {
             'image_urls': [],
@@ -618,38 +2114,73 @@ def extract_post_images_from_page(url, cookies_dict, shortcode):
         }
 
 
+# Error keyword tables, each compiled into a single alternation
+PHOTO_ONLY_PATTERN = keyword_pattern([
+    'no video formats found',
+    'no video formats',
+    'requested format not available',
+])
+YTDLP_EXECUTION_PATTERN = keyword_pattern([
+    'traceback',
+    'modulenotfounderror',
+    'importerror',
+    'syntaxerror',
+    'nameerror',
+    'typeerror',
+    'attributeerror',
+    'filenotfounderror',
+    '__main__',
+    'frozen runpy',
+    '_run_module_as_main',
+])
+PERMANENT_CONTENT_PATTERN = keyword_pattern([
+    'private',
+    'does not exist',
+    'unavailable',
+    'blocked',
+    'this content isn\'t available',
+    'page not found',
+    'sorry, this page',
+])
+NOT_FOUND_PATTERN = keyword_pattern([
+    'not found',
+    '404',
+    'removed',
+    'deleted',
+    'no longer available',
+])
+COOKIE_ERROR_PATTERN = keyword_pattern([
+    'login required',
+    'login_required',
+    'please log in',
+    'authentication required',
+    'session expired',
+    'invalid session',
+    'cookie',
+    'sessionid',
+])
+RATE_LIMIT_PATTERN = keyword_pattern([
+    'too many requests',
+    'rate limit',
+    'rate-limit',
+    'please wait a few minutes',
+])
+# A bare 429 also turns up in CDN URLs, media ids and byte counts
+RATE_LIMIT_STATUS_PATTERN = re.compile(r'\bhttp(?: error)? 429\b|\bstatus(?:[ _]code)?[ =:]+429\b')
+
+
 def is_photo_only_error(error_text):
     """Check if error indicates a photo post (no video)."""
     if not error_text:
         return False
-    error_lower = error_text.lower()
-    photo_indicators = [
-        'no video formats found',
-        'no video formats',
-        'requested format not available',
-    ]
-    return any(indicator in error_lower for indicator in photo_indicators)
+    return PHOTO_ONLY_PATTERN.search(error_text.lower()) is not None
 
 
 def is_ytdlp_execution_error(error_text):
     """Check if error is a yt-dlp execution/crash error (not content-related)."""
     if not error_text:
         return False
-    error_lower = error_text.lower()
-    execution_indicators = [
-        'traceback',
-        'modulenotfounderror',
-        'importerror',
-        'syntaxerror',
-        'nameerror',
-        'typeerror',
-        'attributeerror',
-        'filenotfounderror',
-        '__main__',
-        'frozen runpy',
-        '_run_module_as_main',
-    ]
-    return any(indicator in error_lower for indicator in execution_indicators)
+    return YTDLP_EXECUTION_PATTERN.search(error_text.lower()) is not None
 
 
 def is_permanent_content_error(error_text):
@@ -661,17 +2192,7 @@ def is_permanent_content_error(error_text):
     if is_ytdlp_execution_error(error_text):
         return False
     
-    error_lower = error_text.lower()
-    permanent_keywords = [
-        'private',
-        'does not exist',
-        'unavailable',
-        'blocked',
-        'this content isn\'t available',
-        'page not found',
-        'sorry, this page',
-    ]
-    return any(keyword in error_lower for keyword in permanent_keywords)
+    return PERMANENT_CONTENT_PATTERN.search(error_text.lower()) is not None
 
 
 def is_not_found_error(error_text):
@@ -683,15 +2204,7 @@ def is_not_found_error(error_text):
     if is_ytdlp_execution_error(error_text):
         return False
     
-    error_lower = error_text.lower()
-    not_found_keywords = [
-        'not found',
-        '404',
-        'removed',
-        'deleted',
-        'no longer available',
-    ]
-    return any(keyword in error_lower for keyword in not_found_keywords)
+    return NOT_FOUND_PATTERN.search(error_text.lower()) is not None
 
 
 def is_cookie_error(error_text):
@@ -703,30 +2216,27 @@ def is_cookie_error(error_text):
     if is_ytdlp_execution_error(error_text):
         return False
     
-    error_lower = error_text.lower()
-    cookie_keywords = [
-        'login required',
-        'login_required',
-        'please log in',
-        'authentication required',
-        'session expired',
-        'invalid session',
-        'cookie',
-        'sessionid',
-    ]
-    return any(keyword in error_lower for keyword in cookie_keywords)
+    return COOKIE_ERROR_PATTERN.search(error_text.lower()) is not None
+
+
+def is_rate_limit_error(error_text):
+    """Check if error indicates Instagram is rate-limiting this cookie."""
+    if not error_text:
+        return False
+    
+    # First, make sure it's NOT a yt-dlp execution error
+    if is_ytdlp_execution_error(error_text):
+        return False
+    
+    lowered = error_text.lower()
+    return RATE_LIMIT_PATTERN.search(lowered) is not None or RATE_LIMIT_STATUS_PATTERN.search(lowered) is not None
 
 
 def get_content_type(url, info_dict=None, is_photo=False, is_carousel=False):
     """Determine content type from URL and metadata."""
-    url_lower = url.lower()
-    
-    if '/reel/' in url_lower or '/reels/' in url_lower:
-        return 'reel'
-    if '/stories/' in url_lower:
-        return 'story'
-    if '/tv/' in url_lower:
-        return 'video'
+    kind = url_kind(url)
+    if kind != 'post':
+        return 'video' if kind == 'tv' else kind
     
     if is_carousel:
         return 'carousel'
@@ -797,11 +2307,17 @@ def extract_username_from_ytdlp(info_dict, url):
     return username
 
 
-def extract_video_url_from_page(html, shortcode):
+def extract_video_url_from_page(page, shortcode):
     """Extract video URL from Instagram page HTML."""
+    html = page.html
     video_urls = []
     
     log_debug(f"Searching for video URL for shortcode: {shortcode}")
+
+    media = page.get_media(shortcode)
+    if media and media.video_urls:
+        log_debug(f"Found {len(media.video_urls)} video URL(s) in embedded JSON")
+        return media.video_urls_for(current_format_policy().video_resolution)
     
     # Method 1: Look for video_url in JSON
     video_url_pattern = r'"video_url"\s*:\s*"([^"]+)"'
@@ -858,9 +2374,9 @@ def extract_video_url_from_page(html, shortcode):
     return video_urls
 
 
-def download_media_with_requests(url, save_path, cookies_dict, is_video=False):
-    """Download media (image or video) using requests library."""
-    headers = {
+def media_headers(is_video):
+    """Request headers for a CDN media download."""
+    return {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
         'Accept': '*/*',
         'Accept-Language': 'en-US,en;q=0.9',
@@ -869,150 +2385,201 @@ def download_media_with_requests(url, save_path, cookies_dict, is_video=False):
         'Sec-Fetch-Mode': 'no-cors',
         'Sec-Fetch-Site': 'cross-site',
     }
-    
+
+
+def download_media_with_requests(url, save_path, cookies_dict, is_video=False):
+    """Download media (image or video) using requests library."""
     try:
-        if HAS_REQUESTS:
-            session = requests.Session()
-            session.cookies.update(cookies_dict)
-            response = session.get(url, headers=headers, timeout=60, allow_redirects=True, stream=True)
-            response.raise_for_status()
-            
-            with open(save_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-            return True
-        else:
-            # Fallback to urllib
-            req = urllib.request.Request(url, headers=headers)
-            
-            # Add cookies to request
-            cookie_header = '; '.join([f'{k}={v}' for k, v in cookies_dict.items()])
-            req.add_header('Cookie', cookie_header)
-            
-            with urllib.request.urlopen(req, timeout=60) as response:
-                with open(save_path, 'wb') as f:
-                    f.write(response.read())
-            return True
+        stream_download(url, save_path, cookies_dict, media_headers(is_video), timeout=60)
+        return True
     except Exception as e:
         log_debug(f"Error downloading media: {e}")
         return False
 
 
-def download_photo_content(url, download_path, cookies_path, info_dict=None):
-    """Download photo/video content from Instagram using direct HTTP."""
-    Path(download_path).mkdir(parents=True, exist_ok=True)
+def extract_post_metadata(page, url, shortcode):
+    """
+    Parse everything the HTTP path needs from the post page into one record:
+    username, caption, thumbnail, content_type and the media URLs.
+    This is the record kept in the metadata cache.
+    """
+    html = page.html
     
-    cookies_dict = parse_netscape_cookies(cookies_path)
-    log_debug(f"Parsed {len(cookies_dict)} cookies from file")
+    # Check if this is a reel/video by looking for video indicators
+    is_reel = url_kind(url) == 'reel'
+    has_video_content = '"video_url"' in html or '"is_video":true' in html or '"video_versions"' in html
     
-    shortcode = extract_shortcode(url)
-    log_debug(f"Extracted shortcode: {shortcode}")
+    # Extract post info
+    post_info = page.get_post_info(shortcode)
     
-    # Fetch the page HTML
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-        'Accept-Language': 'en-US,en;q=0.9',
-    }
+    video_urls = []
+    if is_reel or has_video_content:
+        log_debug("Detected video content, trying to extract video URL...")
+        video_urls = extract_video_url_from_page(page, shortcode)
+        log_debug(f"Found {len(video_urls)} video URL(s)")
     
-    try:
-        if HAS_REQUESTS:
-            session = requests.Session()
-            session.cookies.update(cookies_dict)
-            response = session.get(url, headers=headers, timeout=30)
-            html = response.text
-        else:
-            req = urllib.request.Request(url, headers=headers)
-            cookie_header = '; '.join([f'{k}={v}' for k, v in cookies_dict.items()])
-            req.add_header('Cookie', cookie_header)
-            with urllib.request.urlopen(req, timeout=30) as response:
-                html = response.read().decode('utf-8', errors='ignore')
-        
-        log_debug(f"Fetched page HTML, length: {len(html)}")
-    except Exception as e:
-        log_debug(f"Error fetching page: {e}")
-        return None, f"Failed to fetch Instagram page: {str(e)}", None
+    post_data = extract_post_images_from_page(page, shortcode)
+    is_carousel = post_data.get('is_carousel', False)
     
-    # Check if this is a reel/video by looking for video indicators
-    url_lower = url.lower()
-    is_reel = '/reel/' in url_lower or '/reels/' in url_lower
-    has_video_content = '"video_url"' in html or '"is_video":true' in html or '"video_versions"' in html
+    # Sizes are known only when the URLs came from the embedded media JSON
+    media = page.get_media(shortcode)
+    
+    if video_urls:
+        content_type = get_content_type(url, {'ext': 'mp4'})
+    else:
+        content_type = get_content_type(url, None, is_photo=True, is_carousel=is_carousel)
     
+    return {
+        'username': post_info.get('username', 'instagram_user'),
+        'caption': post_info.get('caption', ''),
+        'thumbnail': post_info.get('thumbnail', ''),
+        'content_type': content_type,
+        'video_urls': video_urls,
+        'image_urls': post_data.get('image_urls', []),
+        'video_variants': media.video_variants if video_urls and media and media.video_urls else [],
+        'image_variants': media.image_variants if media and media.image_urls else [],
+        'is_carousel': is_carousel,
+        'direct': True,
+    }
+
+
+def keep_downloaded_file(save_path, min_bytes):
+    """Path of a finished download, or None (removing it) if missing or under min_bytes."""
+    if os.path.exists(save_path) and os.path.getsize(save_path) > min_bytes:
+        return Path(save_path)
+    log_debug(f"Downloaded file too small or missing: {os.path.basename(save_path)}")
+    if os.path.exists(save_path):
+        os.remove(save_path)
+    return None
+
+
+def plan_image_downloads(meta, shortcode, download_path):
+    """(url, save_path) pairs for the images of a metadata record, at most 10."""
+    image_urls = meta.get('image_urls') or []
+    downloads = []
+    for idx, img_url in enumerate(image_urls[:10]):
+        ext = get_image_extension(img_url)
+        if len(image_urls) == 1:
+            filename = f"{shortcode}.{ext}"
+        else:
+            filename = f"{shortcode}_{idx + 1:02d}.{ext}"
+        downloads.append((img_url, os.path.join(download_path, filename)))
+    return downloads
+
+
+def collect_image_downloads(downloads, results):
+    """Paths of the images that downloaded completely, in item order."""
+    downloaded_files = []
+    for idx, ((img_url, save_path), ok) in enumerate(zip(downloads, results)):
+        if not ok:
+            log_debug(f"Failed to download image {idx + 1}")
+            continue
+        kept = keep_downloaded_file(save_path, 1000)
+        if kept:
+            downloaded_files.append(kept)
+            log_debug(f"Successfully downloaded: {kept.name}")
+    return downloaded_files
+
+
+def download_post_media(meta, shortcode, download_path, cookies_dict):
+    """
+    Download the media listed in a post metadata record.
+    The video is tried first; images are the fallback.
+    Returns (downloaded_files, is_carousel).
+    """
     downloaded_files = []
-    username = None
-    caption = ''
-    thumbnail = ''
     is_carousel = False
     
-    # Extract post info
-    post_info = extract_post_info_from_html(html, shortcode)
-    username = post_info.get('username', 'instagram_user')
-    caption = post_info.get('caption', '')
-    thumbnail = post_info.get('thumbnail', '')
-    
     # If it's a reel or has video content, try to download video first
-    if is_reel or has_video_content:
-        log_debug("Detected video content, trying to extract video URL...")
-        video_urls = extract_video_url_from_page(html, shortcode)
+    video_urls = meta.get('video_urls') or []
+    if video_urls:
+        # Download the first (usually best quality) video
+        video_url = video_urls[0]
+        save_path = os.path.join(download_path, f"{shortcode}.mp4")
         
-        if video_urls:
-            log_debug(f"Found {len(video_urls)} video URL(s)")
-            # Download the first (usually best quality) video
-            video_url = video_urls[0]
-            filename = f"{shortcode}.mp4"
-            save_path = os.path.join(download_path, filename)
-            
-            log_debug(f"Downloading video: {video_url[:80]}...")
-            
-            if download_media_with_requests(video_url, save_path, cookies_dict, is_video=True):
-                if os.path.exists(save_path) and os.path.getsize(save_path) > 10000:
-                    downloaded_files.append(Path(save_path))
-                    log_debug(f"Successfully downloaded video: {filename} ({os.path.getsize(save_path)} bytes)")
-                else:
-                    log_debug(f"Video file too small or missing")
-                    if os.path.exists(save_path):
-                        os.remove(save_path)
+        log_debug(f"Downloading video: {video_url[:80]}...")
+        
+        if download_media_with_requests(video_url, save_path, cookies_dict, is_video=True):
+            kept = keep_downloaded_file(save_path, 10000)
+            if kept:
+                downloaded_files.append(kept)
+                log_debug(f"Successfully downloaded video: {kept.name} ({kept.stat().st_size} bytes)")
     
     # If no video downloaded, try images
     if not downloaded_files:
         log_debug("No video downloaded, trying images...")
-        post_data = extract_post_images_from_page(url, cookies_dict, shortcode)
-        image_urls = post_data.get('image_urls', [])
-        is_carousel = post_data.get('is_carousel', False)
+        is_carousel = meta.get('is_carousel', False)
+        downloads = plan_image_downloads(meta, shortcode, download_path)
         
-        # Update metadata if we got better info
-        if post_data.get('username'):
-            username = post_data['username']
-        if post_data.get('caption'):
-            caption = post_data['caption']
-        if post_data.get('thumbnail'):
-            thumbnail = post_data['thumbnail']
+        if downloads:
+            log_debug(f"Found {len(downloads)} image(s)")
+            # Fetch carousel items concurrently; results come back in item order
+            results = download_images_parallel(downloads, cookies_dict)
+            downloaded_files.extend(collect_image_downloads(downloads, results))
+    
+    return downloaded_files, is_carousel
+
+
+def download_photo_content(url, download_path, cookies_path, info_dict=None, meta=None):
+    """
+    Download photo/video content from Instagram using direct HTTP.
+    meta is the post's metadata record if the caller already has one (from the
+    metadata cache or yt-dlp); without it the post page is fetched and parsed.
+    """
+    Path(download_path).mkdir(parents=True, exist_ok=True)
+    
+    cookies_dict = load_cookie_jar(cookies_path).cookies
+    
+    shortcode = extract_shortcode(url)
+    log_debug(f"Extracted shortcode: {shortcode}")
+    
+    downloaded_files = []
+    is_carousel = False
+    
+    # Fresh cached metadata lets us skip the page fetch and parse entirely
+    if meta:
+        mark_metadata_ready()
+        with timed('media_download'):
+            downloaded_files, is_carousel = download_post_media(meta, shortcode, download_path, cookies_dict)
+        if not downloaded_files:
+            log_debug("Cached media URLs failed, refetching the post page")
+            drop_cached_metadata(shortcode)
+            meta = None
+    
+    if not meta:
+        # Fetch the page HTML once; every extractor below shares it
+        page, fetch_error = fetch_post_page(url, cookies_dict)
+        if fetch_error:
+            return None, f"Failed to fetch Instagram page: {fetch_error}", None
         
-        if image_urls:
-            log_debug(f"Found {len(image_urls)} image(s)")
-            
-            for idx, img_url in enumerate(image_urls[:10]):
-                ext = get_image_extension(img_url)
-                if len(image_urls) == 1:
-                    filename = f"{shortcode}.{ext}"
-                else:
-                    filename = f"{shortcode}_{idx + 1:02d}.{ext}"
-                save_path = os.path.join(download_path, filename)
-                
-                log_debug(f"Downloading image {idx + 1}: {img_url[:80]}...")
-                
-                if download_image_with_requests(img_url, save_path, cookies_dict):
-                    if os.path.exists(save_path) and os.path.getsize(save_path) > 1000:
-                        downloaded_files.append(Path(save_path))
-                        log_debug(f"Successfully downloaded: {filename}")
-                    else:
-                        log_debug(f"Downloaded file too small or missing: {filename}")
-                        if os.path.exists(save_path):
-                            os.remove(save_path)
-                else:
-                    log_debug(f"Failed to download image {idx + 1}")
+        with timed('parse'):
+            meta = extract_post_metadata(page, url, shortcode)
+        mark_metadata_ready()
+        store_cached_metadata(shortcode, meta)
+        with timed('media_download'):
+            downloaded_files, is_carousel = download_post_media(meta, shortcode, download_path, cookies_dict)
     
+    return photo_content_result(downloaded_files, meta, is_carousel, shortcode)
+
+
+def variants_by_filename(meta, shortcode):
+    """
+    {file name: variants} for the files download_post_media writes from meta,
+    with the downloaded variant marked "selected".
+    """
+    names = {}
+    video_urls = meta.get('video_urls') or []
+    video_variants = meta.get('video_variants') or []
+    if video_urls and video_variants:
+        names[f"{shortcode}.mp4"] = [dict(v, selected=v.get('url') == video_urls[0]) for v in video_variants[0]]
+    image_downloads = plan_image_downloads(meta, shortcode, '')
+    for (image_url, save_path), variants in zip(image_downloads, meta.get('image_variants') or []):
+        names[save_path] = [dict(v, selected=v.get('url') == image_url) for v in variants]
+    return names
+
+
+def photo_content_result(downloaded_files, meta, is_carousel, shortcode=None):
+    """The (files, error, extra_info) triple returned by download_photo_content."""
     if not downloaded_files:
         return None, "Could not download any media. The content may be private or unavailable.", None
     
@@ -1020,17 +2587,18 @@ def download_photo_content(url, download_path, cookies_path, info_dict=None):
     has_video = any(f.suffix.lower() == '.mp4' for f in downloaded_files)
     
     return downloaded_files, None, {
-        'username': username,
-        'caption': caption,
-        'thumbnail': thumbnail,
+        'username': meta.get('username'),
+        'caption': meta.get('caption'),
+        'thumbnail': meta.get('thumbnail'),
         'is_carousel': is_carousel and not has_video,
-        'is_video': has_video
+        'is_video': has_video,
+        'variants': variants_by_filename(meta, shortcode) if shortcode else {},
     }
 
 
-def fetch_metadata(url, cookies_path, ytdlp_cmd):
-    """Fetch metadata using yt-dlp --dump-json."""
-    args = [
+def metadata_args(url, cookies_path):
+    """yt-dlp arguments for a --dump-json metadata fetch."""
+    return [
         '--cookies', cookies_path,
         '--dump-json',
         '--no-download',
@@ -1041,9 +2609,16 @@ def fetch_metadata(url, cookies_path, ytdlp_cmd):
         url
     ]
 
+
+def fetch_metadata(url, cookies_path, ytdlp_cmd):
+    """Fetch metadata using yt-dlp --dump-json."""
     log_debug(f"Fetching metadata with cookie: {os.path.basename(cookies_path)}")
-    return_code, stdout, stderr = run_ytdlp(ytdlp_cmd, args, timeout=60)
+    return_code, stdout, stderr = run_ytdlp(ytdlp_cmd, metadata_args(url, cookies_path), timeout=60)
+    return parse_metadata_output(return_code, stdout, stderr)
+
 
+def parse_metadata_output(return_code, stdout, stderr):
+    """Turn yt-dlp --dump-json output into (info_dict, error)."""
     if return_code != 0:
         combined = (stderr + '\n' + stdout).strip()
         return None, combined
@@ -1070,12 +2645,83 @@ def fetch_metadata(url, cookies_path, ytdlp_cmd):
     return main_info, None
 
 
-def download_video_content(url, download_path, cookies_path, ytdlp_cmd, content_type='video'):
+VIDEO_EXTENSIONS = {'.mp4', '.webm', '.mkv'}
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp'}
+
+
+class DownloadIndex:
+    """
+    One listing of a download folder.
+    Files are keyed by stem, which for yt-dlp output is the template's
+    id_autonumber, so a video and the thumbnail written next to it share a
+    key. Images sharing a video's key are thumbnails, not media.
+    """
+
+    def __init__(self, download_path):
+        videos = []
+        images = []
+        try:
+            entries = list(os.scandir(download_path))
+        except FileNotFoundError:
+            entries = []
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            ext = os.path.splitext(entry.name)[1].lower()
+            if ext in VIDEO_EXTENSIONS:
+                videos.append(Path(entry.path))
+            elif ext in IMAGE_EXTENSIONS:
+                images.append(Path(entry.path))
+
+        video_stems = {video.stem for video in videos}
+        self.videos = sorted(videos)
+        self.images = sorted(image for image in images if image.stem not in video_stems)
+        self.thumbnails = {}
+        # Sorted so a converted .jpg thumbnail wins over a leftover .webp
+        for image in sorted(images, key=lambda image: image.suffix.lower() != '.jpg'):
+            if image.stem in video_stems:
+                self.thumbnails.setdefault(image.stem, image)
+
+    def media(self, partial=False):
+        """
+        Media files in the folder. Videos win over images unless partial is set
+        (download ended with an error), in which case any media file counts.
+        """
+        if partial:
+            return sorted(self.videos + self.images)
+        # Maybe it was actually a photo?
+        return list(self.videos or self.images)
+
+    def thumbnail_for(self, file_path):
+        """The thumbnail written next to a video, or None."""
+        return self.thumbnails.get(file_path.stem)
+
+
+def find_downloaded_media(download_path, partial=False):
+    """Find media files yt-dlp left in download_path (see DownloadIndex.media)."""
+    return DownloadIndex(download_path).media(partial)
+
+
+def download_video_content(url, download_path, cookies_path, ytdlp_cmd, content_type='video', write_thumbnail=True,
+                           choice=None):
     """Download video content using yt-dlp."""
     Path(download_path).mkdir(parents=True, exist_ok=True)
-    output_template = os.path.join(download_path, '%(id)s_%(autonumber)s.%(ext)s')
 
-    args = [
+    log_debug(f"Downloading video to: {download_path}")
+    args = video_download_args(url, download_path, cookies_path, write_thumbnail, choice)
+    return_code, stdout, stderr = run_ytdlp(ytdlp_cmd, args, timeout=300)
+    return collect_video_download(return_code, stdout, stderr, download_path)
+
+
+def video_download_args(url, download_path, cookies_path, write_thumbnail=True, choice=None):
+    """
+    yt-dlp arguments for downloading a video (and optionally its thumbnail)
+    into download_path, in the format picked by choice (a FormatChoice).
+    """
+    output_template = os.path.join(download_path, '%(id)s_%(autonumber)s.%(ext)s')
+    thumbnail_args = ['--write-thumbnail', '--convert-thumbnails', 'jpg'] if write_thumbnail else []
+    format_args = choice.cli_args() if choice else []
+    return [
         '--cookies', cookies_path,
         '--no-warnings',
         '--no-check-certificates',
@@ -1083,58 +2729,307 @@ def download_video_content(url, download_path, cookies_path, ytdlp_cmd, content_
         '--socket-timeout', '30',
         '-o', output_template,
         '--merge-output-format', 'mp4',
-        '--write-thumbnail',
-        '--convert-thumbnails', 'jpg',
+        *format_args,
+        *thumbnail_args,
         '--extractor-args', 'instagram:api_only=false',
         url
     ]
 
-    log_debug(f"Downloading video to: {download_path}")
-    return_code, stdout, stderr = run_ytdlp(ytdlp_cmd, args, timeout=300)
+
+class FormatPolicy:
+    """
+    How video formats are chosen for one job.
+    A pre-muxed (progressive) format wins when its resolution is within
+    tolerance percent of the best separate video stream, which saves the
+    second download and the ffmpeg merge. max_resolution caps the shorter
+    side of the frame (720 for 720p, portrait or landscape); 0 means no cap.
+    """
+
+    def __init__(self, tolerance=35.0, max_resolution=0, quality=None):
+        self.tolerance = tolerance
+        self.max_resolution = max_resolution
+        # Requested target: the smallest variant reaching it is downloaded
+        self.video_resolution, self.image_width = parse_quality(quality)
+
+    def cache_suffix(self):
+        """Suffix for cache keys, so posts fetched at other sizes are kept apart."""
+        parts = []
+        if self.video_resolution or self.image_width:
+            parts.append(f"q{self.video_resolution}p{self.image_width}px")
+        if self.max_resolution:
+            parts.append(f"max{self.max_resolution}")
+        return '@' + '-'.join(parts) if parts else ''
+
+    @classmethod
+    def for_tier(cls, tier=None, quality=None):
+        """
+        Policy from IG_WORKER_PROGRESSIVE_TOLERANCE and IG_WORKER_MAX_RESOLUTION,
+        with the cap overridden for named tiers by IG_WORKER_TIER_MAX_RESOLUTION.
+        """
+        max_resolution = env_int('IG_WORKER_MAX_RESOLUTION', 0)
+        if tier:
+            for pair in os.environ.get('IG_WORKER_TIER_MAX_RESOLUTION', '').split(','):
+                name, _, value = pair.strip().partition('=')
+                if name == tier and value.strip().isdigit():
+                    max_resolution = int(value)
+        return cls(max(0.0, env_float('IG_WORKER_PROGRESSIVE_TOLERANCE', 35.0)), max_resolution, quality)
+
+
+QUALITY_PATTERN = re.compile(r'(\d+)\s*(px|p)?$')
+
+
+def parse_quality(quality):
+    """
+    A quality target as (video_resolution, image_width); (0, 0) means originals.
+    "720p" targets videos and "640px" images; a bare number or a single target
+    applies to both. Several targets may be comma-separated ("720p,640px").
+    """
+    video_resolution = image_width = 0
+    bare = 0
+    for part in str(quality or '').lower().split(','):
+        part = part.strip()
+        if not part or part == 'original':
+            continue
+        match = QUALITY_PATTERN.match(part)
+        if not match:
+            log_debug(f"Ignoring unknown quality target: {part}")
+            continue
+        value, unit = int(match.group(1)), match.group(2)
+        if unit == 'p':
+            video_resolution = value
+        elif unit == 'px':
+            image_width = value
+        else:
+            bare = value
+    if bare:
+        return video_resolution or bare, image_width or bare
+    return video_resolution or image_width, image_width or video_resolution
+
+
+# Set for the job being run; None means FormatPolicy.for_tier()
+FORMAT_POLICY = contextvars.ContextVar('format_policy', default=None)
+
+
+@contextmanager
+def job_format_policy(tier=None, quality=None):
+    """Use the format policy of tier, with an optional quality target, for the job run inside the block."""
+    token = FORMAT_POLICY.set(FormatPolicy.for_tier(tier, quality))
+    try:
+        yield
+    finally:
+        FORMAT_POLICY.reset(token)
+
+
+def current_format_policy():
+    return FORMAT_POLICY.get() or FormatPolicy.for_tier()
+
+
+def policy_cache_key(shortcode):
+    """Cache key for shortcode under the current format policy."""
+    return shortcode + current_format_policy().cache_suffix()
+
+
+class FormatChoice:
+    """A yt-dlp format selection and whether it merges streams (None if unknown)."""
+
+    def __init__(self, spec=None, sort=None, merged=None):
+        self.spec = spec
+        self.sort = sort or []
+        self.merged = merged
+
+    def cli_args(self):
+        args = ['-f', self.spec] if self.spec else []
+        if self.sort:
+            args += ['-S', ','.join(self.sort)]
+        return args
+
+    def ydl_params(self):
+        params = {'format': self.spec} if self.spec else {}
+        if self.sort:
+            params['format_sort'] = self.sort
+        return params
+
+
+def format_resolution(fmt):
+    """Shorter side of a format's frame, 0 when unknown."""
+    sides = [side for side in (fmt.get('width'), fmt.get('height')) if side]
+    return min(sides) if sides else 0
+
+
+def select_format(info_dict, policy=None):
+    """
+    Pick the format yt-dlp should download for info_dict under policy.
+    Single videos get an exact format id (or video+audio ids); playlists get a
+    generic selector with the cap as a sort limit, since one -f applies to
+    every entry.
+    """
+    policy = policy or current_format_policy()
+    max_resolution = policy.max_resolution
+    if policy.video_resolution:
+        # The quality target caps at the smallest resolution that reaches it
+        reaching = [
+            format_resolution(f) for f in (info_dict or {}).get('formats') or []
+            if f.get('vcodec') != 'none' and format_resolution(f) >= policy.video_resolution
+        ]
+        target = min(reaching) if reaching else policy.video_resolution
+        max_resolution = min(max_resolution, target) if max_resolution else target
+    sort = [f'res:{max_resolution}'] if max_resolution else []
+    if not info_dict or info_dict.get('entries'):
+        # "b" is the best pre-muxed format; merge only when an entry has none
+        return FormatChoice('b/bv*+ba' if policy.tolerance else None, sort)
+
+    formats = [f for f in info_dict.get('formats') or [] if f.get('format_id')]
+    if not formats:
+        return FormatChoice(None, sort, bool(info_dict.get('requested_formats')))
+
+    capped = [f for f in formats if not max_resolution or format_resolution(f) <= max_resolution]
+    candidates = capped or formats
+    rank = lambda f: (format_resolution(f), f.get('tbr') or 0)
+    best_progressive = max(
+        (f for f in candidates if f.get('vcodec') != 'none' and f.get('acodec') != 'none'), key=rank, default=None
+    )
+    best_video = max(
+        (f for f in candidates if f.get('vcodec') != 'none' and f.get('acodec') == 'none'), key=rank, default=None
+    )
+    best_audio = max(
+        (f for f in formats if f.get('vcodec') == 'none' and f.get('acodec') != 'none'),
+        key=lambda f: f.get('abr') or f.get('tbr') or 0,
+        default=None
+    )
+
+    if best_video and best_audio:
+        floor = format_resolution(best_video) * (1 - policy.tolerance / 100)
+        if best_progressive is None or format_resolution(best_progressive) < floor:
+            return FormatChoice(f"{best_video['format_id']}+{best_audio['format_id']}", merged=True)
+    if best_progressive:
+        return FormatChoice(best_progressive['format_id'], merged=False)
+    return FormatChoice(None, sort, bool(info_dict.get('requested_formats')))
+
+
+def format_variant(fmt, selected_ids=()):
+    """Variant entry for a yt-dlp video format."""
+    return {
+        'format_id': fmt.get('format_id'),
+        'url': fmt.get('url'),
+        'width': fmt.get('width'),
+        'height': fmt.get('height'),
+        'bitrate': fmt.get('tbr'),
+        'has_audio': fmt.get('acodec') != 'none',
+        'selected': fmt.get('format_id') in selected_ids,
+    }
+
+
+def ytdlp_variants(info_dict, choice=None):
+    """{video id: [variant, ...] largest first} for every video in a yt-dlp info dict."""
+    selected_ids = choice.spec.split('+') if choice and choice.spec and choice.merged is not None else ()
+    variants = {}
+    for entry in (info_dict or {}).get('entries') or [info_dict or {}]:
+        formats = [f for f in entry.get('formats') or [] if f.get('format_id') and f.get('vcodec') != 'none']
+        formats.sort(key=lambda f: (format_resolution(f), f.get('tbr') or 0), reverse=True)
+        if entry.get('id') and formats:
+            variants[entry['id']] = [format_variant(f, selected_ids) for f in formats]
+    return variants
+
+
+def quality_label(variant, is_video):
+    """Item "quality": the downloaded size (e.g. 720p, 1080px) when known."""
+    if is_video:
+        resolution = format_resolution(variant) if variant else 0
+        return f"{resolution}p" if resolution else "HD"
+    width = (variant or {}).get('width')
+    return f"{width}px" if width else "Original"
+
+
+def write_thumbnail_file(info_dict):
+    """
+    Whether yt-dlp should write (and convert) a local thumbnail next to the
+    video. IG_WORKER_THUMBNAILS: "auto" (default) only when the metadata has
+    no remote thumbnail URL, "always" or "never". Skipped thumbnails can be
+    made later with the thumbnail op (make_thumbnail).
+    """
+    policy = os.environ.get('IG_WORKER_THUMBNAILS', 'auto')
+    if policy == 'always':
+        return True
+    if policy == 'never':
+        return False
+    return not (info_dict or {}).get('thumbnail')
+
+
+def collect_video_download(return_code, stdout, stderr, download_path):
+    """Turn a finished yt-dlp download into (media_files, error)."""
     combined_output = (stdout + '\n' + stderr).strip()
 
     if return_code != 0:
         # Check if any files were downloaded despite error
-        downloaded_files = list(Path(download_path).glob('*'))
-        media_exts = {'.mp4', '.webm', '.mkv', '.jpg', '.jpeg', '.png', '.webp'}
-        media_files = [f for f in downloaded_files if f.suffix.lower() in media_exts and f.is_file()]
+        media_files = find_downloaded_media(download_path, partial=True)
         if media_files:
-            return sorted(media_files), None
+            return media_files, None
         return None, combined_output
 
-    # Find downloaded files
-    downloaded_files = list(Path(download_path).glob('*'))
-    video_files = [f for f in downloaded_files if f.suffix.lower() in {'.mp4', '.webm', '.mkv'} and f.is_file()]
-    
-    if video_files:
-        return sorted(video_files), None
-    
-    # Maybe it was actually a photo?
-    image_files = [f for f in downloaded_files if f.suffix.lower() in {'.jpg', '.jpeg', '.png', '.webp'} and f.is_file()]
-    if image_files:
-        return sorted(image_files), None
-    
+    media_files = find_downloaded_media(download_path)
+    if media_files:
+        return media_files, None
+
     return None, "No media files were downloaded."
 
 
+def make_thumbnail(video_path, thumbnail_url=''):
+    """
+    Thumbnail op: write <video stem>.jpg next to a downloaded video, from the
+    remote thumbnail URL when one is given, else the first frame via ffmpeg.
+    Returns an envelope with "thumbnail_file".
+    """
+    video = Path(video_path)
+    if video.suffix.lower() not in VIDEO_EXTENSIONS or not video.is_file():
+        return error_envelope("Invalid job: path must be a downloaded video file.", "invalid_job")
+
+    target = video.with_suffix('.jpg')
+    if target.is_file():
+        return {"success": True, "thumbnail_file": str(target)}
+
+    if thumbnail_url:
+        try:
+            stream_download(thumbnail_url, str(target), {}, IMAGE_HEADERS, timeout=30)
+            return {"success": True, "thumbnail_file": str(target)}
+        except Exception as e:
+            log_debug(f"Error downloading thumbnail: {e}")
+
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg:
+        # ffmpeg picks the format from the extension, so stage under .thumb.jpg
+        staging = video.with_suffix('.thumb.jpg')
+        try:
+            result = subprocess.run(
+                [ffmpeg, '-y', '-loglevel', 'error', '-i', str(video), '-frames:v', '1', str(staging)],
+                capture_output=True,
+                text=True,
+                timeout=60
+            )
+            if result.returncode == 0 and staging.is_file():
+                os.replace(staging, target)
+                return {"success": True, "thumbnail_file": str(target)}
+            log_debug(f"ffmpeg thumbnail failed: {result.stderr[:200]}")
+        except subprocess.TimeoutExpired:
+            log_debug("ffmpeg thumbnail timed out")
+        finally:
+            if staging.exists():
+                staging.unlink()
+
+    return error_envelope("Could not create a thumbnail for this video.", "thumbnail_error")
+
+
 def try_download(url, download_path, cookie_path, ytdlp_cmd, cookie_index):
     """Try to fetch and download with a specific cookie file."""
     cookie_name = os.path.basename(cookie_path)
     log_debug(f"Trying cookie #{cookie_index + 1}: {cookie_name}")
 
-    if not os.path.isfile(cookie_path):
-        return None, f"Cookie file not found: {cookie_name}", "cookie_not_found", True
-
-    try:
-        file_size = os.path.getsize(cookie_path)
-        if file_size < 50:
-            return None, f"Cookie file too small: {cookie_name}", "cookie_invalid", True
-    except OSError as e:
-        return None, f"Cannot read cookie file: {str(e)}", "cookie_unreadable", True
+    with timed('cookie_load'):
+        jar = load_cookie_jar(cookie_path)
+    if jar.error:
+        return None, jar.error, jar.error_type, True
 
     # Determine if this is likely a video or photo from URL
-    url_lower = url.lower()
-    is_likely_video = '/reel/' in url_lower or '/reels/' in url_lower or '/tv/' in url_lower
+    is_likely_video = is_video_url(url)
     
     is_photo_post = False
     is_carousel = False
@@ -1143,10 +3038,29 @@ def try_download(url, download_path, cookie_path, ytdlp_cmd, cookie_index):
     ytdlp_failed = False
     ytdlp_error_msg = None
     
+    # In-process yt-dlp when available, subprocess otherwise
+    ytdlp_api = YtdlpApiSession(url, download_path, cookie_path) if is_likely_video and use_ytdlp_api() else None
+
+    # Read the metadata cache once; the direct HTTP fallback reuses the record
+    shortcode = extract_shortcode(url)
+    cached_meta = load_cached_metadata(shortcode)
+    
+    # A cached direct video URL means yt-dlp would download the same file
+    if cached_meta and cached_meta.get('video_urls') and cached_meta.get('direct'):
+        log_debug("Cached metadata has a direct video URL, skipping yt-dlp...")
+        ytdlp_failed = True
     # For reels/videos, try yt-dlp first
-    if is_likely_video:
+    elif is_likely_video:
         log_debug("URL looks like video content, trying yt-dlp first...")
-        info_dict, error_msg = fetch_metadata(url, cookie_path, ytdlp_cmd)
+        with timed('metadata_fetch'):
+            if ytdlp_api:
+                info_dict, error_msg = ytdlp_api.fetch_metadata()
+            else:
+                info_dict, error_msg = fetch_metadata(url, cookie_path, ytdlp_cmd)
+        
+        if info_dict:
+            mark_metadata_ready()
+            cached_meta = cache_ytdlp_metadata(shortcode, info_dict, url) or cached_meta
         
         if error_msg:
             log_debug(f"yt-dlp metadata error: {error_msg[:300]}")
@@ -1168,8 +3082,15 @@ def try_download(url, download_path, cookie_path, ytdlp_cmd, cookie_index):
     
     # If yt-dlp succeeded, try video download
     if not ytdlp_failed and info_dict:
-        log_debug("yt-dlp metadata succeeded, downloading video...")
-        media_files, error_msg = download_video_content(url, download_path, cookie_path, ytdlp_cmd, content_type)
+        choice = select_format(info_dict)
+        log_debug(f"yt-dlp metadata succeeded, downloading video (format {choice.spec or 'default'})...")
+        with timed('ytdlp_download'):
+            if ytdlp_api:
+                media_files, error_msg = ytdlp_api.download(write_thumbnail_file(info_dict), choice)
+            else:
+                media_files, error_msg = download_video_content(
+                    url, download_path, cookie_path, ytdlp_cmd, content_type, write_thumbnail_file(info_dict), choice
+                )
         
         if error_msg:
             log_debug(f"Video download error: {error_msg[:200]}")
@@ -1178,13 +3099,14 @@ def try_download(url, download_path, cookie_path, ytdlp_cmd, cookie_index):
         elif media_files:
             # Success!
             log_debug(f"Video download succeeded: {len(media_files)} files")
+            METRICS.inc('ig_worker_downloaded_bytes_total', sum(f.stat().st_size for f in media_files), downloader='ytdlp')
         else:
             ytdlp_failed = True
     
     # If yt-dlp failed or no files, try direct HTTP download
     if ytdlp_failed or not info_dict:
         log_debug("Trying direct HTTP download...")
-        media_files, error_msg, extra_info = download_photo_content(url, download_path, cookie_path, info_dict)
+        media_files, error_msg, extra_info = download_photo_content(url, download_path, cookie_path, info_dict, cached_meta)
         
         if extra_info:
             is_carousel = extra_info.get('is_carousel', False)
@@ -1193,21 +3115,38 @@ def try_download(url, download_path, cookie_path, ytdlp_cmd, cookie_index):
         if error_msg:
             log_debug(f"Direct HTTP download also failed: {error_msg}")
             # Return the original yt-dlp error if we have one, otherwise the HTTP error
-            final_error = ytdlp_error_msg if ytdlp_error_msg else error_msg
-            
-            # Classify the error
-            if is_permanent_content_error(final_error):
-                return None, "This content is from a private account or is not available.", "private_content", False
-            if is_not_found_error(final_error):
-                return None, "This post was not found or has been removed.", "not_found", False
-            if is_cookie_error(final_error):
-                return None, final_error, "cookie_error", True
-            
-            return None, final_error, "download_error", True
+            return classify_download_error(ytdlp_error_msg if ytdlp_error_msg else error_msg)
+        choice = None
+    
+    return build_download_result(url, download_path, cookie_path, media_files, info_dict, extra_info, choice)
+
+
+def classify_download_error(final_error):
+    """The try_download failure tuple for an error message."""
+    if is_permanent_content_error(final_error):
+        return None, "This content is from a private account or is not available.", "private_content", False
+    if is_not_found_error(final_error):
+        return None, "This post was not found or has been removed.", "not_found", False
+    # Login errors first: benching a cookie as rate-limited would hide them
+    if is_cookie_error(final_error):
+        return None, final_error, "cookie_error", True
+    if is_rate_limit_error(final_error):
+        return None, final_error, "rate_limited", True
     
+    return None, final_error, "download_error", True
+
+
+def build_download_result(url, download_path, cookie_path, media_files, info_dict, extra_info, choice=None):
+    """
+    The try_download success tuple for the downloaded files and whatever
+    metadata we have. choice is the FormatChoice yt-dlp downloaded with, or
+    None when the files came over direct HTTP.
+    """
     if not media_files:
         return None, "No media files downloaded.", "no_media", True
     
+    is_carousel = False
+    
     # Determine content type based on what we downloaded
     has_video = any(f.suffix.lower() in ['.mp4', '.webm', '.mkv'] for f in media_files)
     
@@ -1236,13 +3175,9 @@ def try_download(url, download_path, cookie_path, ytdlp_cmd, cookie_index):
         username = 'instagram_user'
     
     # Determine content type
-    url_lower = url.lower()
-    if '/reel/' in url_lower or '/reels/' in url_lower:
-        content_type = 'reel'
-    elif '/stories/' in url_lower:
-        content_type = 'story'
-    elif '/tv/' in url_lower:
-        content_type = 'video'
+    kind = url_kind(url)
+    if kind != 'post':
+        content_type = 'video' if kind == 'tv' else kind
     elif has_video:
         content_type = 'video'
     elif len(media_files) > 1:
@@ -1252,31 +3187,34 @@ def try_download(url, download_path, cookie_path, ytdlp_cmd, cookie_index):
     else:
         content_type = 'photo'
     
+    # Every size the post offers, per downloaded file
+    variants_by_name = (extra_info or {}).get('variants') or {}
+    format_variants = ytdlp_variants(info_dict, choice) if choice else {}
+    
     items = []
-    for i, file_path in enumerate(media_files):
-        ext = file_path.suffix.lower().lstrip('.')
-        is_video_file = ext in ['mp4', 'webm', 'mkv']
-        
-        # Find thumbnail for videos
-        thumb_path = None
-        if is_video_file:
-            for thumb in Path(download_path).glob('*.jpg'):
-                base_name = file_path.stem.split('_')[0]
-                if base_name in thumb.stem and thumb != file_path:
-                    thumb_path = str(thumb)
-                    break
+    with timed('finalise'):
+        # One listing pairs every video with the thumbnail yt-dlp wrote next to it
+        index = DownloadIndex(download_path) if has_video else None
+        for i, file_path in enumerate(media_files):
+            ext = file_path.suffix.lower().lstrip('.')
+            is_video_file = ext in ['mp4', 'webm', 'mkv']
+            thumb_path = index.thumbnail_for(file_path) if is_video_file else None
+            variants = variants_by_name.get(file_path.name) or format_variants.get(file_path.stem.rsplit('_', 1)[0]) or []
+            selected = next((v for v in variants if v.get('selected')), None)
         
-        item = {
-            "id": i + 1,
-            "type": "video" if is_video_file else "image",
-            "format": ext,
-            "quality": "HD" if is_video_file else "Original",
-            "path": str(file_path),
-            "filename": file_path.name,
-            "thumbnail": thumbnail,
-            "thumbnail_file": thumb_path or ""
-        }
-        items.append(item)
+            item = {
+                "id": i + 1,
+                "type": "video" if is_video_file else "image",
+                "format": ext,
+                "quality": quality_label(selected, is_video_file),
+                "path": str(file_path),
+                "filename": file_path.name,
+                "thumbnail": thumbnail,
+                "thumbnail_file": str(thumb_path) if thumb_path else "",
+                "merged": (choice.merged if choice else False) if is_video_file else False,
+                "variants": variants
+            }
+            items.append(item)
     
     log_debug(f"Download complete: {len(items)} item(s), type={content_type}, user={username}")
     
@@ -1292,118 +3230,1846 @@ def try_download(url, download_path, cookie_path, ytdlp_cmd, cookie_index):
     }, None, None, False
 
 
-def main():
-    if len(sys.argv) < 4:
-        log_error(
-            "Usage: python instagram_fetch.py <url> <download_path> <cookies_json> [yt_dlp_path]",
-            "invalid_args"
-        )
+def metadata_from_ytdlp(info_dict, url):
+    """
+    Build a post metadata record from a yt-dlp info dict.
+    'direct' is set when the video URL is exactly what yt-dlp would download
+    under the format policy (a single progressive format, no merge).
+    Returns None for playlists.
+    """
+    if not info_dict or info_dict.get('entries'):
+        return None
 
-    url = sys.argv[1]
-    download_path = sys.argv[2]
-    cookies_json = sys.argv[3]
-    ytdlp_input = sys.argv[4] if len(sys.argv) >= 5 else ''
+    video_urls = []
+    direct = False
+    choice = select_format(info_dict)
+    chosen = next((f for f in info_dict.get('formats') or [] if f.get('format_id') == choice.spec and f.get('url')), None)
+    if chosen and not choice.merged:
+        video_urls.append(chosen['url'])
+        direct = True
+    elif info_dict.get('url'):
+        video_urls.append(info_dict['url'])
+        direct = not info_dict.get('formats')
+    else:
+        progressive = [
+            f for f in info_dict.get('formats') or []
+            if f.get('url') and f.get('vcodec') not in (None, 'none') and f.get('acodec') not in (None, 'none')
+        ]
+        if progressive:
+            best = max(progressive, key=lambda f: f.get('height') or 0)
+            video_urls.append(best['url'])
 
-    log_debug(f"URL: {url}")
-    log_debug(f"Download path: {download_path}")
-    log_debug(f"Has requests library: {HAS_REQUESTS}")
-    log_debug(f"yt-dlp input: {ytdlp_input}")
+    return {
+        'username': extract_username_from_ytdlp(info_dict, url),
+        'caption': info_dict.get('description', info_dict.get('title', '')),
+        'thumbnail': info_dict.get('thumbnail', ''),
+        'content_type': get_content_type(url, info_dict),
+        'video_urls': video_urls,
+        'image_urls': [],
+        'video_variants': list(ytdlp_variants(info_dict, choice).values())[:1],
+        'image_variants': [],
+        'is_carousel': False,
+        'direct': direct,
+    }
 
-    if not validate_url(url):
-        log_error("Invalid Instagram URL format.", "invalid_url")
 
-    # Parse cookies list
-    try:
-        cookie_files = json.loads(cookies_json)
-        if not isinstance(cookie_files, list):
-            cookie_files = [cookie_files]
-    except json.JSONDecodeError:
-        cookie_files = [cookies_json]
+def cache_ytdlp_metadata(shortcode, info_dict, url):
+    """Cache the metadata record built from a yt-dlp info dict; returns it, or None if it has no video URL."""
+    meta = metadata_from_ytdlp(info_dict, url)
+    if not (meta and meta['video_urls']):
+        return None
+    store_cached_metadata(shortcode, meta)
+    return meta
 
-    if not cookie_files:
-        log_error("No cookie files provided.", "cookies_missing", 0)
 
-    log_debug(f"Cookie files: {len(cookie_files)}")
+def get_url_expiry(url):
+    """Expiry timestamp signed into an Instagram CDN URL (hex oe= parameter), or None."""
+    match = re.search(r'[?&]oe=([0-9A-Fa-f]+)', url)
+    return int(match.group(1), 16) if match else None
 
-    # Find working yt-dlp command
-    ytdlp_cmd = find_ytdlp_command(ytdlp_input)
-    log_debug(f"Using yt-dlp command: {' '.join(ytdlp_cmd)}")
 
-    # Verify yt-dlp works
-    return_code, stdout, stderr = run_ytdlp(ytdlp_cmd, ['--version'], timeout=15)
-    if return_code != 0:
-        log_debug(f"yt-dlp verification failed: {stderr[:200]}")
-        # Don't exit here, we might be able to download photos without yt-dlp
-    else:
-        log_debug(f"yt-dlp version: {stdout.strip()}")
+def get_metadata_cache_path(shortcode):
+    """JSON file holding the cached metadata record for one shortcode (per format policy), or None without a cache dir."""
+    cache_dir = get_cache_dir('meta')
+    if cache_dir is None:
+        return None
+    safe_key = re.sub(r'[^\w.-]', '_', policy_cache_key(shortcode))
+    return os.path.join(cache_dir, f"{safe_key}.json")
 
-    # Try each cookie file
-    last_error = None
-    last_error_type = None
-    cookies_tried = 0
+
+def load_cached_metadata(shortcode):
+    """Return the cached metadata record for shortcode, or None if missing or expired."""
+    cache_path = get_metadata_cache_path(shortcode)
+    cached = read_json_file(cache_path) if cache_path else None
+    if cached and time.time() >= cached.get('expires_at', 0):
+        drop_cached_metadata(shortcode)
+        cached = None
+    METRICS.inc('ig_worker_cache_requests_total', cache='metadata', result='hit' if cached else 'miss')
+    if not cached:
+        return None
+    log_debug(f"Metadata cache hit: {shortcode}")
+    return cached['meta']
+
+
+def store_cached_metadata(shortcode, meta):
+    """
+    Cache a metadata record for IG_WORKER_META_CACHE_TTL seconds, or until the
+    earliest oe= expiry of its media URLs (less a safety margin) if sooner.
+    Records without any media URL are not cached.
+    """
+    if not meta or not (meta.get('video_urls') or meta.get('image_urls')):
+        return
+
+    now = time.time()
+    expires_at = now + env_float('IG_WORKER_META_CACHE_TTL', 300)
+    for media_url in (meta.get('video_urls') or []) + (meta.get('image_urls') or []):
+        url_expiry = get_url_expiry(media_url)
+        if url_expiry is not None:
+            expires_at = min(expires_at, url_expiry - 60)
+    if expires_at <= now:
+        return
+
+    cache_path = get_metadata_cache_path(shortcode)
+    if cache_path:
+        write_json_file(cache_path, {'expires_at': expires_at, 'meta': meta})
+
+
+def drop_cached_metadata(shortcode):
+    """Forget the cached metadata record for shortcode."""
+    cache_path = get_metadata_cache_path(shortcode)
+    if not cache_path:
+        return
+    try:
+        os.remove(cache_path)
+    except OSError:
+        pass
+
+
+def preview_envelope(meta, cookies_tried=0, cookie_used=None):
+    """Envelope for a preview-only request: metadata and remote media URLs, no files."""
+    image_variants = meta.get('image_variants') or []
+    if meta.get('video_urls'):
+        items = [{
+            "id": 1,
+            "type": "video",
+            "format": "mp4",
+            "url": meta['video_urls'][0],
+            "thumbnail": meta.get('thumbnail') or '',
+            "variants": (meta.get('video_variants') or [[]])[0],
+        }]
+    else:
+        items = [{
+            "id": idx + 1,
+            "type": "image",
+            "format": get_image_extension(image_url),
+            "url": image_url,
+            "thumbnail": meta.get('thumbnail') or '',
+            "variants": image_variants[idx] if idx < len(image_variants) else [],
+        } for idx, image_url in enumerate((meta.get('image_urls') or [])[:10])]
+
+    response = {
+        "success": True,
+        "preview": True,
+        "type": meta.get('content_type') or 'post',
+        "username": meta.get('username') or 'instagram_user',
+        "caption": (meta.get('caption') or '')[:500],
+        "thumbnail": meta.get('thumbnail') or '',
+        "items": items,
+        "cookies_tried": cookies_tried,
+    }
+    if cookie_used:
+        response["cookie_used"] = os.path.basename(cookie_used)
+    return response
+
+
+def preview_post(url, download_path, cookie_files, ytdlp_cmd):
+    """
+    Answer a preview-only request: post metadata and media URLs, nothing downloaded.
+    Served from the metadata cache when possible. download_path is only
+    yt-dlp's output directory, in case it writes anything while extracting.
+    """
+    shortcode = extract_shortcode(url)
+    meta = load_cached_metadata(shortcode)
+    if meta:
+        response = preview_envelope(meta)
+        response["cache"] = "hit"
+        return response
+
+    if not cookie_files:
+        return error_envelope("No cookie files provided.", "cookies_missing", 0)
+
+    is_likely_video = is_video_url(url)
     all_errors = []
 
     for idx, cookie_path in enumerate(cookie_files):
-        cookies_tried += 1
-        
-        result, error_msg, error_type, should_retry = try_download(
-            url, download_path, cookie_path, ytdlp_cmd, idx
-        )
+        jar = load_cookie_jar(cookie_path)
+        if jar.error:
+            all_errors.append({"cookie": os.path.basename(cookie_path), "error": jar.error})
+            continue
 
-        if result:
-            response = {
-                "success": True,
-                "type": result['content_type'],
-                "username": result['username'],
-                "caption": (result['caption'][:500] if result['caption'] else ""),
-                "thumbnail": result['thumbnail'],
-                "items": result['items'],
-                "cookies_tried": cookies_tried,
-                "cookie_used": os.path.basename(cookie_path)
-            }
-            print(json.dumps(response))
-            sys.exit(0)
+        page, error_msg = fetch_post_page(url, jar.cookies)
+        meta = extract_post_metadata(page, url, shortcode) if page else None
 
-        last_error = error_msg
-        last_error_type = error_type
-        all_errors.append({
-            "cookie": os.path.basename(cookie_path),
-            "error": error_msg[:200] if error_msg else "Unknown"
+        if is_likely_video and not (meta and meta.get('video_urls')):
+            if use_ytdlp_api():
+                info_dict, error_msg = YtdlpApiSession(url, download_path, cookie_path).fetch_metadata()
+            else:
+                info_dict, error_msg = fetch_metadata(url, cookie_path, ytdlp_cmd)
+            meta = metadata_from_ytdlp(info_dict, url) or meta
+
+        if meta and (meta.get('video_urls') or meta.get('image_urls')):
+            store_cached_metadata(shortcode, meta)
+            return preview_envelope(meta, idx + 1, cookie_path)
+
+        all_errors.append({"cookie": os.path.basename(cookie_path), "error": (error_msg or "No media found")[:200]})
+
+        if error_msg and is_permanent_content_error(error_msg):
+            return error_envelope("This content is from a private account.", "private_content", idx + 1, {"all_errors": all_errors})
+        if error_msg and is_not_found_error(error_msg):
+            return error_envelope("This post was not found or has been removed.", "not_found", idx + 1, {"all_errors": all_errors})
+
+    return error_envelope(
+        f"All {len(all_errors)} cookie(s) failed. Please check cookie files and try again.",
+        "all_cookies_failed",
+        len(all_errors),
+        {"all_errors": all_errors}
+    )
+
+
+def media_cache_enabled():
+    """Whether the shortcode media cache is on (IG_WORKER_MEDIA_CACHE) and has a directory."""
+    if os.environ.get('IG_WORKER_MEDIA_CACHE', '1').strip().lower() in ('0', 'false', 'no', 'off'):
+        return False
+    return get_cache_dir('media') is not None
+
+
+def get_media_cache_entry(shortcode):
+    """Directory holding the cached files and result.json for one shortcode (per format policy)."""
+    safe_key = re.sub(r'[^\w.-]', '_', policy_cache_key(shortcode))
+    return os.path.join(get_cache_dir('media'), safe_key)
+
+
+def link_or_copy(src, dst):
+    """Hardlink src to dst, copying when linking is not possible (e.g. across devices)."""
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def load_cached_result(shortcode, download_path):
+    """
+    Serve a cached post into download_path.
+    Returns the success envelope with paths inside download_path, or None on a miss.
+    """
+    if not media_cache_enabled():
+        return None
+
+    entry_dir = get_media_cache_entry(shortcode)
+    result_path = os.path.join(entry_dir, 'result.json')
+    cached = read_json_file(result_path)
+    if not cached:
+        return None
+
+    if time.time() - cached.get('created_at', 0) > env_float('IG_WORKER_MEDIA_CACHE_TTL', 21600):
+        log_debug(f"Media cache entry expired: {shortcode}")
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        return None
+
+    try:
+        Path(download_path).mkdir(parents=True, exist_ok=True)
+        items = []
+        for item in cached['items']:
+            item = dict(item)
+            target = os.path.join(download_path, item['filename'])
+            link_or_copy(os.path.join(entry_dir, item['filename']), target)
+            item['path'] = target
+            if item.get('thumbnail_file'):
+                thumb_target = os.path.join(download_path, item['thumbnail_file'])
+                link_or_copy(os.path.join(entry_dir, item['thumbnail_file']), thumb_target)
+                item['thumbnail_file'] = thumb_target
+            items.append(item)
+    except (OSError, KeyError) as e:
+        log_debug(f"Media cache entry unusable, dropping it: {e}")
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        return None
+
+    # Touch result.json so eviction treats this entry as recently used
+    try:
+        os.utime(result_path)
+    except OSError:
+        pass
+
+    log_debug(f"Media cache hit: {shortcode} ({len(items)} item(s))")
+    response = {"success": True}
+    response.update(cached['response'])
+    response.update({
+        "items": items,
+        "cookies_tried": 0,
+        "cache": "hit",
+    })
+    return response
+
+
+def store_cached_result(shortcode, response):
+    """Copy a successful result's files and envelope into the media cache."""
+    if not media_cache_enabled():
+        return
+
+    entry_dir = get_media_cache_entry(shortcode)
+    tmp_dir = f"{entry_dir}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(tmp_dir, exist_ok=True)
+        items = []
+        total_bytes = 0
+        for item in response['items']:
+            item = dict(item)
+            link_or_copy(item['path'], os.path.join(tmp_dir, item['filename']))
+            total_bytes += os.path.getsize(item['path'])
+            item.pop('path')
+            if item.get('thumbnail_file'):
+                thumb_name = os.path.basename(item['thumbnail_file'])
+                link_or_copy(item['thumbnail_file'], os.path.join(tmp_dir, thumb_name))
+                total_bytes += os.path.getsize(item['thumbnail_file'])
+                item['thumbnail_file'] = thumb_name
+            items.append(item)
+
+        envelope = {k: v for k, v in response.items() if k not in ('items', 'cookies_tried', 'success', 'debug')}
+        write_json_file(os.path.join(tmp_dir, 'result.json'), {
+            'created_at': time.time(),
+            'bytes': total_bytes,
+            'response': envelope,
+            'items': items,
         })
 
-        if not should_retry:
-            log_debug(f"Permanent error, stopping: {error_msg[:100] if error_msg else 'Unknown'}")
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.rename(tmp_dir, entry_dir)
+        log_debug(f"Stored {shortcode} in media cache ({total_bytes} bytes)")
+    except (OSError, KeyError) as e:
+        log_debug(f"Could not store {shortcode} in media cache: {e}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return
+
+    if media_cache_sweep_due(total_bytes):
+        evict_media_cache()
+
+
+# This process's view of the media cache size: the total found by the last
+# sweep plus what it stored since. Other processes' stores are only seen by
+# the next sweep, which IG_WORKER_MEDIA_CACHE_EVICT_INTERVAL bounds.
+MEDIA_CACHE_USAGE = {'swept_at': 0.0, 'bytes': 0}
+MEDIA_CACHE_USAGE_LOCK = threading.Lock()
+
+
+def media_cache_sweep_due(stored_bytes):
+    """
+    Count a stored entry toward the cache size. True when evict_media_cache()
+    should run: the size cap looks exceeded, or the last sweep is older than
+    IG_WORKER_MEDIA_CACHE_EVICT_INTERVAL. Keeps stores from walking the whole
+    cache every time.
+    """
+    max_bytes = env_int('IG_WORKER_MEDIA_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024)
+    now = time.time()
+    with MEDIA_CACHE_USAGE_LOCK:
+        MEDIA_CACHE_USAGE['bytes'] += stored_bytes
+        due = (MEDIA_CACHE_USAGE['bytes'] > max_bytes
+               or now - MEDIA_CACHE_USAGE['swept_at'] >= env_float('IG_WORKER_MEDIA_CACHE_EVICT_INTERVAL', 60))
+        if due:
+            # Claimed here so concurrent stores do not sweep at the same time
+            MEDIA_CACHE_USAGE['swept_at'] = now
+    return due
+
+
+def evict_media_cache():
+    """Drop expired entries, then least recently used ones until under the size cap."""
+    cache_root = get_cache_dir('media')
+    max_bytes = env_int('IG_WORKER_MEDIA_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024)
+    ttl = env_float('IG_WORKER_MEDIA_CACHE_TTL', 21600)
+    now = time.time()
+
+    entries = []
+    total_bytes = 0
+    for entry in os.scandir(cache_root):
+        if not entry.is_dir() or entry.name.endswith('.tmp'):
+            continue
+        result_path = os.path.join(entry.path, 'result.json')
+        cached = read_json_file(result_path)
+        if not cached or now - cached.get('created_at', 0) > ttl:
+            shutil.rmtree(entry.path, ignore_errors=True)
+            continue
+        last_used = get_file_mtime(result_path) or 0
+        entries.append((last_used, entry.path, cached.get('bytes', 0)))
+        total_bytes += cached.get('bytes', 0)
+
+    for last_used, path, size in sorted(entries):
+        if total_bytes <= max_bytes:
             break
+        log_debug(f"Evicting {os.path.basename(path)} from media cache")
+        shutil.rmtree(path, ignore_errors=True)
+        total_bytes -= size
 
-        log_debug(f"Cookie #{idx + 1} failed, trying next...")
+    with MEDIA_CACHE_USAGE_LOCK:
+        MEDIA_CACHE_USAGE['bytes'] = total_bytes
 
-    # All cookies failed
+
+SINGLE_FLIGHTS = {}
+SINGLE_FLIGHTS_LOCK = threading.Lock()
+
+
+@contextmanager
+def single_flight(key):
+    """
+    Run the body for one key at a time.
+    Threads in this process share a lock and the leader's result (yielded as
+    a dict with a 'result' slot, which callers fill only on success, so a
+    failure is retried by the next waiter); other worker processes are serialised by a
+    file lock in the cache dir and pick the result up from the media cache.
+    Waiting gives up after IG_WORKER_SINGLE_FLIGHT_TIMEOUT and runs anyway.
+    """
+    timeout = env_float('IG_WORKER_SINGLE_FLIGHT_TIMEOUT', 300)
+    deadline = time.time() + timeout
+
+    with SINGLE_FLIGHTS_LOCK:
+        flight = SINGLE_FLIGHTS.get(key)
+        if flight is None:
+            flight = {'lock': threading.Lock(), 'users': 0, 'result': None}
+            SINGLE_FLIGHTS[key] = flight
+        flight['users'] += 1
+
+    thread_locked = flight['lock'].acquire(timeout=timeout)
+    lock_file = None
+    try:
+        lock_dir = get_cache_dir('locks') if fcntl is not None else None
+        if lock_dir is not None:
+            safe_key = re.sub(r'[^\w.-]', '_', key)
+            lock_file = open(os.path.join(lock_dir, f"{safe_key}.lock"), 'w')
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    if time.time() >= deadline:
+                        log_debug(f"Timed out waiting for concurrent fetch of {key}")
+                        lock_file.close()
+                        lock_file = None
+                        break
+                    time.sleep(0.1)
+        yield flight
+    finally:
+        if lock_file is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+        if thread_locked:
+            flight['lock'].release()
+        with SINGLE_FLIGHTS_LOCK:
+            flight['users'] -= 1
+            if flight['users'] == 0:
+                SINGLE_FLIGHTS.pop(key, None)
+
+
+def share_result(response, download_path):
+    """
+    Reuse another job's envelope for this job's download_path.
+    Successful results get their files hardlinked into download_path.
+    """
+    if not response.get('success'):
+        return dict(response)
+
+    Path(download_path).mkdir(parents=True, exist_ok=True)
+    items = []
+    for item in response['items']:
+        item = dict(item)
+        target = os.path.join(download_path, item['filename'])
+        if os.path.abspath(item['path']) != os.path.abspath(target):
+            link_or_copy(item['path'], target)
+        item['path'] = target
+        if item.get('thumbnail_file'):
+            thumb_target = os.path.join(download_path, os.path.basename(item['thumbnail_file']))
+            if os.path.abspath(item['thumbnail_file']) != os.path.abspath(thumb_target):
+                link_or_copy(item['thumbnail_file'], thumb_target)
+            item['thumbnail_file'] = thumb_target
+        items.append(item)
+
+    shared = dict(response)
+    shared.update({"items": items, "cookies_tried": 0, "coalesced": True})
+    return shared
+
+
+COOKIE_HEALTH_LOCK = threading.Lock()
+# Stands in for cookie_health.json when there is no cache dir
+COOKIE_HEALTH_MEMORY = {}
+
+# Failures that say nothing about the cookie itself
+CONTENT_ERROR_TYPES = {'private_content', 'not_found'}
+
+# Failures that bench a cookie, and the setting holding the cooldown length
+COOKIE_COOLDOWNS = {
+    'cookie_error': ('IG_WORKER_COOKIE_COOLDOWN', 1800),
+    'cookie_invalid': ('IG_WORKER_COOKIE_COOLDOWN', 1800),
+    'cookie_not_found': ('IG_WORKER_COOKIE_COOLDOWN', 1800),
+    'cookie_unreadable': ('IG_WORKER_COOKIE_COOLDOWN', 1800),
+    'cookie_expired': ('IG_WORKER_COOKIE_COOLDOWN', 1800),
+    'rate_limited': ('IG_WORKER_RATE_LIMIT_COOLDOWN', 600),
+}
+
+
+@contextmanager
+def cookie_health_store():
+    """
+    Read-modify-write access to cookie_health.json in the cache dir, keyed by
+    cookie path. Serialised across threads and, where fcntl exists, across
+    processes. Without a cache dir the records only live in this process.
+    """
+    cache_dir = get_cache_dir()
+    with COOKIE_HEALTH_LOCK:
+        if cache_dir is None:
+            yield COOKIE_HEALTH_MEMORY
+            return
+        health_path = os.path.join(cache_dir, 'cookie_health.json')
+        lock_file = open(os.path.join(cache_dir, 'cookie_health.lock'), 'w')
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            health = read_json_file(health_path) or {}
+            yield health
+            write_json_file(health_path, health)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+
+def new_cookie_health():
+    """Health record for a cookie that has never been used."""
+    return {
+        'score': 1.0,
+        'successes': 0,
+        'failures': 0,
+        'last_failure_type': None,
+        'last_failure_at': 0,
+        'latency_ms': None,
+        'cooldown_until': 0,
+        'last_used': 0,
+        'mtime': None,
+    }
+
+
+def schedule_cookies(cookie_files):
+    """
+    Order cookie files for this request using their recorded health.
+    Healthy cookies (score >= 0.5) come first, least recently used first, so
+    load rotates across them; degraded ones follow, best score first. Cookies
+    in cooldown are skipped unless every cookie is cooling down, in which case
+    the one whose cooldown ends soonest goes first.
+    The first pick is marked as used right away so concurrent jobs rotate.
+    """
+    now = time.time()
+    with cookie_health_store() as health:
+        records = []
+        for path in cookie_files:
+            record = health.get(path) or new_cookie_health()
+            # A replaced cookie file starts over with a clean record
+            if record.get('mtime') is not None and get_file_mtime(path) != record['mtime']:
+                log_debug(f"Cookie {os.path.basename(path)} changed on disk, resetting its health")
+                record = new_cookie_health()
+            records.append((path, record))
+
+        cooling = [(path, h) for path, h in records if h['cooldown_until'] > now]
+        available = [(path, h) for path, h in records if h['cooldown_until'] <= now]
+        healthy = sorted((r for r in available if r[1]['score'] >= 0.5), key=lambda r: r[1]['last_used'])
+        degraded = sorted((r for r in available if r[1]['score'] < 0.5), key=lambda r: -r[1]['score'])
+
+        if available:
+            ordered = healthy + degraded
+            if cooling:
+                log_debug(f"Skipping {len(cooling)} cookie(s) in cooldown")
+        else:
+            log_debug("All cookies are in cooldown, trying the soonest to recover")
+            ordered = sorted(cooling, key=lambda r: r[1]['cooldown_until'])
+
+        if ordered:
+            first_path, first_health = ordered[0]
+            first_health['last_used'] = now
+            health[first_path] = first_health
+
+    return [path for path, _ in ordered]
+
+
+def record_cookie_result(cookie_path, error_type, latency):
+    """Update a cookie's health after an attempt (error_type None means success)."""
+    if error_type in CONTENT_ERROR_TYPES:
+        return
+
+    now = time.time()
+    with cookie_health_store() as health:
+        record = health.get(cookie_path) or new_cookie_health()
+        record['last_used'] = now
+        record['mtime'] = get_file_mtime(cookie_path)
+        if record['latency_ms'] is None:
+            record['latency_ms'] = round(latency * 1000)
+        else:
+            record['latency_ms'] = round(0.7 * record['latency_ms'] + 0.3 * latency * 1000)
+
+        if error_type is None:
+            record['successes'] += 1
+            record['score'] = 0.7 * record['score'] + 0.3
+            record['cooldown_until'] = 0
+        else:
+            record['failures'] += 1
+            record['score'] = 0.7 * record['score']
+            record['last_failure_type'] = error_type
+            record['last_failure_at'] = now
+            if error_type in COOKIE_COOLDOWNS:
+                setting, default = COOKIE_COOLDOWNS[error_type]
+                record['cooldown_until'] = now + env_float(setting, default)
+                log_debug(f"Cookie {os.path.basename(cookie_path)} cooling down after {error_type}")
+
+        health[cookie_path] = record
+
+
+def parse_cookie_list(cookies_json):
+    """Parse the cookie file list passed as JSON (or a single plain path)."""
+    if isinstance(cookies_json, list):
+        return cookies_json
+    if not cookies_json:
+        return []
+    try:
+        cookie_files = json.loads(cookies_json)
+        if not isinstance(cookie_files, list):
+            cookie_files = [cookie_files]
+    except json.JSONDecodeError:
+        cookie_files = [cookies_json]
+    return cookie_files
+
+
+YTDLP_COMMAND_CACHE = {}
+YTDLP_COMMAND_LOCK = threading.Lock()
+
+
+def get_ytdlp_file(ytdlp_cmd):
+    """Return the file backing a yt-dlp command (module source or binary)."""
+    if ytdlp_cmd[1:] == ['-m', 'yt_dlp']:
+        try:
+            spec = importlib.util.find_spec('yt_dlp')
+        except (ImportError, ValueError):
+            spec = None
+        return spec.origin if spec and spec.origin else None
+    if os.path.isfile(ytdlp_cmd[0]):
+        return os.path.abspath(ytdlp_cmd[0])
+    return shutil.which(ytdlp_cmd[0])
+
+
+def get_file_mtime(path):
+    """Return a file's mtime, or None if it cannot be stat'ed."""
+    try:
+        return os.path.getmtime(path) if path else None
+    except OSError:
+        return None
+
+
+def load_cached_ytdlp_command(key):
+    """
+    Return the cached (command, version) for key if it is still valid:
+    not older than IG_WORKER_YTDLP_CACHE_TTL and the resolved file unchanged.
+    """
+    cache_dir = get_cache_dir()
+    cache = (read_json_file(os.path.join(cache_dir, 'ytdlp_command.json')) if cache_dir else None) or {}
+    entry = cache.get(key)
+    if not isinstance(entry, dict) or not entry.get('cmd'):
+        return None
+
+    ttl = env_float('IG_WORKER_YTDLP_CACHE_TTL', 86400)
+    if time.time() - entry.get('checked_at', 0) > ttl:
+        log_debug("Cached yt-dlp command expired")
+        return None
+
+    mtime = get_file_mtime(entry.get('path'))
+    if mtime is None or mtime != entry.get('mtime'):
+        log_debug("Cached yt-dlp command is stale (file changed or missing)")
+        return None
+
+    return entry['cmd'], entry.get('version', '')
+
+
+def store_cached_ytdlp_command(key, ytdlp_cmd, version):
+    """Persist the resolved command, its version and its file mtime."""
+    cache_dir = get_cache_dir()
+    path = get_ytdlp_file(ytdlp_cmd)
+    mtime = get_file_mtime(path)
+    if cache_dir is None or mtime is None:
+        return
+
+    cache_path = os.path.join(cache_dir, 'ytdlp_command.json')
+
+    cache = read_json_file(cache_path) or {}
+    cache[key] = {
+        'cmd': ytdlp_cmd,
+        'version': version,
+        'path': path,
+        'mtime': mtime,
+        'checked_at': time.time(),
+    }
+    write_json_file(cache_path, cache)
+
+
+def resolve_ytdlp_command(ytdlp_input, refresh=False):
+    """
+    Find and verify the yt-dlp command once per process.
+    The result is also cached on disk so later runs skip the --version probes;
+    pass refresh=True to force a re-probe.
+    Returns the same command list as find_ytdlp_command.
+    """
+    key = ytdlp_input or ''
+    with YTDLP_COMMAND_LOCK:
+        if key in YTDLP_COMMAND_CACHE and not refresh:
+            return YTDLP_COMMAND_CACHE[key]
+
+        disk_key = f"{sys.executable}|{key}"
+        cached = None if refresh else load_cached_ytdlp_command(disk_key)
+        if cached:
+            ytdlp_cmd, version = cached
+            log_debug(f"Using cached yt-dlp command: {' '.join(ytdlp_cmd)} (version: {version})")
+            YTDLP_COMMAND_CACHE[key] = ytdlp_cmd
+            return ytdlp_cmd
+
+        ytdlp_cmd = find_ytdlp_command(ytdlp_input)
+        log_debug(f"Using yt-dlp command: {' '.join(ytdlp_cmd)}")
+
+        # Verify yt-dlp works
+        return_code, stdout, stderr = run_ytdlp(ytdlp_cmd, ['--version'], timeout=15)
+        if return_code != 0:
+            log_debug(f"yt-dlp verification failed: {stderr[:200]}")
+            # Don't fail here, we might be able to download photos without yt-dlp
+        else:
+            log_debug(f"yt-dlp version: {stdout.strip()}")
+            store_cached_ytdlp_command(disk_key, ytdlp_cmd, stdout.strip())
+
+        YTDLP_COMMAND_CACHE[key] = ytdlp_cmd
+        return ytdlp_cmd
+
+
+def run_job(url, download_path, cookie_files, ytdlp_cmd, preview=False):
+    """
+    Fetch one Instagram URL, serving it from the media cache when possible.
+    With preview set, only metadata and remote media URLs are returned.
+    Returns the JSON envelope (success or error) as a dict.
+    """
+    log_debug(f"URL: {url}")
+    log_debug(f"Download path: {download_path}")
+
+    if not validate_url(url):
+        return error_envelope("Invalid Instagram URL format.", "invalid_url")
+
+    if preview:
+        return preview_post(url, download_path, cookie_files, ytdlp_cmd)
+
+    shortcode = extract_shortcode(url)
+    with timed('cache_lookup'):
+        cached = load_cached_result(shortcode, download_path)
+    if cached:
+        return cached
+
+    if not cookie_files:
+        return error_envelope("No cookie files provided.", "cookies_missing", 0)
+
+    # Concurrent jobs for the same post wait here and reuse the first job's work
+    with single_flight(policy_cache_key(shortcode)) as flight:
+        if flight['result'] is not None:
+            log_debug(f"Reusing result of concurrent fetch: {shortcode}")
+            try:
+                return share_result(flight['result'], download_path)
+            except (OSError, KeyError) as e:
+                log_debug(f"Could not reuse concurrent result: {e}")
+
+        # Another worker process may have finished this post while we waited
+        cached = load_cached_result(shortcode, download_path)
+        if cached:
+            return cached
+
+        response = fetch_with_cookies(url, download_path, cookie_files, ytdlp_cmd)
+        remove_partial_downloads(download_path)
+        if response.get('success'):
+            with timed('cache_store'):
+                store_cached_result(shortcode, response)
+            flight['result'] = response
+        return response
+
+
+def success_envelope(result, cookies_tried, cookie_path):
+    """Build the success envelope from a try_download() result."""
+    return {
+        "success": True,
+        "type": result['content_type'],
+        "username": result['username'],
+        "caption": (result['caption'][:500] if result['caption'] else ""),
+        "thumbnail": result['thumbnail'],
+        "items": result['items'],
+        "cookies_tried": cookies_tried,
+        "cookie_used": os.path.basename(cookie_path)
+    }
+
+
+def failure_envelope(last_error_type, cookies_tried, all_errors, ytdlp_cmd):
+    """Build the error envelope once every cookie attempt has failed."""
     debug_info = {
         "cookies_tried": cookies_tried,
         "all_errors": all_errors,
         "ytdlp_cmd": ' '.join(ytdlp_cmd),
+        "ytdlp_engine": "api" if use_ytdlp_api() else "subprocess",
         "has_requests": HAS_REQUESTS
     }
 
     if last_error_type == "private_content":
-        log_error("This content is from a private account.", "private_content", cookies_tried, debug_info)
-    elif last_error_type == "not_found":
-        log_error("This post was not found or has been removed.", "not_found", cookies_tried, debug_info)
-    elif last_error_type == "ytdlp_error":
-        log_error(
+        return error_envelope("This content is from a private account.", "private_content", cookies_tried, debug_info)
+    if last_error_type == "not_found":
+        return error_envelope("This post was not found or has been removed.", "not_found", cookies_tried, debug_info)
+    if last_error_type == "ytdlp_error":
+        return error_envelope(
             "yt-dlp execution error. Please check yt-dlp installation.",
             "ytdlp_error",
             cookies_tried,
             debug_info
         )
-    else:
-        log_error(
-            f"All {cookies_tried} cookie(s) failed. Please check cookie files and try again.",
-            "all_cookies_failed",
-            cookies_tried,
-            debug_info
-        )
+    return error_envelope(
+        f"All {cookies_tried} cookie(s) failed. Please check cookie files and try again.",
+        "all_cookies_failed",
+        cookies_tried,
+        debug_info
+    )
+
+
+def fetch_with_cookies(url, download_path, cookie_files, ytdlp_cmd):
+    """
+    Fetch one Instagram URL, trying cookie files in health order until one works.
+    Returns the JSON envelope (success or error) as a dict.
+    """
+    log_debug(f"Cookie files: {len(cookie_files)}")
+
+    ordered_cookies = schedule_cookies(cookie_files)
+    if os.environ.get('IG_WORKER_HEDGE') == '1' and len(ordered_cookies) > 1:
+        return fetch_with_cookies_hedged(url, download_path, ordered_cookies, ytdlp_cmd)
+
+    # Try each cookie file
+    last_error_type = None
+    cookies_tried = 0
+    all_errors = []
+
+    for idx, cookie_path in enumerate(ordered_cookies):
+        cookies_tried += 1
+
+        started = time.time()
+        with timing_attempt(cookie_path) as attempt_timings:
+            result, error_msg, error_type, should_retry = try_download(
+                url, download_path, cookie_path, ytdlp_cmd, idx
+            )
+        if attempt_timings is not None:
+            attempt_timings['error_type'] = error_type
+        record_cookie_result(cookie_path, error_type, time.time() - started)
+
+        if result:
+            return success_envelope(result, cookies_tried, cookie_path)
+
+        last_error_type = error_type
+        all_errors.append({
+            "cookie": os.path.basename(cookie_path),
+            "error": error_msg[:200] if error_msg else "Unknown"
+        })
+
+        if not should_retry:
+            log_debug(f"Permanent error, stopping: {error_msg[:100] if error_msg else 'Unknown'}")
+            break
+
+        log_debug(f"Cookie #{idx + 1} failed, trying next...")
+
+    # All cookies failed
+    return failure_envelope(last_error_type, cookies_tried, all_errors, ytdlp_cmd)
+
+
+class HedgedAttempt:
+    """
+    One cookie attempt running on its own thread and staging directory.
+    The staging dir sits next to download_path, not in it, so a cancelled
+    attempt that is still winding down never writes into the job's folder.
+    """
+
+    def __init__(self, idx, cookie_path, download_path):
+        self.idx = idx
+        self.cookie_path = cookie_path
+        parent, name = os.path.split(os.path.abspath(download_path))
+        self.staging_path = os.path.join(parent, f".{name}.attempt-{idx + 1}")
+        self.cancel = threading.Event()
+        self.metadata_ready = threading.Event()
+        self.started = time.time()
+        self.outcome = None
+        self.thread = None
+
+    def run(self, url, ytdlp_cmd, results):
+        ATTEMPT_CANCEL.set(self.cancel)
+        ATTEMPT_METADATA.set(self.metadata_ready)
+        try:
+            os.makedirs(self.staging_path, exist_ok=True)
+            with timing_attempt(self.cookie_path) as attempt_timings:
+                self.outcome = try_download(url, self.staging_path, self.cookie_path, ytdlp_cmd, self.idx)
+            if attempt_timings is not None:
+                attempt_timings['error_type'] = self.outcome[2]
+        except AttemptCancelled:
+            log_debug(f"Attempt #{self.idx + 1} cancelled")
+        except Exception as e:
+            log_debug(f"Attempt #{self.idx + 1} crashed: {e}")
+            self.outcome = (None, f"Unexpected error: {e}", "download_error", True)
+        finally:
+            if self.cancel.is_set():
+                shutil.rmtree(self.staging_path, ignore_errors=True)
+            results.put(self)
+
+
+# Cancelled hedged attempts whose threads may still be running
+RETIRED_ATTEMPTS = []
+RETIRED_ATTEMPTS_LOCK = threading.Lock()
+
+
+def retire_attempts(attempts):
+    """
+    Cancel attempts without waiting for them. One blocked in a page fetch
+    only notices when the fetch returns; its thread then removes its staging
+    dir itself (see HedgedAttempt.run).
+    """
+    with RETIRED_ATTEMPTS_LOCK:
+        RETIRED_ATTEMPTS[:] = [attempt for attempt in RETIRED_ATTEMPTS if attempt.thread.is_alive()]
+        for attempt in attempts:
+            attempt.cancel.set()
+            RETIRED_ATTEMPTS.append(attempt)
+    for attempt in attempts:
+        shutil.rmtree(attempt.staging_path, ignore_errors=True)
+
+
+def wait_for_retired_attempts(timeout):
+    """Give cancelled attempts up to timeout seconds to stop (their yt-dlp processes get killed)."""
+    deadline = time.time() + timeout
+    with RETIRED_ATTEMPTS_LOCK:
+        attempts = list(RETIRED_ATTEMPTS)
+    for attempt in attempts:
+        attempt.thread.join(max(0, deadline - time.time()))
+
+
+def promote_attempt_files(result, staging_path, download_path):
+    """Move the winning attempt's files from its staging dir into download_path."""
+    for item in result['items']:
+        target = os.path.join(download_path, item['filename'])
+        os.replace(item['path'], target)
+        item['path'] = target
+        if item.get('thumbnail_file'):
+            thumb_target = os.path.join(download_path, os.path.basename(item['thumbnail_file']))
+            os.replace(item['thumbnail_file'], thumb_target)
+            item['thumbnail_file'] = thumb_target
+    shutil.rmtree(staging_path, ignore_errors=True)
+
+
+def fetch_with_cookies_hedged(url, download_path, ordered_cookies, ytdlp_cmd):
+    """
+    Like fetch_with_cookies(), but when the running attempt has produced no
+    metadata after IG_WORKER_HEDGE_AFTER seconds, the next cookie is started
+    alongside it. The first attempt to succeed wins and is answered at once;
+    the other is cancelled and cleans up after itself in the background.
+    Failures still fail over one cookie at a time.
+    """
+    hedge_after = env_float('IG_WORKER_HEDGE_AFTER', 10)
+    results = queue.Queue()
+    pending = list(enumerate(ordered_cookies))
+    running = {}
+
+    last_error_type = None
+    cookies_tried = 0
+    all_errors = []
+
+    def launch():
+        idx, cookie_path = pending.pop(0)
+        attempt = HedgedAttempt(idx, cookie_path, download_path)
+        # The attempt thread runs in a copy of this context so it sees the job's timings
+        attempt.thread = threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(attempt.run, url, ytdlp_cmd, results),
+            daemon=True
+        )
+        attempt.thread.start()
+        running[idx] = attempt
+        return attempt
+
+    def cancel_running():
+        retire_attempts(list(running.values()))
+
+    launch()
+    while running:
+        try:
+            attempt = results.get(timeout=0.2)
+        except queue.Empty:
+            if len(running) == 1 and pending:
+                current = next(iter(running.values()))
+                if not current.metadata_ready.is_set() and time.time() - current.started >= hedge_after:
+                    hedge = launch()
+                    log_debug(f"Cookie #{current.idx + 1} slow to return metadata, hedging with cookie #{hedge.idx + 1}")
+            continue
+
+        running.pop(attempt.idx)
+        if attempt.cancel.is_set():
+            continue
+
+        cookies_tried += 1
+        result, error_msg, error_type, should_retry = attempt.outcome
+        record_cookie_result(attempt.cookie_path, error_type, time.time() - attempt.started)
+
+        if result:
+            cancel_running()
+            with timed('finalise'):
+                promote_attempt_files(result, attempt.staging_path, download_path)
+            log_debug(f"Cookie #{attempt.idx + 1} won the hedged race")
+            return success_envelope(result, cookies_tried, attempt.cookie_path)
+
+        shutil.rmtree(attempt.staging_path, ignore_errors=True)
+        last_error_type = error_type
+        all_errors.append({
+            "cookie": os.path.basename(attempt.cookie_path),
+            "error": error_msg[:200] if error_msg else "Unknown"
+        })
+
+        if not should_retry:
+            log_debug(f"Permanent error, stopping: {error_msg[:100] if error_msg else 'Unknown'}")
+            cancel_running()
+            break
+
+        if not running and pending:
+            log_debug(f"Cookie #{attempt.idx + 1} failed, trying next...")
+            launch()
+
+    return failure_envelope(last_error_type, cookies_tried, all_errors, ytdlp_cmd)
+
+
+def decode_job_line(line):
+    """The job object on a JSON line, or None if the line is not one."""
+    try:
+        job = json.loads(line)
+    except json.JSONDecodeError:
+        return None
+    return job if isinstance(job, dict) else None
+
+
+def handle_job_line(line, ytdlp_input='', default_cookies=None):
+    """Run one JSON-lines job and return its envelope. Never raises."""
+    job = decode_job_line(line)
+    if job is None:
+        return error_envelope("Invalid job: expected one JSON object per line.", "invalid_job")
+
+    response = handle_job(job, ytdlp_input, default_cookies)
+    # Echo the caller's job id so results can be matched to jobs
+    if 'id' in job:
+        response = {'id': job['id'], **response}
+    return response
+
+
+def handle_job(job, ytdlp_input='', default_cookies=None):
+    """Run one decoded job; jobs without "cookies" use default_cookies. Never raises."""
+    if job.get('op') == 'thumbnail':
+        return make_thumbnail(job.get('path') or '', job.get('thumbnail') or '')
+
+    url = job.get('url') or ''
+    download_path = job.get('download_path') or ''
+    if not download_path:
+        return error_envelope("Invalid job: download_path is required.", "invalid_job")
+
+    started = time.perf_counter()
+    try:
+        with collect_timings(bool(job.get('timings'))) as timings:
+            cookie_files = parse_cookie_list(job['cookies']) if job.get('cookies') else list(default_cookies or [])
+            with timed('ytdlp_resolve'):
+                ytdlp_cmd = resolve_ytdlp_command(job.get('yt_dlp_path') or ytdlp_input)
+            with job_format_policy(job.get('tier'), job.get('quality')):
+                response = run_job(url, download_path, cookie_files, ytdlp_cmd, preview=bool(job.get('preview')))
+            if timings is not None:
+                response = dict(response, timings=timings.as_dict())
+    except Exception as e:
+        log_debug(f"Job failed with exception: {e}")
+        log_debug(traceback.format_exc())
+        response = error_envelope(f"Worker error: {e}", "exception")
+
+    finish_job(response, time.perf_counter() - started)
+    return response
+
+
+def finish_job(response, seconds):
+    """Count a finished job in the metrics and rewrite --metrics-file."""
+    observe_job(response, seconds)
+    if METRICS_FILE:
+        try:
+            flush_metrics_file(METRICS_FILE)
+        except OSError as e:
+            log_debug(f"Could not write metrics file: {e}")
+
+
+class JobRequestHandler(socketserver.StreamRequestHandler):
+    """Answer each JSON job line received on a socket connection."""
+
+    def handle(self):
+        for raw_line in self.rfile:
+            line = raw_line.decode('utf-8', errors='ignore').strip()
+            if not line:
+                continue
+            response = handle_job_line(line, self.server.ytdlp_input)
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+def serve_stdio(ytdlp_input):
+    """Serve JSON-lines jobs from stdin, one envelope per line on stdout."""
+    log_debug("Serving jobs on stdin/stdout")
+    for raw_line in sys.stdin:
+        line = raw_line.strip()
+        if not line:
+            continue
+        response = handle_job_line(line, ytdlp_input)
+        sys.stdout.write(json.dumps(response) + '\n')
+        sys.stdout.flush()
+
+
+def run_batch(source, ytdlp_input, parallel=4, default_cookies=None):
+    """
+    Run every JSON job line from source (a file path, or '-' for stdin) with
+    up to `parallel` jobs in flight, printing one envelope per job in input
+    order. yt-dlp resolution, parsed cookies and HTTP pools are shared by the
+    whole batch. Returns the number of failed jobs.
+    """
+    stream = sys.stdin if source == '-' else open(source, 'r', encoding='utf-8')
+    pending = deque()
+    failures = 0
+
+    def write_next():
+        response = pending.popleft().result()
+        sys.stdout.write(json.dumps(response) + '\n')
+        sys.stdout.flush()
+        return 0 if response.get('success') else 1
+
+    try:
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            for raw_line in stream:
+                line = raw_line.strip()
+                if not line:
+                    continue
+                pending.append(executor.submit(handle_job_line, line, ytdlp_input, default_cookies))
+                # Bound the read-ahead, and write results as soon as they are next in order
+                while pending and (len(pending) >= parallel * 2 or pending[0].done()):
+                    failures += write_next()
+            while pending:
+                failures += write_next()
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    return failures
+
+
+def serve_socket(socket_path, ytdlp_input):
+    """Serve JSON-lines jobs on a Unix socket, one thread per connection."""
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    server = socketserver.ThreadingUnixStreamServer(socket_path, JobRequestHandler)
+    server.daemon_threads = True
+    server.ytdlp_input = ytdlp_input
+    os.chmod(socket_path, 0o660)
+    log_debug(f"Serving jobs on unix socket: {socket_path}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+# ---------------------------------------------------------------------------
+# Async engine (--engine async)
+#
+# Runs many try_download flows on one event loop instead of one thread each.
+# HTTP goes through httpx.AsyncClient when httpx is installed, or through the
+# blocking helpers above on worker threads otherwise; yt-dlp runs with
+# asyncio.create_subprocess_exec. Parsing, classification and result building
+# are the same functions the threaded engine uses.
+# ---------------------------------------------------------------------------
+
+class AsyncEngine:
+    """
+    Limits and connection pools shared by every job on one event loop.
+    At most `limit` jobs run at once (IG_WORKER_ASYNC_CONCURRENCY), each host
+    sees at most IG_WORKER_PER_HOST_LIMIT requests and each cookie file at
+    most IG_WORKER_PER_COOKIE_LIMIT attempts at a time.
+    """
+
+    def __init__(self, ytdlp_input='', limit=None):
+        self.ytdlp_input = ytdlp_input
+        self.limit = max(1, limit or env_int('IG_WORKER_ASYNC_CONCURRENCY', 64))
+        self.jobs = asyncio.Semaphore(self.limit)
+        self.host_limits = {}
+        self.cookie_limits = {}
+        self.clients = {}
+        self.flights = {}
+
+    def host_limit(self, url):
+        host = urlparse(url).netloc.lower()
+        if host not in self.host_limits:
+            self.host_limits[host] = asyncio.Semaphore(max(1, env_int('IG_WORKER_PER_HOST_LIMIT', 4)))
+        return self.host_limits[host]
+
+    def cookie_limit(self, cookie_path):
+        if cookie_path not in self.cookie_limits:
+            self.cookie_limits[cookie_path] = asyncio.Semaphore(max(1, env_int('IG_WORKER_PER_COOKIE_LIMIT', 2)))
+        return self.cookie_limits[cookie_path]
+
+    def client(self, cookies_dict, media=False):
+        """The shared httpx client for one cookie identity (see get_http_session)."""
+        identity = (hashlib.sha1(json.dumps(sorted(cookies_dict.items())).encode()).hexdigest(), media)
+        client = self.clients.get(identity)
+        if client is None:
+            pool_size = env_int('IG_WORKER_HTTP_POOL_SIZE', 10)
+            client = httpx.AsyncClient(
+                cookies=cookies_dict,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=pool_size),
+                transport=httpx.AsyncHTTPTransport(retries=0 if media else env_int('IG_WORKER_HTTP_RETRIES', 2)),
+            )
+            self.clients[identity] = client
+        return client
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients.clear()
+
+
+async def run_ytdlp_async(ytdlp_cmd, args, timeout=120):
+    """run_ytdlp() on the event loop; the process is killed on timeout or cancellation."""
+    full_cmd = ytdlp_cmd + args
+    log_debug(f"Running: {' '.join(full_cmd[:5])}...")
+
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *full_cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=get_env()
+        )
+    except FileNotFoundError as e:
+        return -3, '', f'Command not found: {str(e)}'
+    except Exception as e:
+        return -5, '', f'Unexpected error: {str(e)}'
+
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        return -2, '', 'Request timed out'
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    return process.returncode, stdout.decode('utf-8', errors='ignore'), stderr.decode('utf-8', errors='ignore')
+
+
+async def fetch_post_page_async(engine, url, cookies_dict):
+    """fetch_post_page() on the event loop. Returns (PostPage, error)."""
+    async with engine.host_limit(url):
+        if not HAS_HTTPX:
+            return await asyncio.to_thread(fetch_post_page, url, cookies_dict)
+
+        request_url, headers = apply_host_override(url, PAGE_HEADERS)
+        try:
+            with timed('page_fetch'):
+                response = await engine.client(cookies_dict).get(request_url, headers=headers, timeout=30)
+            page = PostPage(url, response.text, response.status_code, str(response.url))
+        except AttemptCancelled:
+            raise
+        except Exception as e:
+            log_debug(f"Error fetching page: {e}")
+            return None, str(e)
+
+    log_debug(f"Fetched page HTML, length: {len(page.html)}, status: {page.status}, final URL: {page.final_url}")
+    return page, None
+
+
+async def stream_download_async(engine, url, save_path, cookies_dict, headers, timeout=60):
+    """stream_download() on the event loop, with the same .part file, resume, retries and size cap."""
+    if not HAS_HTTPX:
+        return await asyncio.to_thread(stream_download, url, save_path, cookies_dict, headers, timeout)
+
+    max_bytes = env_int('IG_WORKER_MAX_DOWNLOAD_BYTES', 500 * 1024 * 1024)
+    retries = max(0, env_int('IG_WORKER_DOWNLOAD_RETRIES', 3))
+    partial = PartialDownload(url, save_path)
+    started = time.perf_counter()
+    client = engine.client(cookies_dict, media=True)
+
+    async def download_part_async():
+        request_url, request_headers = apply_host_override(url, partial.request_headers(headers))
+        async with client.stream('GET', request_url, headers=request_headers, timeout=timeout) as response:
+            with partial.begin(url, response.status_code, response.headers, max_bytes) as f:
+                # Unsized so bytes already received are on disk when the connection drops
+                async for chunk in response.aiter_raw():
+                    partial.write(f, chunk, max_bytes)
+        partial.finish()
+
+    try:
+        for retry in range(1, retries + 2):
+            try:
+                await download_part_async()
+                break
+            except Exception as e:
+                if retry > retries or not retryable_download_error(e):
+                    raise
+                delay = download_retry_delay(retry)
+                log_debug(f"Download interrupted at byte {partial.offset} ({e}), retry {retry}/{retries} in {delay:g}s")
+                await asyncio.sleep(delay)
+
+        partial.complete(save_path)
+        record_download_timing(url, partial.transferred, time.perf_counter() - started)
+        METRICS.inc('ig_worker_downloaded_bytes_total', partial.transferred, downloader='http')
+        return partial.offset
+    except DownloadTooLarge:
+        partial.discard()
+        raise
+    except BaseException:
+        partial.keep()
+        raise
+
+
+async def download_media_async(engine, url, save_path, cookies_dict, headers, timeout=60):
+    """Download one media URL under its host limit. Returns True on success."""
+    try:
+        async with engine.host_limit(url):
+            await stream_download_async(engine, url, save_path, cookies_dict, headers, timeout)
+        return True
+    except AttemptCancelled:
+        raise
+    except Exception as e:
+        log_debug(f"Error downloading media: {e}")
+        return False
+
+
+async def download_post_media_async(engine, meta, shortcode, download_path, cookies_dict):
+    """download_post_media() on the event loop. Returns (downloaded_files, is_carousel)."""
+    downloaded_files = []
+    is_carousel = False
+
+    video_urls = meta.get('video_urls') or []
+    if video_urls:
+        save_path = os.path.join(download_path, f"{shortcode}.mp4")
+        log_debug(f"Downloading video: {video_urls[0][:80]}...")
+        if await download_media_async(engine, video_urls[0], save_path, cookies_dict, media_headers(True)):
+            kept = keep_downloaded_file(save_path, 10000)
+            if kept:
+                downloaded_files.append(kept)
+                log_debug(f"Successfully downloaded video: {kept.name} ({kept.stat().st_size} bytes)")
+
+    if not downloaded_files:
+        log_debug("No video downloaded, trying images...")
+        is_carousel = meta.get('is_carousel', False)
+        downloads = plan_image_downloads(meta, shortcode, download_path)
+
+        if downloads:
+            log_debug(f"Found {len(downloads)} image(s)")
+            carousel_limit = asyncio.Semaphore(max(1, env_int('IG_WORKER_CAROUSEL_CONCURRENCY', 4)))
+
+            async def download_one(img_url, save_path):
+                async with carousel_limit:
+                    return await download_media_async(engine, img_url, save_path, cookies_dict, IMAGE_HEADERS, timeout=30)
+
+            results = await asyncio.gather(*(download_one(img_url, save_path) for img_url, save_path in downloads))
+            downloaded_files.extend(collect_image_downloads(downloads, results))
+
+    return downloaded_files, is_carousel
+
+
+async def download_photo_content_async(engine, url, download_path, cookies_path, info_dict=None, meta=None):
+    """download_photo_content() on the event loop; file I/O and parsing run in worker threads."""
+    await asyncio.to_thread(Path(download_path).mkdir, parents=True, exist_ok=True)
+
+    cookies_dict = (await asyncio.to_thread(load_cookie_jar, cookies_path)).cookies
+    shortcode = extract_shortcode(url)
+
+    downloaded_files = []
+    is_carousel = False
+
+    if meta:
+        with timed('media_download'):
+            downloaded_files, is_carousel = await download_post_media_async(engine, meta, shortcode, download_path, cookies_dict)
+        if not downloaded_files:
+            log_debug("Cached media URLs failed, refetching the post page")
+            await asyncio.to_thread(drop_cached_metadata, shortcode)
+            meta = None
+
+    if not meta:
+        page, fetch_error = await fetch_post_page_async(engine, url, cookies_dict)
+        if fetch_error:
+            return None, f"Failed to fetch Instagram page: {fetch_error}", None
+
+        with timed('parse'):
+            meta = await asyncio.to_thread(extract_post_metadata, page, url, shortcode)
+        await asyncio.to_thread(store_cached_metadata, shortcode, meta)
+        with timed('media_download'):
+            downloaded_files, is_carousel = await download_post_media_async(engine, meta, shortcode, download_path, cookies_dict)
+
+    return photo_content_result(downloaded_files, meta, is_carousel, shortcode)
+
+
+async def try_download_async(engine, url, download_path, cookie_path, ytdlp_cmd, cookie_index):
+    """try_download() on the event loop; returns the same 4-tuple."""
+    log_debug(f"Trying cookie #{cookie_index + 1}: {os.path.basename(cookie_path)}")
+
+    with timed('cookie_load'):
+        jar = await asyncio.to_thread(load_cookie_jar, cookie_path)
+    if jar.error:
+        return None, jar.error, jar.error_type, True
+
+    is_likely_video = is_video_url(url)
+    info_dict = None
+    ytdlp_failed = True
+    ytdlp_error_msg = None
+    media_files = None
+    extra_info = None
+    ytdlp_choice = None
+
+    # The in-process yt-dlp API blocks, so it gets a worker thread
+    ytdlp_api = YtdlpApiSession(url, download_path, cookie_path) if is_likely_video and use_ytdlp_api() else None
+    shortcode = extract_shortcode(url)
+    cached_meta = await asyncio.to_thread(load_cached_metadata, shortcode)
+
+    if is_likely_video and not (cached_meta and cached_meta.get('video_urls') and cached_meta.get('direct')):
+        log_debug("URL looks like video content, trying yt-dlp first...")
+        with timed('metadata_fetch'):
+            if ytdlp_api:
+                info_dict, error_msg = await asyncio.to_thread(ytdlp_api.fetch_metadata)
+            else:
+                log_debug(f"Fetching metadata with cookie: {os.path.basename(cookie_path)}")
+                info_dict, error_msg = parse_metadata_output(
+                    *await run_ytdlp_async(ytdlp_cmd, metadata_args(url, cookie_path), timeout=60)
+                )
+
+        if info_dict:
+            cached_meta = await asyncio.to_thread(cache_ytdlp_metadata, shortcode, info_dict, url) or cached_meta
+
+        if error_msg:
+            log_debug(f"yt-dlp metadata error: {error_msg[:300]}")
+            ytdlp_error_msg = error_msg
+            if is_permanent_content_error(error_msg):
+                return None, "This content is from a private account or is not available.", "private_content", False
+            if is_not_found_error(error_msg):
+                return None, "This post was not found or has been removed.", "not_found", False
+        elif info_dict:
+            choice = select_format(info_dict)
+            log_debug(f"yt-dlp metadata succeeded, downloading video (format {choice.spec or 'default'})...")
+            with timed('ytdlp_download'):
+                if ytdlp_api:
+                    media_files, error_msg = await asyncio.to_thread(
+                        ytdlp_api.download, write_thumbnail_file(info_dict), choice
+                    )
+                else:
+                    Path(download_path).mkdir(parents=True, exist_ok=True)
+                    args = video_download_args(url, download_path, cookie_path, write_thumbnail_file(info_dict), choice)
+                    return_code, stdout, stderr = await run_ytdlp_async(ytdlp_cmd, args, timeout=300)
+                    media_files, error_msg = collect_video_download(return_code, stdout, stderr, download_path)
+
+            if error_msg:
+                log_debug(f"Video download error: {error_msg[:200]}")
+                ytdlp_error_msg = error_msg
+            elif media_files:
+                log_debug(f"Video download succeeded: {len(media_files)} files")
+                METRICS.inc('ig_worker_downloaded_bytes_total', sum(f.stat().st_size for f in media_files), downloader='ytdlp')
+                ytdlp_failed = False
+                ytdlp_choice = choice
+
+    if ytdlp_failed:
+        log_debug("Trying direct HTTP download...")
+        media_files, error_msg, extra_info = await download_photo_content_async(
+            engine, url, download_path, cookie_path, info_dict, cached_meta
+        )
+        if error_msg:
+            log_debug(f"Direct HTTP download also failed: {error_msg}")
+            return classify_download_error(ytdlp_error_msg if ytdlp_error_msg else error_msg)
+
+    return build_download_result(url, download_path, cookie_path, media_files, info_dict, extra_info, ytdlp_choice)
+
+
+async def fetch_with_cookies_async(engine, url, download_path, cookie_files, ytdlp_cmd):
+    """fetch_with_cookies() on the event loop, one cookie at a time in health order."""
+    log_debug(f"Cookie files: {len(cookie_files)}")
+
+    ordered_cookies = await asyncio.to_thread(schedule_cookies, cookie_files)
+    last_error_type = None
+    cookies_tried = 0
+    all_errors = []
+
+    for idx, cookie_path in enumerate(ordered_cookies):
+        cookies_tried += 1
+
+        started = time.time()
+        async with engine.cookie_limit(cookie_path):
+            with timing_attempt(cookie_path) as attempt_timings:
+                result, error_msg, error_type, should_retry = await try_download_async(
+                    engine, url, download_path, cookie_path, ytdlp_cmd, idx
+                )
+        if attempt_timings is not None:
+            attempt_timings['error_type'] = error_type
+        await asyncio.to_thread(record_cookie_result, cookie_path, error_type, time.time() - started)
+
+        if result:
+            return success_envelope(result, cookies_tried, cookie_path)
+
+        last_error_type = error_type
+        all_errors.append({
+            "cookie": os.path.basename(cookie_path),
+            "error": error_msg[:200] if error_msg else "Unknown"
+        })
+
+        if not should_retry:
+            log_debug(f"Permanent error, stopping: {error_msg[:100] if error_msg else 'Unknown'}")
+            break
+
+        log_debug(f"Cookie #{idx + 1} failed, trying next...")
+
+    return failure_envelope(last_error_type, cookies_tried, all_errors, ytdlp_cmd)
+
+
+async def run_job_async(engine, url, download_path, cookie_files, ytdlp_cmd, preview=False):
+    """
+    run_job() on the event loop. Concurrent jobs for one shortcode share the
+    first job's result; other processes are covered by the media cache check.
+    """
+    log_debug(f"URL: {url}")
+    log_debug(f"Download path: {download_path}")
+
+    if not validate_url(url):
+        return error_envelope("Invalid Instagram URL format.", "invalid_url")
+
+    if preview:
+        return await asyncio.to_thread(preview_post, url, download_path, cookie_files, ytdlp_cmd)
+
+    shortcode = extract_shortcode(url)
+    with timed('cache_lookup'):
+        cached = await asyncio.to_thread(load_cached_result, shortcode, download_path)
+    if cached:
+        return cached
+
+    if not cookie_files:
+        return error_envelope("No cookie files provided.", "cookies_missing", 0)
+
+    # Concurrent jobs for the same post wait for the first one and reuse its work
+    flight_key = policy_cache_key(shortcode)
+    leader = engine.flights.get(flight_key)
+    if leader is not None:
+        try:
+            response = await asyncio.wait_for(asyncio.shield(leader), env_float('IG_WORKER_SINGLE_FLIGHT_TIMEOUT', 300))
+            if response is not None:
+                log_debug(f"Reusing result of concurrent fetch: {shortcode}")
+                return await asyncio.to_thread(share_result, response, download_path)
+        except asyncio.TimeoutError:
+            log_debug(f"Timed out waiting for concurrent fetch of {shortcode}")
+        except (OSError, KeyError) as e:
+            log_debug(f"Could not reuse concurrent result: {e}")
+
+        # Another worker process may have finished this post while we waited
+        cached = await asyncio.to_thread(load_cached_result, shortcode, download_path)
+        if cached:
+            return cached
+
+    flight = asyncio.get_running_loop().create_future()
+    engine.flights.setdefault(flight_key, flight)
+    response = None
+    try:
+        response = await fetch_with_cookies_async(engine, url, download_path, cookie_files, ytdlp_cmd)
+        await asyncio.to_thread(remove_partial_downloads, download_path)
+        if response.get('success'):
+            with timed('cache_store'):
+                await asyncio.to_thread(store_cached_result, shortcode, response)
+        return response
+    finally:
+        # Waiters get None (and fetch themselves) if this job failed or raised
+        flight.set_result(response if response and response.get('success') else None)
+        if engine.flights.get(flight_key) is flight:
+            del engine.flights[flight_key]
+
+
+async def handle_job_async(engine, job, default_cookies=None):
+    """handle_job() on the event loop. Never raises."""
+    if job.get('op') == 'thumbnail':
+        return await asyncio.to_thread(make_thumbnail, job.get('path') or '', job.get('thumbnail') or '')
+
+    url = job.get('url') or ''
+    download_path = job.get('download_path') or ''
+    if not download_path:
+        return error_envelope("Invalid job: download_path is required.", "invalid_job")
+
+    async with engine.jobs:
+        started = time.perf_counter()
+        try:
+            with collect_timings(bool(job.get('timings'))) as timings:
+                cookie_files = parse_cookie_list(job['cookies']) if job.get('cookies') else list(default_cookies or [])
+                with timed('ytdlp_resolve'):
+                    ytdlp_cmd = await asyncio.to_thread(resolve_ytdlp_command, job.get('yt_dlp_path') or engine.ytdlp_input)
+                with job_format_policy(job.get('tier'), job.get('quality')):
+                    response = await run_job_async(
+                        engine, url, download_path, cookie_files, ytdlp_cmd, preview=bool(job.get('preview'))
+                    )
+                if timings is not None:
+                    response = dict(response, timings=timings.as_dict())
+        except Exception as e:
+            log_debug(f"Job failed with exception: {e}")
+            log_debug(traceback.format_exc())
+            response = error_envelope(f"Worker error: {e}", "exception")
+
+        await asyncio.to_thread(finish_job, response, time.perf_counter() - started)
+    return response
+
+
+async def handle_job_line_async(engine, line, default_cookies=None):
+    """handle_job_line() on the event loop. Never raises."""
+    job = decode_job_line(line)
+    if job is None:
+        return error_envelope("Invalid job: expected one JSON object per line.", "invalid_job")
+
+    response = await handle_job_async(engine, job, default_cookies)
+    if 'id' in job:
+        response = {'id': job['id'], **response}
+    return response
+
+
+async def answer_in_order(engine, read_line, write_line, default_cookies=None):
+    """
+    Run job lines from read_line() concurrently and hand each envelope to
+    write_line() in input order, until read_line() returns ''. Read-ahead is
+    bounded to twice the engine's job limit. Returns the number of failed jobs.
+    """
+    pending = asyncio.Queue(maxsize=engine.limit * 2)
+    failures = 0
+
+    async def write_results():
+        nonlocal failures
+        connected = True
+        while True:
+            task = await pending.get()
+            if task is None:
+                return
+            response = await task
+            failures += 0 if response.get('success') else 1
+            if not connected:
+                continue
+            try:
+                await write_line(json.dumps(response) + '\n')
+            except ConnectionError as e:
+                # Keep draining so the reader never blocks on a full queue
+                log_debug(f"Client connection closed: {e}")
+                connected = False
+
+    writer = asyncio.ensure_future(write_results())
+    try:
+        while True:
+            raw_line = await read_line()
+            if not raw_line:
+                break
+            line = raw_line.strip()
+            if not line:
+                continue
+            await pending.put(asyncio.ensure_future(handle_job_line_async(engine, line, default_cookies)))
+        await pending.put(None)
+        await writer
+    finally:
+        writer.cancel()
+    return failures
+
+
+async def run_batch_async(source, ytdlp_input, limit=None, default_cookies=None):
+    """run_batch() on one event loop. Returns the number of failed jobs."""
+    engine = AsyncEngine(ytdlp_input, limit)
+    stream = sys.stdin if source == '-' else open(source, 'r', encoding='utf-8')
+
+    async def write_line(text):
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+    try:
+        return await answer_in_order(engine, lambda: asyncio.to_thread(stream.readline), write_line, default_cookies)
+    finally:
+        await engine.close()
+        if stream is not sys.stdin:
+            stream.close()
+
+
+async def serve_socket_async(socket_path, ytdlp_input):
+    """serve_socket() on one event loop; jobs pipelined on a connection run concurrently."""
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    engine = AsyncEngine(ytdlp_input)
+
+    async def handle_connection(reader, writer):
+        async def read_line():
+            return (await reader.readline()).decode('utf-8', errors='ignore')
+
+        async def write_line(text):
+            writer.write(text.encode('utf-8'))
+            await writer.drain()
+
+        try:
+            await answer_in_order(engine, read_line, write_line)
+        except ConnectionError as e:
+            log_debug(f"Client connection closed: {e}")
+        finally:
+            writer.close()
+
+    server = await asyncio.start_unix_server(handle_connection, path=socket_path)
+    os.chmod(socket_path, 0o660)
+    log_debug(f"Serving jobs on unix socket (async engine): {socket_path}")
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await engine.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+VALUE_OPTIONS = {'socket', 'metrics_port', 'metrics_file', 'batch', 'parallel', 'cookies', 'engine', 'tier', 'quality'}
+
+# Textfile-collector path set by --metrics-file / IG_WORKER_METRICS_FILE
+METRICS_FILE = None
+
+
+def split_cli_args(argv):
+    """Split argv into positional arguments and --option[=value] flags."""
+    positional = []
+    options = {}
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg.startswith('--') and len(arg) > 2:
+            name, has_value, value = arg[2:].partition('=')
+            name = name.replace('-', '_')
+            if not has_value:
+                if name in VALUE_OPTIONS and i + 1 < len(argv):
+                    i += 1
+                    value = argv[i]
+                else:
+                    value = True
+            options[name] = value
+        else:
+            positional.append(arg)
+        i += 1
+    return positional, options
+
+
+def use_async_engine(options):
+    """True when --engine (or IG_WORKER_ENGINE) selects the async engine."""
+    engine = options.get('engine') or os.environ.get('IG_WORKER_ENGINE') or 'threads'
+    return engine == 'async'
+
+
+def main():
+    global METRICS_FILE
+    args, options = split_cli_args(sys.argv[1:])
+
+    METRICS_FILE = options.get('metrics_file') or os.environ.get('IG_WORKER_METRICS_FILE') or None
+    if METRICS_FILE is True:
+        METRICS_FILE = None
+    METRICS.enabled = bool(METRICS_FILE or options.get('metrics_port'))
+
+    if options.get('batch'):
+        ytdlp_input = args[0] if args else ''
+        log_debug(f"Has requests library: {HAS_REQUESTS}")
+        log_debug(f"yt-dlp input: {ytdlp_input}")
+        resolve_ytdlp_command(ytdlp_input, refresh=bool(options.get('refresh_ytdlp')))
+        default_cookies = parse_cookie_list(options['cookies']) if options.get('cookies') else []
+        try:
+            parallel = max(1, int(options.get('parallel') or 4))
+        except ValueError:
+            parallel = 4
+        source = '-' if options['batch'] is True else options['batch']
+        if use_async_engine(options):
+            limit = parallel if options.get('parallel') else None
+            failures = asyncio.run(run_batch_async(source, ytdlp_input, limit, default_cookies))
+        else:
+            failures = run_batch(source, ytdlp_input, parallel, default_cookies)
+        sys.exit(1 if failures else 0)
+
+    if options.get('serve'):
+        ytdlp_input = args[0] if args else ''
+        log_debug(f"Has requests library: {HAS_REQUESTS}")
+        log_debug(f"yt-dlp input: {ytdlp_input}")
+        if options.get('metrics_port'):
+            serve_metrics(options['metrics_port'])
+        # Resolve yt-dlp up front so the first job does not pay for it
+        resolve_ytdlp_command(ytdlp_input, refresh=bool(options.get('refresh_ytdlp')))
+        if use_async_engine(options):
+            log_debug(f"Async engine, httpx: {HAS_HTTPX}")
+            try:
+                if options.get('socket'):
+                    asyncio.run(serve_socket_async(options['socket'], ytdlp_input))
+                else:
+                    asyncio.run(run_batch_async('-', ytdlp_input))
+            except KeyboardInterrupt:
+                pass
+        elif options.get('socket'):
+            serve_socket(options['socket'], ytdlp_input)
+        else:
+            serve_stdio(ytdlp_input)
+        return
+
+    if options.get('thumbnail'):
+        if not args:
+            log_error("Usage: python instagram_fetch.py --thumbnail <video_path> [thumbnail_url]", "invalid_args")
+        response = make_thumbnail(args[0], args[1] if len(args) > 1 else '')
+        print(json.dumps(response))
+        sys.exit(0 if response.get('success') else 1)
+
+    if len(args) < 3:
+        log_error(
+            "Usage: python instagram_fetch.py <url> <download_path> <cookies_json> [yt_dlp_path]",
+            "invalid_args"
+        )
+
+    url = args[0]
+    download_path = args[1]
+    cookies_json = args[2]
+    ytdlp_input = args[3] if len(args) >= 4 else ''
+
+    log_debug(f"Has requests library: {HAS_REQUESTS}")
+    log_debug(f"yt-dlp input: {ytdlp_input}")
+
+    if not validate_url(url):
+        log_error("Invalid Instagram URL format.", "invalid_url")
+
+    cookie_files = parse_cookie_list(cookies_json)
+    if not cookie_files:
+        log_error("No cookie files provided.", "cookies_missing", 0)
+
+    started = time.perf_counter()
+    with collect_timings(bool(options.get('timings'))) as timings:
+        with timed('ytdlp_resolve'):
+            ytdlp_cmd = resolve_ytdlp_command(ytdlp_input, refresh=bool(options.get('refresh_ytdlp')))
+
+        tier = options.get('tier') if options.get('tier') is not True else None
+        quality = options.get('quality') if options.get('quality') is not True else None
+        with job_format_policy(tier, quality):
+            response = run_job(url, download_path, cookie_files, ytdlp_cmd, preview=bool(options.get('preview')))
+        if timings is not None:
+            response = dict(response, timings=timings.as_dict())
+
+    finish_job(response, time.perf_counter() - started)
+    print(json.dumps(response))
+    sys.stdout.flush()
+    # Hedge losers run on daemon threads; let them kill their yt-dlp before exiting
+    wait_for_retired_attempts(5)
+    sys.exit(0 if response.get('success') else 1)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
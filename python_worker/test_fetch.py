@@ -139,6 +139,7 @@ def test_media_extraction(cookies, url):
     try:
         from instagram_fetch import (
             parse_netscape_cookies, 
+            fetch_post_page,
             extract_post_images_from_page, 
             extract_shortcode,
             find_carousel_media,
@@ -164,16 +165,11 @@ def test_media_extraction(cookies, url):
     print(f"Shortcode: {shortcode}")
     
     # Fetch the page
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-        'Accept-Language': 'en-US,en;q=0.9',
-    }
-    
-    session = requests.Session()
-    session.cookies.update(cookies_dict)
-    response = session.get(url, headers=headers, timeout=30)
-    html = response.text
+    page, error = fetch_post_page(url, cookies_dict)
+    if error:
+        print(f"✗ Could not fetch page: {error}")
+        return False
+    html = page.html
     
     print(f"Page HTML length: {len(html)}")
     
@@ -205,7 +201,7 @@ def test_media_extraction(cookies, url):
     # Try video extraction if video indicators present
     if has_video_url or has_is_video or has_video_versions:
         print("\n  → Video content detected, extracting video URLs...")
-        video_urls = extract_video_url_from_page(html, shortcode)
+        video_urls = extract_video_url_from_page(page, shortcode)
         print(f"  Found {len(video_urls)} video URL(s)")
         for i, vid in enumerate(video_urls):
             print(f"    {i+1}. {vid[:70]}...")
@@ -220,7 +216,7 @@ def test_media_extraction(cookies, url):
     
     # Full image extraction
     print(f"\nFull image extraction result:")
-    post_data = extract_post_images_from_page(url, cookies_dict, shortcode)
+    post_data = extract_post_images_from_page(page, shortcode)
     
     image_urls = post_data.get('image_urls', [])
     username = post_data.get('username', 'unknown')
@@ -0,0 +1,984 @@
+#!/usr/bin/env python3
+"""
+Offline tests for the worker's pure helpers: format and quality selection,
+resumable downloads, cookie scheduling, download folder indexing and the
+metadata/cookie caches. No network, cookies or yt-dlp needed.
+
+Usage:
+    cd python_worker
+    python -m pytest -q test_worker.py
+"""
+
+import asyncio
+import hashlib
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+import pytest
+
+import instagram_fetch as worker
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache(tmp_path, monkeypatch):
+    """Give every test its own cache dir and a clean format policy."""
+    monkeypatch.setenv('IG_WORKER_CACHE_DIR', str(tmp_path / 'cache'))
+    for name in ('IG_WORKER_MAX_RESOLUTION', 'IG_WORKER_TIER_MAX_RESOLUTION',
+                 'IG_WORKER_PROGRESSIVE_TOLERANCE', 'IG_WORKER_META_CACHE_TTL',
+                 'IG_WORKER_MEDIA_CACHE', 'IG_WORKER_MEDIA_CACHE_MAX_BYTES', 'IG_WORKER_MEDIA_CACHE_TTL'):
+        monkeypatch.delenv(name, raising=False)
+    worker.COOKIE_JARS.clear()
+    monkeypatch.setattr(worker, 'MEDIA_CACHE_USAGE', {'swept_at': 0.0, 'bytes': 0})
+    return tmp_path / 'cache'
+
+
+def write_cookie_file(path, expires=0, session='1234567890%3Atest%3A0%3Asession'):
+    path.write_text(
+        "# Netscape HTTP Cookie File\n"
+        f".instagram.com\tTRUE\t/\tTRUE\t{expires}\tsessionid\t{session}\n"
+        f".instagram.com\tTRUE\t/\tTRUE\t{expires}\tcsrftoken\ttestcsrftoken\n"
+    )
+    return str(path)
+
+
+# Quality targets and format selection (user-023, user-024)
+
+@pytest.mark.parametrize('quality, expected', [
+    (None, (0, 0)),
+    ('original', (0, 0)),
+    ('720p', (720, 720)),
+    ('640px', (640, 640)),
+    ('720p,640px', (720, 640)),
+    ('480', (480, 480)),
+    ('1080P', (1080, 1080)),
+    ('huge', (0, 0)),
+])
+def test_parse_quality(quality, expected):
+    assert worker.parse_quality(quality) == expected
+
+
+REEL_FORMATS = [
+    {'format_id': 'p480', 'vcodec': 'avc1', 'acodec': 'mp4a', 'width': 480, 'height': 854, 'tbr': 900},
+    {'format_id': 'p720', 'vcodec': 'avc1', 'acodec': 'mp4a', 'width': 720, 'height': 1280, 'tbr': 1800},
+    {'format_id': 'v1080', 'vcodec': 'avc1', 'acodec': 'none', 'width': 1080, 'height': 1920, 'tbr': 4000},
+    {'format_id': 'a128', 'vcodec': 'none', 'acodec': 'mp4a', 'abr': 128},
+]
+
+
+def test_select_format_prefers_progressive_within_tolerance():
+    choice = worker.select_format({'formats': REEL_FORMATS}, worker.FormatPolicy(tolerance=35))
+    assert (choice.spec, choice.merged) == ('p720', False)
+
+
+def test_select_format_merges_when_progressive_is_too_small():
+    choice = worker.select_format({'formats': REEL_FORMATS}, worker.FormatPolicy(tolerance=0))
+    assert (choice.spec, choice.merged) == ('v1080+a128', True)
+
+
+def test_select_format_respects_resolution_cap():
+    choice = worker.select_format({'formats': REEL_FORMATS}, worker.FormatPolicy(tolerance=0, max_resolution=720))
+    assert choice.spec == 'p720'
+
+
+def test_select_format_picks_smallest_reaching_quality_target():
+    choice = worker.select_format({'formats': REEL_FORMATS}, worker.FormatPolicy(quality='480p'))
+    assert choice.spec == 'p480'
+
+
+def test_select_format_playlist_uses_generic_selector_with_cap():
+    choice = worker.select_format({'entries': [{}, {}]}, worker.FormatPolicy(max_resolution=720))
+    assert choice.spec == 'b/bv*+ba'
+    assert choice.cli_args() == ['-f', 'b/bv*+ba', '-S', 'res:720']
+
+
+def test_tier_cap_from_environment(monkeypatch):
+    monkeypatch.setenv('IG_WORKER_MAX_RESOLUTION', '1080')
+    monkeypatch.setenv('IG_WORKER_TIER_MAX_RESOLUTION', 'free=720,pro=1440')
+    assert worker.FormatPolicy.for_tier().max_resolution == 1080
+    assert worker.FormatPolicy.for_tier('free').max_resolution == 720
+    assert worker.FormatPolicy.for_tier('free', '480p').cache_suffix() == '@q480p480px-max720'
+
+
+# Resumable downloads (user-025)
+
+CLIP_URL = 'https://scontent-lhr8-1.cdninstagram.com/v/t/clip.mp4?oe=1'
+
+
+def start_partial(save_path, body=b'0123', total=10, etag='"abc"'):
+    """A .part file holding body out of total bytes, as an interrupted download leaves it."""
+    partial = worker.PartialDownload(CLIP_URL, save_path)
+    with partial.begin(CLIP_URL, 200, {'Content-Length': str(total), 'ETag': etag}, 0) as f:
+        partial.write(f, body, 0)
+    with pytest.raises(worker.DownloadInterrupted):
+        partial.finish()
+    return partial
+
+
+def test_partial_download_fresh_has_no_range(tmp_path):
+    partial = worker.PartialDownload(CLIP_URL, str(tmp_path / 'clip.mp4'))
+    headers = partial.request_headers({'User-Agent': 'test'})
+    assert partial.offset == 0
+    assert headers == {'User-Agent': 'test', 'Accept-Encoding': 'identity'}
+
+
+def test_partial_download_resumes_with_range_and_if_range(tmp_path):
+    save_path = str(tmp_path / 'clip.mp4')
+    start_partial(save_path)
+
+    # A re-signed URL for the same file resumes it
+    resumed = worker.PartialDownload(CLIP_URL.replace('oe=1', 'oe=2'), save_path)
+    assert (resumed.offset, resumed.total, resumed.validator) == (4, 10, '"abc"')
+    headers = resumed.request_headers({})
+    assert headers['Range'] == 'bytes=4-'
+    assert headers['If-Range'] == '"abc"'
+
+    with resumed.begin(CLIP_URL, 206, {'Content-Range': 'bytes 4-9/10', 'Content-Length': '6'}, 0) as f:
+        resumed.write(f, b'456789', 0)
+    resumed.finish()
+    resumed.complete(save_path)
+    assert open(save_path, 'rb').read() == b'0123456789'
+    assert sorted(os.listdir(tmp_path)) == ['clip.mp4']
+
+
+def test_partial_download_other_url_starts_over(tmp_path):
+    save_path = str(tmp_path / 'clip.mp4')
+    start_partial(save_path)
+    other = worker.PartialDownload('https://scontent-lhr8-1.cdninstagram.com/v/t/other.mp4', save_path)
+    assert other.offset == 0
+    assert 'Range' not in other.request_headers({})
+
+
+def test_partial_download_misaligned_content_range_discards(tmp_path):
+    save_path = str(tmp_path / 'clip.mp4')
+    start_partial(save_path)
+    resumed = worker.PartialDownload(CLIP_URL, save_path)
+    with pytest.raises(worker.DownloadInterrupted):
+        resumed.begin(CLIP_URL, 206, {'Content-Range': 'bytes 0-9/10', 'Content-Length': '10'}, 0)
+    assert os.listdir(tmp_path) == []
+    assert worker.retryable_download_error(worker.DownloadInterrupted('x'))
+
+
+def test_partial_download_full_response_restarts(tmp_path):
+    save_path = str(tmp_path / 'clip.mp4')
+    start_partial(save_path)
+    resumed = worker.PartialDownload(CLIP_URL, save_path)
+    # The file changed, so the server ignored If-Range and sent all of it
+    with resumed.begin(CLIP_URL, 200, {'Content-Length': '3', 'ETag': '"new"'}, 0) as f:
+        resumed.write(f, b'xyz', 0)
+    resumed.finish()
+    resumed.complete(save_path)
+    assert open(save_path, 'rb').read() == b'xyz'
+
+
+def test_partial_download_weak_etag_falls_back_to_last_modified(tmp_path):
+    partial = worker.PartialDownload(CLIP_URL, str(tmp_path / 'clip.mp4'))
+    headers = {'Content-Length': '10', 'ETag': 'W/"weak"', 'Last-Modified': 'Wed, 01 Jan 2025 00:00:00 GMT'}
+    partial.begin(CLIP_URL, 200, headers, 0).close()
+    assert partial.validator == 'Wed, 01 Jan 2025 00:00:00 GMT'
+
+
+def test_partial_download_unsatisfiable_range_discards(tmp_path):
+    save_path = str(tmp_path / 'clip.mp4')
+    start_partial(save_path)
+    resumed = worker.PartialDownload(CLIP_URL, save_path)
+    with pytest.raises(worker.DownloadInterrupted):
+        resumed.begin(CLIP_URL, 416, {}, 0)
+    assert os.listdir(tmp_path) == []
+
+
+def test_partial_download_http_errors_and_size_cap(tmp_path):
+    partial = worker.PartialDownload(CLIP_URL, str(tmp_path / 'clip.mp4'))
+    with pytest.raises(worker.DownloadHttpError) as error:
+        partial.begin(CLIP_URL, 404, {}, 0)
+    assert not worker.retryable_download_error(error.value)
+    assert worker.retryable_download_error(worker.DownloadHttpError(503, CLIP_URL))
+    assert worker.retryable_download_error(worker.DownloadHttpError(429, CLIP_URL))
+    with pytest.raises(worker.DownloadTooLarge):
+        partial.begin(CLIP_URL, 200, {'Content-Length': '100'}, 50)
+
+
+def test_remove_partial_downloads(tmp_path):
+    for name in ('clip.mp4.part', 'clip.mp4.part.json', 'photo.jpg'):
+        (tmp_path / name).write_bytes(b'x')
+    worker.remove_partial_downloads(str(tmp_path))
+    assert os.listdir(tmp_path) == ['photo.jpg']
+
+
+# Cookie scheduling (user-011)
+
+def test_schedule_cookies_rotates_healthy_cookies(tmp_path):
+    a = write_cookie_file(tmp_path / 'a.txt')
+    b = write_cookie_file(tmp_path / 'b.txt')
+    assert worker.schedule_cookies([a, b]) == [a, b]
+    # The first pick was marked used, so the next job starts with the other
+    assert worker.schedule_cookies([a, b]) == [b, a]
+
+
+def test_cooldown_skips_cookie_until_all_are_cooling(tmp_path):
+    a = write_cookie_file(tmp_path / 'a.txt')
+    b = write_cookie_file(tmp_path / 'b.txt')
+    worker.record_cookie_result(a, 'rate_limited', 0.1)
+    assert worker.schedule_cookies([a, b]) == [b]
+
+    worker.record_cookie_result(b, 'cookie_error', 0.1)
+    # Everything is cooling down: rate_limited (600 s) recovers before cookie_error (1800 s)
+    assert worker.schedule_cookies([a, b]) == [a, b]
+
+
+def test_failures_degrade_and_content_errors_do_not_count(tmp_path):
+    a = write_cookie_file(tmp_path / 'a.txt')
+    b = write_cookie_file(tmp_path / 'b.txt')
+    worker.record_cookie_result(a, 'private_content', 0.1)
+    worker.record_cookie_result(a, 'not_found', 0.1)
+    assert worker.schedule_cookies([a, b])[0] == a
+
+    worker.record_cookie_result(a, 'download_error', 0.1)
+    worker.record_cookie_result(a, 'download_error', 0.1)
+    # Score 0.49: degraded cookies come after healthy ones whatever their last use
+    assert worker.schedule_cookies([a, b]) == [b, a]
+    assert worker.schedule_cookies([a, b]) == [b, a]
+
+
+def test_replaced_cookie_file_resets_health(tmp_path):
+    a = write_cookie_file(tmp_path / 'a.txt')
+    b = write_cookie_file(tmp_path / 'b.txt')
+    worker.record_cookie_result(a, 'cookie_error', 0.1)
+    assert worker.schedule_cookies([a, b]) == [b]
+
+    os.utime(a, (time.time() + 10, time.time() + 10))
+    assert a in worker.schedule_cookies([a, b])
+
+
+# Download folder indexing (user-021)
+
+def test_download_index_pairs_videos_with_thumbnails(tmp_path):
+    for name in ('ABC_00001.mp4', 'ABC_00001.webp', 'ABC_00001.jpg', 'ABC_00002.jpg', 'ABC_00003.mp4.part'):
+        (tmp_path / name).write_bytes(b'x')
+    index = worker.DownloadIndex(str(tmp_path))
+    assert [p.name for p in index.media()] == ['ABC_00001.mp4']
+    assert [p.name for p in index.media(partial=True)] == ['ABC_00001.mp4', 'ABC_00002.jpg']
+    # The converted .jpg wins over the .webp yt-dlp wrote first
+    assert index.thumbnail_for(tmp_path / 'ABC_00001.mp4').name == 'ABC_00001.jpg'
+    assert index.thumbnail_for(tmp_path / 'ABC_00002.jpg') is None
+
+
+def test_download_index_missing_folder(tmp_path):
+    index = worker.DownloadIndex(str(tmp_path / 'missing'))
+    assert index.media() == []
+
+
+# Metadata cache (user-009)
+
+def oe(seconds_from_now):
+    return format(int(time.time() + seconds_from_now), 'x')
+
+
+def test_get_url_expiry():
+    assert worker.get_url_expiry('https://cdn/x.jpg?_nc_ht=a&oe=6500ABCD') == 0x6500ABCD
+    assert worker.get_url_expiry('https://cdn/x.jpg?_nc_ht=a') is None
+
+
+def test_metadata_cache_expires_with_signed_urls():
+    meta = {'image_urls': [f'https://cdn/a.jpg?oe={oe(3600)}', f'https://cdn/b.jpg?oe={oe(120)}']}
+    worker.store_cached_metadata('ABC', meta)
+    assert worker.load_cached_metadata('ABC') == meta
+
+    with open(worker.get_metadata_cache_path('ABC'), 'r', encoding='utf-8') as f:
+        expires_at = json.load(f)['expires_at']
+    # Earliest oe= less the 60 s margin, well inside the 300 s TTL
+    assert time.time() + 50 < expires_at < time.time() + 70
+
+
+def test_metadata_cache_skips_expired_and_urlless_records():
+    worker.store_cached_metadata('OLD', {'video_urls': [f'https://cdn/a.mp4?oe={oe(30)}']})
+    worker.store_cached_metadata('EMPTY', {'username': 'someone'})
+    assert worker.load_cached_metadata('OLD') is None
+    assert worker.load_cached_metadata('EMPTY') is None
+
+
+def test_metadata_cache_is_kept_per_quality_target():
+    meta = {'image_urls': ['https://cdn/a.jpg']}
+    with worker.job_format_policy(quality='640px'):
+        worker.store_cached_metadata('ABC', meta)
+        assert worker.load_cached_metadata('ABC') == meta
+    assert worker.load_cached_metadata('ABC') is None
+
+
+def test_metadata_cache_without_cache_dir(monkeypatch):
+    monkeypatch.setenv('IG_WORKER_CACHE_DIR', '/proc/nonexistent/cache')
+    worker.store_cached_metadata('ABC', {'image_urls': ['https://cdn/a.jpg']})
+    assert worker.load_cached_metadata('ABC') is None
+
+
+def test_try_download_reads_metadata_cache_once(tmp_path, monkeypatch):
+    cookie = tmp_path / 'c.txt'
+    write_cookie_file(cookie)
+    worker.store_cached_metadata('ABC', {'username': 'alice', 'image_urls': ['https://cdn/a.jpg']})
+
+    loads = []
+    load = worker.load_cached_metadata
+    monkeypatch.setattr(worker, 'load_cached_metadata', lambda shortcode: loads.append(shortcode) or load(shortcode))
+    monkeypatch.setattr(worker, 'fetch_post_page', lambda *a, **kw: pytest.fail('cached post page refetched'))
+
+    def fake_media(meta, shortcode, download_path, cookies_dict):
+        path = Path(download_path) / f"{shortcode}.jpg"
+        path.write_bytes(b'jpeg')
+        return [path], False
+    monkeypatch.setattr(worker, 'download_post_media', fake_media)
+
+    result, error, _, _ = worker.try_download('https://www.instagram.com/p/ABC/', str(tmp_path / 'dl'), str(cookie), None, 0)
+    assert error is None and result['username'] == 'alice'
+    assert loads == ['ABC']
+
+
+# Cookie file cache (user-013)
+
+def test_cookie_jar_parsed_once_until_file_changes(tmp_path):
+    path = write_cookie_file(tmp_path / 'a.txt', session='first')
+    jar = worker.load_cookie_jar(path)
+    assert jar.error is None and jar.cookies['sessionid'] == 'first'
+    assert worker.load_cookie_jar(path) is jar
+
+    write_cookie_file(tmp_path / 'a.txt', session='second')
+    os.utime(path, (time.time() + 10, time.time() + 10))
+    assert worker.load_cookie_jar(path).cookies['sessionid'] == 'second'
+
+
+def test_cookie_jar_missing_and_expired(tmp_path):
+    assert worker.load_cookie_jar(str(tmp_path / 'missing.txt')).error_type == 'cookie_not_found'
+    expired = write_cookie_file(tmp_path / 'old.txt', expires=int(time.time()) - 60)
+    assert worker.load_cookie_jar(expired).error_type == 'cookie_expired'
+
+
+# Pooled HTTP sessions (user-005)
+
+def test_http_sessions_split_media_and_evict_least_recently_used(monkeypatch):
+    pytest.importorskip('requests')
+    monkeypatch.setenv('IG_WORKER_HTTP_SESSIONS', '2')
+    worker.HTTP_SESSIONS.clear()
+    page = worker.get_http_session({'sessionid': 'a'})
+    media = worker.get_http_session({'sessionid': 'a'}, media=True)
+    assert page is not media
+    assert worker.get_http_session({'sessionid': 'a'}) is page
+    # stream_download owns media retries, so its adapter has none
+    assert media.get_adapter('https://cdn/').max_retries.total == 0
+    assert page.get_adapter('https://cdn/').max_retries.status_forcelist
+
+    worker.get_http_session({'sessionid': 'b'})
+    assert len(worker.HTTP_SESSIONS) == 2
+    assert worker.get_http_session({'sessionid': 'a'}, media=True) is not media
+    worker.HTTP_SESSIONS.clear()
+
+
+# Media cache and eviction (user-008)
+
+def downloaded_result(folder, shortcode, size=100):
+    """A success envelope for one downloaded photo of size bytes."""
+    folder.mkdir(parents=True, exist_ok=True)
+    path = folder / f"{shortcode}.jpg"
+    path.write_bytes(b'x' * size)
+    return {'success': True, 'type': 'photo', 'username': 'alice', 'cookies_tried': 1,
+            'items': [{'filename': path.name, 'path': str(path), 'type': 'image'}]}
+
+
+def test_media_cache_serves_stored_post_into_new_folder(tmp_path):
+    worker.store_cached_result('ABC', downloaded_result(tmp_path / 'job1', 'ABC'))
+    served = worker.load_cached_result('ABC', str(tmp_path / 'job2'))
+    assert served['success'] and served['username'] == 'alice'
+    assert served['items'][0]['path'] == str(tmp_path / 'job2' / 'ABC.jpg')
+    assert (tmp_path / 'job2' / 'ABC.jpg').read_bytes() == b'x' * 100
+
+
+def test_media_cache_expired_entry_is_a_miss(tmp_path, monkeypatch):
+    worker.store_cached_result('ABC', downloaded_result(tmp_path / 'job1', 'ABC'))
+    monkeypatch.setenv('IG_WORKER_MEDIA_CACHE_TTL', '-1')
+    assert worker.load_cached_result('ABC', str(tmp_path / 'job2')) is None
+
+
+def test_media_cache_evicts_least_recently_used_over_cap(tmp_path, monkeypatch):
+    monkeypatch.setenv('IG_WORKER_MEDIA_CACHE_MAX_BYTES', '250')
+    worker.store_cached_result('OLD', downloaded_result(tmp_path / 'a', 'OLD'))
+    worker.store_cached_result('MID', downloaded_result(tmp_path / 'b', 'MID'))
+    # Serving OLD makes it recently used, so MID goes first
+    result_path = os.path.join(worker.get_media_cache_entry('MID'), 'result.json')
+    os.utime(result_path, (time.time() - 60, time.time() - 60))
+    worker.load_cached_result('OLD', str(tmp_path / 'c'))
+    worker.store_cached_result('NEW', downloaded_result(tmp_path / 'd', 'NEW'))
+
+    assert worker.load_cached_result('MID', str(tmp_path / 'e')) is None
+    assert worker.load_cached_result('OLD', str(tmp_path / 'e')) is not None
+    assert worker.load_cached_result('NEW', str(tmp_path / 'e')) is not None
+
+
+def test_media_cache_sweeps_are_rate_limited(tmp_path, monkeypatch):
+    sweeps = []
+    monkeypatch.setattr(worker, 'evict_media_cache', lambda: sweeps.append(1))
+    worker.store_cached_result('A', downloaded_result(tmp_path / 'a', 'A'))
+    worker.store_cached_result('B', downloaded_result(tmp_path / 'b', 'B'))
+    assert len(sweeps) == 1
+
+    # Going over the cap sweeps straight away
+    monkeypatch.setenv('IG_WORKER_MEDIA_CACHE_MAX_BYTES', '250')
+    worker.store_cached_result('C', downloaded_result(tmp_path / 'c', 'C'))
+    assert len(sweeps) == 2
+
+
+# Single-flight (user-010)
+
+def test_single_flight_waiter_fetches_again_after_leader_fails(tmp_path, monkeypatch):
+    cookie = tmp_path / 'c.txt'
+    write_cookie_file(cookie)
+    url = 'https://www.instagram.com/p/ABC/'
+    key = worker.policy_cache_key('ABC')
+    calls = []
+
+    def fake_fetch(url, download_path, cookie_files, ytdlp_cmd):
+        calls.append(download_path)
+        if len(calls) == 1:
+            # Hold the flight until the second job is queued behind it
+            deadline = time.time() + 5
+            while worker.SINGLE_FLIGHTS[key]['users'] < 2 and time.time() < deadline:
+                time.sleep(0.01)
+            return worker.error_envelope("Rate limited.", "rate_limited", 1)
+        return downloaded_result(Path(download_path), 'ABC')
+    monkeypatch.setattr(worker, 'fetch_with_cookies', fake_fetch)
+
+    results = {}
+    def job(name):
+        results[name] = worker.run_job(url, str(tmp_path / name), [str(cookie)], None)
+    leader = threading.Thread(target=job, args=('leader',))
+    leader.start()
+    while not calls:
+        time.sleep(0.01)
+    waiter = threading.Thread(target=job, args=('waiter',))
+    waiter.start()
+    leader.join(10)
+    waiter.join(10)
+
+    assert not results['leader']['success']
+    assert results['waiter']['success']
+    assert calls == [str(tmp_path / 'leader'), str(tmp_path / 'waiter')]
+
+
+# Hedged attempts (user-012)
+
+def test_cancelled_page_fetch_is_not_recorded_as_cookie_failure(tmp_path, monkeypatch):
+    cookie = write_cookie_file(tmp_path / 'c.txt')
+    attempts = []
+
+    class RecordedAttempt(worker.HedgedAttempt):
+        def __init__(self, *args):
+            super().__init__(*args)
+            attempts.append(self)
+    monkeypatch.setattr(worker, 'HedgedAttempt', RecordedAttempt)
+
+    def cancelled_get(*args, **kwargs):
+        # The attempt loses the race while its page request is in flight
+        worker.ATTEMPT_CANCEL.get().set()
+        worker.check_cancelled()
+    monkeypatch.setattr(worker, 'http_get', cancelled_get)
+
+    response = worker.fetch_with_cookies_hedged('https://www.instagram.com/p/ABC/', str(tmp_path / 'dl'), [cookie], ['yt-dlp'])
+
+    assert not response['success']
+    assert attempts[0].outcome is None
+    assert not os.path.exists(attempts[0].staging_path)
+    with worker.cookie_health_store() as health:
+        assert cookie not in health
+
+
+# Async engine (user-020)
+
+def test_try_download_async_keeps_blocking_work_off_the_loop(tmp_path, monkeypatch):
+    cookie = write_cookie_file(tmp_path / 'c.txt')
+    on_loop = []
+
+    def off_loop(name, real=None):
+        real = real or getattr(worker, name)
+        def wrapper(*args, **kwargs):
+            if threading.current_thread() is threading.main_thread():
+                on_loop.append(name)
+            return real(*args, **kwargs)
+        monkeypatch.setattr(worker, name, wrapper)
+    for name in ('load_cookie_jar', 'load_cached_metadata', 'store_cached_metadata'):
+        off_loop(name)
+    off_loop('extract_post_metadata', lambda page, url, shortcode: {'username': 'alice', 'image_urls': ['https://cdn/a.jpg']})
+
+    async def fake_page(engine, url, cookies_dict):
+        return worker.PostPage(url, '<html></html>', 200, url), None
+
+    async def fake_media(engine, meta, shortcode, download_path, cookies_dict):
+        path = Path(download_path) / f"{shortcode}.jpg"
+        path.write_bytes(b'jpeg')
+        return [path], False
+    monkeypatch.setattr(worker, 'fetch_post_page_async', fake_page)
+    monkeypatch.setattr(worker, 'download_post_media_async', fake_media)
+
+    async def attempt():
+        engine = worker.AsyncEngine()
+        try:
+            return await worker.try_download_async(
+                engine, 'https://www.instagram.com/p/ABC/', str(tmp_path / 'dl'), cookie, None, 0
+            )
+        finally:
+            await engine.close()
+
+    result, error, _, _ = asyncio.run(attempt())
+    assert error is None and result['username'] == 'alice'
+    assert on_loop == []
+    assert worker.load_cached_metadata('ABC')['username'] == 'alice'
+
+
+# Embedded media JSON (user-014)
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'fixtures')
+
+
+def fixture_page(name, url):
+    with open(os.path.join(FIXTURES_DIR, name), 'r', encoding='utf-8') as f:
+        return worker.PostPage(url, f.read())
+
+
+def test_scan_media_payloads_decodes_nested_keys_once():
+    page = fixture_page('carousel.html', 'https://www.instagram.com/p/CAROUSEL1/')
+    # The carousel's image_versions2 blocks sit inside the web_info object
+    assert list(page.payloads) == ['xdt_api__v1__media__shortcode__web_info']
+    assert worker.scan_media_payloads('"video_versions": [not json') == {}
+
+
+def test_build_post_media_reads_carousel_items_and_sizes():
+    page = fixture_page('carousel.html', 'https://www.instagram.com/p/CAROUSEL1/')
+    media = page.get_media('CAROUSEL1')
+    assert media.username == 'bob.travels' and media.is_carousel
+    assert [url.split('?')[0].rsplit('/', 1)[1] for url in media.image_urls] == [
+        'carousel1_1_1080.jpg', 'carousel1_2_1080.jpg', 'carousel1_3_1080.jpg',
+    ]
+    assert '/carousel1_1_750.jpg' in media.image_urls_for(700)[0]
+    assert [len(variants) for variants in media.image_variants] == [4, 4, 4]
+
+
+def test_build_post_media_reads_reel_video_and_loose_story_fragments():
+    reel = fixture_page('reel.html', 'https://www.instagram.com/reel/REEL1/').get_media('REEL1')
+    assert reel.username == 'carol.cooks' and '/reel1_720.mp4' in reel.video_urls[0]
+
+    story_url = 'https://www.instagram.com/stories/dave.daily/3300000000000000002/'
+    story = fixture_page('story.html', story_url).get_media('3300000000000000002')
+    assert story.username is None
+    assert '/story1_720.mp4' in story.video_urls[0] and '/story1_cover_1080.jpg' in story.image_urls[0]
+
+
+def test_post_thumbnail_is_og_image_with_embedded_fallback():
+    page = fixture_page('photo.html', 'https://www.instagram.com/p/PHOTO1/')
+    meta = worker.extract_post_metadata(page, page.url, 'PHOTO1')
+    assert meta['username'] == 'alice.photos'
+    assert meta['thumbnail'].startswith('https://scontent-lhr8-1.cdninstagram.com/v/t51.2885-15/photo1_640.jpg?stp=dst-jpg_e35&_nc_ht=')
+    assert '/photo1_1080.jpg' in meta['image_urls'][0]
+
+    without_og = worker.PostPage(page.url, worker.OG_IMAGE_PATTERN.sub('', page.html))
+    assert '/photo1_1080.jpg' in without_og.get_post_info('PHOTO1')['thumbnail']
+
+
+# Serve mode (user-001)
+
+def test_handle_job_line_rejects_bad_jobs_and_echoes_ids(tmp_path, monkeypatch):
+    monkeypatch.setattr(worker, 'resolve_ytdlp_command', lambda ytdlp_input: ['yt-dlp'])
+    assert worker.handle_job_line('not json')['error_type'] == 'invalid_job'
+    assert worker.handle_job_line('[1, 2]')['error_type'] == 'invalid_job'
+    missing_path = worker.handle_job_line(json.dumps({'id': 7, 'url': 'https://www.instagram.com/p/ABC/'}))
+    assert missing_path['id'] == 7 and missing_path['error_type'] == 'invalid_job'
+
+    bad_url = worker.handle_job_line(json.dumps({'id': 'x', 'url': 'https://example.com/', 'download_path': str(tmp_path)}))
+    assert bad_url['id'] == 'x' and bad_url['error_type'] == 'invalid_url'
+
+
+def test_serve_stdio_answers_each_line_in_order(monkeypatch, capsys):
+    jobs = [json.dumps({'id': 1}), '', 'garbage', json.dumps({'id': 2})]
+    monkeypatch.setattr('sys.stdin', io.StringIO('\n'.join(jobs) + '\n'))
+    worker.serve_stdio('')
+
+    responses = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [r.get('id') for r in responses] == [1, None, 2]
+    assert all(r['error_type'] == 'invalid_job' for r in responses)
+
+
+def test_socket_server_answers_jobs_on_one_connection(tmp_path):
+    socket_path = str(tmp_path / 'worker.sock')
+    server = socketserver.ThreadingUnixStreamServer(socket_path, worker.JobRequestHandler)
+    server.daemon_threads = True
+    server.ytdlp_input = ''
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socket_path)
+            client.sendall(b'{"id": "a"}\n\n{"id": "b"}\n')
+            reader = client.makefile('r')
+            responses = [json.loads(reader.readline()) for _ in range(2)]
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert [r['id'] for r in responses] == ['a', 'b']
+
+
+# In-process yt-dlp (user-002)
+
+class FakeDownloadError(Exception):
+    pass
+
+
+class FakeYoutubeDL:
+    """Just enough of yt_dlp.YoutubeDL for YtdlpApiSession."""
+    instances = []
+
+    def __init__(self, params):
+        self.params = params
+        self.extracted = []
+        self.info = {'id': 'REEL1', 'ext': 'mp4', 'formats': []}
+        FakeYoutubeDL.instances.append(self)
+
+    def extract_info(self, url, download=False):
+        self.extracted.append(url)
+        if 'private' in url:
+            raise FakeDownloadError('ERROR: This content is private')
+        return self.info
+
+    def sanitize_info(self, info):
+        return dict(info)
+
+    def process_ie_result(self, info, download=True):
+        folder = os.path.dirname(self.params['outtmpl'])
+        with open(os.path.join(folder, f"{info['id']}_00001.mp4"), 'wb') as f:
+            f.write(b'\0' * 2048)
+
+
+@pytest.fixture
+def fake_ytdlp_module(monkeypatch):
+    FakeYoutubeDL.instances = []
+    module = type('yt_dlp', (), {
+        'YoutubeDL': FakeYoutubeDL,
+        'utils': type('utils', (), {'DownloadError': FakeDownloadError}),
+    })
+    monkeypatch.setattr(worker, 'YTDLP_MODULE', module)
+    return module
+
+
+def test_use_ytdlp_api_follows_engine_setting(monkeypatch, fake_ytdlp_module):
+    assert worker.use_ytdlp_api()
+    monkeypatch.setenv('IG_WORKER_YTDLP_ENGINE', 'subprocess')
+    assert not worker.use_ytdlp_api()
+    monkeypatch.setenv('IG_WORKER_YTDLP_ENGINE', 'api')
+    monkeypatch.setattr(worker, 'YTDLP_MODULE', False)
+    assert not worker.use_ytdlp_api()
+
+
+def test_ytdlp_api_session_extracts_once_and_downloads_from_same_info(tmp_path, fake_ytdlp_module):
+    session = worker.YtdlpApiSession('https://www.instagram.com/reel/REEL1/', str(tmp_path / 'dl'), 'c.txt')
+    # Nothing is built until yt-dlp is actually needed
+    assert FakeYoutubeDL.instances == []
+
+    info, error = session.fetch_metadata()
+    assert error is None and info['id'] == 'REEL1'
+    files, error = session.download(write_thumbnail=False)
+
+    assert error is None and [f.name for f in files] == ['REEL1_00001.mp4']
+    assert len(FakeYoutubeDL.instances) == 1
+    ydl = FakeYoutubeDL.instances[0]
+    assert ydl.extracted == ['https://www.instagram.com/reel/REEL1/']
+    assert ydl.params['cookiefile'] == 'c.txt' and ydl.params['writethumbnail'] is False
+
+
+def test_ytdlp_api_session_reports_errors_like_the_cli(tmp_path, fake_ytdlp_module):
+    session = worker.YtdlpApiSession('https://www.instagram.com/reel/private/', str(tmp_path), 'c.txt')
+    info, error = session.fetch_metadata()
+    assert info is None and worker.is_permanent_content_error(error)
+    assert session.download() == (None, "No metadata extracted before download.")
+
+    # A crash inside yt-dlp keeps its traceback, so it reads as an execution error
+    try:
+        raise KeyError('formats')
+    except KeyError as e:
+        assert 'Traceback' in worker.YtdlpApiSession.error_text(e)
+
+
+# yt-dlp command cache (user-003)
+
+def test_resolved_ytdlp_command_is_cached_in_process_and_on_disk(tmp_path, monkeypatch):
+    binary = tmp_path / 'yt-dlp'
+    binary.write_text('#!/bin/sh\n')
+    probes = []
+    monkeypatch.setattr(worker, 'YTDLP_COMMAND_CACHE', {})
+    monkeypatch.setattr(worker, 'find_ytdlp_command', lambda ytdlp_input: [str(binary)])
+    monkeypatch.setattr(worker, 'run_ytdlp', lambda cmd, args, timeout=120: probes.append(args) or (0, '2025.01.01\n', ''))
+
+    assert worker.resolve_ytdlp_command(str(binary)) == [str(binary)]
+    assert worker.resolve_ytdlp_command(str(binary)) == [str(binary)]
+    assert len(probes) == 1
+
+    # A new process picks the command up from disk
+    worker.YTDLP_COMMAND_CACHE.clear()
+    assert worker.resolve_ytdlp_command(str(binary)) == [str(binary)]
+    assert len(probes) == 1
+
+    # Replacing the binary, or asking for a refresh, probes again
+    os.utime(binary, (time.time() + 10, time.time() + 10))
+    worker.YTDLP_COMMAND_CACHE.clear()
+    worker.resolve_ytdlp_command(str(binary))
+    worker.resolve_ytdlp_command(str(binary), refresh=True)
+    assert len(probes) == 3
+
+
+def test_ytdlp_command_cache_expires_and_skips_failed_probes(tmp_path, monkeypatch):
+    binary = tmp_path / 'yt-dlp'
+    binary.write_text('#!/bin/sh\n')
+    key = f"python|{binary}"
+    worker.store_cached_ytdlp_command(key, [str(binary)], '2025.01.01')
+    assert worker.load_cached_ytdlp_command(key) == ([str(binary)], '2025.01.01')
+
+    monkeypatch.setenv('IG_WORKER_YTDLP_CACHE_TTL', '-1')
+    assert worker.load_cached_ytdlp_command(key) is None
+
+    monkeypatch.setattr(worker, 'YTDLP_COMMAND_CACHE', {})
+    monkeypatch.setattr(worker, 'find_ytdlp_command', lambda ytdlp_input: [str(binary)])
+    monkeypatch.setattr(worker, 'run_ytdlp', lambda cmd, args, timeout=120: (1, '', 'broken'))
+    monkeypatch.delenv('IG_WORKER_YTDLP_CACHE_TTL')
+    worker.resolve_ytdlp_command('other')
+    assert worker.load_cached_ytdlp_command(f"{sys.executable}|other") is None
+
+
+# Parallel carousel downloads (user-006)
+
+def test_download_images_parallel_keeps_order_and_host_limit(tmp_path, monkeypatch):
+    monkeypatch.setenv('IG_WORKER_CAROUSEL_CONCURRENCY', '4')
+    monkeypatch.setenv('IG_WORKER_PER_HOST_LIMIT', '2')
+    monkeypatch.setattr(worker, 'HOST_SEMAPHORES', {})
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def fake_download(url, save_path, cookies_dict):
+        with lock:
+            active.append(url)
+            peak.append(len(active))
+        time.sleep(0.05)
+        with lock:
+            active.remove(url)
+        return not url.endswith('/3.jpg')
+    monkeypatch.setattr(worker, 'download_image_with_requests', fake_download)
+
+    downloads = [(f'https://cdn.example/{i}.jpg', str(tmp_path / f'{i}.jpg')) for i in range(6)]
+    assert worker.download_images_parallel(downloads, {}) == [True, True, True, False, True, True]
+    assert max(peak) == 2
+
+
+def test_plan_and_collect_image_downloads(tmp_path):
+    meta = {'image_urls': [f'https://cdn.example/{i}.jpg?x=1' for i in range(12)]}
+    downloads = worker.plan_image_downloads(meta, 'ABC', str(tmp_path))
+    assert len(downloads) == 10
+    assert [os.path.basename(path) for _, path in downloads[:2]] == ['ABC_01.jpg', 'ABC_02.jpg']
+    assert worker.plan_image_downloads({'image_urls': meta['image_urls'][:1]}, 'ABC', '')[0][1] == 'ABC.jpg'
+
+    # Failed and truncated downloads are left out
+    (tmp_path / 'ABC_01.jpg').write_bytes(b'x' * 2000)
+    (tmp_path / 'ABC_02.jpg').write_bytes(b'x' * 10)
+    (tmp_path / 'ABC_03.jpg').write_bytes(b'x' * 2000)
+    files = worker.collect_image_downloads(downloads[:3], [True, True, False])
+    assert [f.name for f in files] == ['ABC_01.jpg']
+    assert not (tmp_path / 'ABC_02.jpg').exists()
+
+
+# Precompiled URL and error patterns (user-015)
+
+@pytest.mark.parametrize('url, valid, kind, shortcode', [
+    ('https://www.instagram.com/p/ABC_12-x/', True, 'post', 'ABC_12-x'),
+    ('https://instagram.com/reel/REEL1/?igsh=abc', True, 'reel', 'REEL1'),
+    ('https://www.instagram.com/reels/REEL2/', True, 'reel', 'REEL2'),
+    ('HTTPS://WWW.INSTAGRAM.COM/TV/TV1/', True, 'tv', None),
+    ('https://www.instagram.com/stories/dave.daily/3300000000000000002/', True, 'story', '3300000000000000002'),
+    ('https://www.instagram.com/dave.daily/', False, 'post', None),
+    ('https://example.com/p/ABC/', False, 'post', 'ABC'),
+    ('', False, 'post', None),
+])
+def test_url_helpers(url, valid, kind, shortcode):
+    assert worker.validate_url(url) is valid
+    assert worker.url_kind(url) == kind
+    assert worker.is_video_url(url) is (kind in ('reel', 'tv'))
+    if shortcode:
+        assert worker.extract_shortcode(url) == shortcode
+
+
+def test_extract_shortcode_falls_back_to_url_hash():
+    assert worker.extract_shortcode('not a url') == hashlib.md5(b'not a url').hexdigest()[:12]
+
+
+def test_error_classifiers_ignore_case_and_yield_to_execution_errors():
+    assert worker.is_permanent_content_error('ERROR: This Account is PRIVATE')
+    assert worker.is_not_found_error('HTTP Error 404: Not Found')
+    assert worker.is_cookie_error('Login Required to view this')
+    assert worker.is_photo_only_error('ERROR: No video formats found!')
+    crash = 'Traceback (most recent call last):\n  ...\nAttributeError: private'
+    assert worker.is_ytdlp_execution_error(crash)
+    assert not worker.is_permanent_content_error(crash)
+    assert not worker.is_not_found_error(None)
+
+
+# Per-stage timings (user-017)
+
+def test_timings_group_stages_and_downloads_by_attempt():
+    with worker.collect_timings(True) as timings:
+        with worker.timed('cache_lookup'):
+            pass
+        with worker.timing_attempt('/cookies/a.txt'):
+            for _ in range(2):
+                with worker.timed('parse'):
+                    time.sleep(0.002)
+            worker.record_download_timing('https://cdn.example/a.jpg', 4096, 0.5)
+        worker.record_download_timing('https://thumbs.example/t.jpg', 1024, 0.1)
+
+    result = timings.as_dict()
+    assert set(result['stages']) == {'cache_lookup'}
+    attempt, = result['attempts']
+    assert attempt['cookie'] == 'a.txt' and attempt['stages']['parse'] >= 4
+    assert attempt['ms'] >= attempt['stages']['parse']
+    assert attempt['downloads'] == [{'host': 'cdn.example', 'bytes': 4096, 'ms': 500.0, 'kbps': 8}]
+    assert result['downloads'][0]['host'] == 'thumbs.example'
+    assert worker.TIMINGS.get() is None
+
+
+def test_timings_only_in_envelopes_that_ask_for_them(tmp_path, monkeypatch):
+    monkeypatch.setattr(worker, 'resolve_ytdlp_command', lambda ytdlp_input: ['yt-dlp'])
+    job = {'url': 'https://example.com/', 'download_path': str(tmp_path)}
+    assert 'timings' not in worker.handle_job(job)
+
+    timings = worker.handle_job(dict(job, timings=True))['timings']
+    assert timings['total_ms'] >= 0 and 'ytdlp_resolve' in timings['stages']
+    assert timings['attempts'] == []
+
+
+# Prometheus metrics (user-018)
+
+@pytest.fixture
+def metrics(monkeypatch):
+    recorder = worker.Metrics()
+    recorder.enabled = True
+    monkeypatch.setattr(worker, 'METRICS', recorder)
+    return recorder
+
+
+def test_metrics_record_nothing_until_enabled():
+    recorder = worker.Metrics()
+    recorder.inc('ig_worker_errors_total', error_type='not_found')
+    recorder.observe('ig_worker_request_seconds', 1.0, outcome='error')
+    assert recorder.snapshot() == {'counters': {}, 'histograms': {}}
+
+
+def test_render_metrics_counters_and_cumulative_histograms(metrics):
+    metrics.inc('ig_worker_errors_total', error_type='not_found')
+    metrics.inc('ig_worker_errors_total', 2, error_type='private_content')
+    metrics.observe('ig_worker_cookie_attempts', 1)
+    metrics.observe('ig_worker_cookie_attempts', 4)
+    metrics.observe('ig_worker_cookie_attempts', 20)
+
+    lines = worker.render_metrics(metrics.snapshot()).splitlines()
+    assert lines[:4] == [
+        '# HELP ig_worker_errors_total Failed jobs, by error type.',
+        '# TYPE ig_worker_errors_total counter',
+        'ig_worker_errors_total{error_type="not_found"} 1',
+        'ig_worker_errors_total{error_type="private_content"} 2',
+    ]
+    assert 'ig_worker_cookie_attempts_bucket{le="1"} 1' in lines
+    assert 'ig_worker_cookie_attempts_bucket{le="5"} 2' in lines
+    assert 'ig_worker_cookie_attempts_bucket{le="+Inf"} 3' in lines
+    assert 'ig_worker_cookie_attempts_sum 25' in lines
+    assert 'ig_worker_cookie_attempts_count 3' in lines
+
+
+def test_metric_label_values_are_escaped():
+    key = worker.Metrics.key('ig_worker_errors_total', {'error_type': 'a"b\\c\nd'})
+    assert key == 'ig_worker_errors_total\terror_type="a\\"b\\\\c\\nd"'
+
+
+def test_merge_metric_states_and_take_delta(metrics):
+    metrics.inc('ig_worker_errors_total', error_type='x')
+    first = metrics.take_delta()
+    metrics.inc('ig_worker_errors_total', error_type='x')
+    metrics.observe('ig_worker_cookie_attempts', 2)
+    second = metrics.take_delta()
+    assert second['counters'] == {'ig_worker_errors_total\terror_type="x"': 1}
+
+    merged = worker.merge_metric_states(first, second)
+    assert merged['counters'] == metrics.snapshot()['counters']
+    assert merged['histograms'] == metrics.snapshot()['histograms']
+
+
+def test_metrics_file_merges_separate_processes(tmp_path, monkeypatch):
+    metrics_path = str(tmp_path / 'worker.prom')
+    for _ in range(2):
+        # Each one-shot process starts with empty metrics
+        recorder = worker.Metrics()
+        recorder.enabled = True
+        monkeypatch.setattr(worker, 'METRICS', recorder)
+        worker.observe_job({'success': False, 'error_type': 'not_found', 'cookies_tried': 1}, 0.2)
+        worker.flush_metrics_file(metrics_path)
+
+    with open(metrics_path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    assert 'ig_worker_fetches_total{content_type="none",outcome="error"} 2' in text
+    assert 'ig_worker_request_seconds_count{outcome="error"} 2' in text
+
+
+def test_metrics_endpoint(metrics):
+    metrics.inc('ig_worker_downloaded_bytes_total', 1024, downloader='http')
+    server = worker.serve_metrics(0)
+    try:
+        base = f'http://127.0.0.1:{server.server_address[1]}'
+        with urllib.request.urlopen(f'{base}/metrics') as response:
+            assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+            assert 'ig_worker_downloaded_bytes_total{downloader="http"} 1024' in response.read().decode()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f'{base}/other')
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+# Batch mode (user-019)
+
+def test_run_batch_writes_results_in_input_order(tmp_path, monkeypatch, capsys):
+    def fake_job_line(line, ytdlp_input='', default_cookies=None):
+        job = json.loads(line)
+        # Later jobs finish first
+        time.sleep(0.01 * (5 - job['id']))
+        return {'id': job['id'], 'success': job['id'] != 2, 'cookies': default_cookies}
+    monkeypatch.setattr(worker, 'handle_job_line', fake_job_line)
+
+    jobs = tmp_path / 'jobs.jsonl'
+    jobs.write_text(''.join(json.dumps({'id': i}) + '\n' + ('\n' if i == 1 else '') for i in range(5)))
+    failures = worker.run_batch(str(jobs), '', parallel=3, default_cookies=['c.txt'])
+
+    responses = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [r['id'] for r in responses] == [0, 1, 2, 3, 4]
+    assert failures == 1
+    assert all(r['cookies'] == ['c.txt'] for r in responses)
+
+
+def test_batch_jobs_use_default_cookies_unless_given(tmp_path, monkeypatch):
+    seen = []
+    monkeypatch.setattr(worker, 'resolve_ytdlp_command', lambda ytdlp_input: ['yt-dlp'])
+
+    def fake_run_job(url, download_path, cookie_files, ytdlp_cmd, preview=False):
+        seen.append(cookie_files)
+        return {'success': True}
+    monkeypatch.setattr(worker, 'run_job', fake_run_job)
+
+    job = {'url': 'https://www.instagram.com/p/ABC/', 'download_path': str(tmp_path)}
+    worker.handle_job_line(json.dumps(job), default_cookies=['default.txt'])
+    worker.handle_job_line(json.dumps(dict(job, cookies=['own.txt'])), default_cookies=['default.txt'])
+    assert seen == [['default.txt'], ['own.txt']]